@@ -0,0 +1,929 @@
+# Benchmarks for the Paint application.
+# Run from the project folder, e.g.: python bench.py strokes
+# The GUI benchmarks need a display (a real one or Xvfb). The interactive suite can start its own
+# Xvfb and save its results to compare runs across commits:
+#     python bench.py suite --xvfb --json results.json
+########### Imports Necessary libraries ###########
+import argparse
+import io
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tkinter as tk
+import tkinter.font
+from types import SimpleNamespace
+
+import numpy as np
+
+import paint
+from tools.build_atlas import ICONS
+
+
+def spiral(n, cx=450, cy=300, turns=6.0, radius=250.0):
+    """Return n integer points along a spiral centred on (cx, cy), like a long scribble."""
+    points = []
+    for i in range(n):
+        t = i / max(n - 1, 1)
+        a = t * turns * 2 * math.pi
+        r = radius * t
+        points.append((int(cx + r * math.cos(a)), int(cy + r * math.sin(a))))
+    return points
+
+
+def make_app():
+    """Create a mapped PaintApp window ready to be driven by the benchmarks."""
+    root = tk.Tk()
+    root.geometry("1200x800")
+    app = paint.PaintApp(root)
+    # Keep the journal of the benchmarks away from the one of the real application.
+    app.journal.path = os.path.join(tempfile.mkdtemp(), "journal.wal")
+    root.update()
+    return root, app
+
+
+def close_app(root, app):
+    """Close a PaintApp made by make_app, deleting its journal as a clean exit does."""
+    app.journal.close()
+    root.destroy()
+
+
+def replay_stroke(app, points):
+    """Feed one press/motion.../release sequence to the pen handlers."""
+    x, y = points[0]
+    app.start_draw(SimpleNamespace(x=x, y=y))
+    for x, y in points[1:]:
+        app.draw(SimpleNamespace(x=x, y=y))
+    app.release(SimpleNamespace(x=x, y=y))
+
+
+def replay_segments(canvas, points, color="#000000", size=2):
+    """Draw a stroke the way draw() used to: one create_line item per motion event."""
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        canvas.create_line(x0, y0, x1, y1, fill=color, width=size, smooth=True)
+
+
+def redraw_time(root, canvas, repeat=20):
+    """Median time in seconds for Tk to repaint the whole canvas."""
+    samples = []
+    for i in range(repeat):
+        canvas.configure(background="#FFFFFF" if i % 2 else "#FFFFFE")
+        start = time.perf_counter()
+        root.update_idletasks()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def bench_strokes(args):
+    """Items per stroke and redraw time, per-segment items (before) vs coalesced strokes (after)."""
+    root, app = make_app()
+    points = spiral(args.points)
+    for label, replay in (
+        ("before", lambda: replay_segments(app.canvas, points)),
+        ("after", lambda: replay_stroke(app, points)),
+    ):
+        app.clear_canvas()
+        start = time.perf_counter()
+        for _ in range(args.strokes):
+            replay()
+        draw_time = time.perf_counter() - start
+        items = len(app.canvas.find_all())
+        print(
+            f"{label:>6}: {items / args.strokes:8.1f} items/stroke  "
+            f"draw {draw_time * 1000:8.1f} ms  "
+            f"redraw {redraw_time(root, app.canvas) * 1000:8.2f} ms"
+        )
+    close_app(root, app)
+
+
+def bench_flatten(args):
+    """Redraw time as strokes accumulate, with and without flattening old items into the background."""
+    root, app = make_app()
+    rng = random.Random(3)
+    strokes = [
+        [(x + rng.randrange(-40, 40), y + rng.randrange(-40, 40)) for _ in range(20)]
+        for x, y in (
+            (rng.randrange(900), rng.randrange(600)) for _ in range(args.strokes)
+        )
+    ]
+    default_max_items = paint.FLATTEN_MAX_ITEMS
+    for label, max_items in (("live", float("inf")), ("flatten", default_max_items)):
+        paint.FLATTEN_MAX_ITEMS = max_items
+        app.clear_canvas()
+        app.history.clear()
+        print(label)
+        for count, points in enumerate(strokes, 1):
+            replay_stroke(app, points)
+            if count % args.every == 0:
+                root.update()
+                print(
+                    f"  {count:>7} strokes  {app.view.item_count:>7} items  "
+                    f"redraw {redraw_time(root, app.canvas) * 1000:8.2f} ms"
+                )
+    paint.FLATTEN_MAX_ITEMS = default_max_items
+    close_app(root, app)
+
+
+def bench_tiles(args):
+    """Time to bake one stroke into the tiled backing store, by stroke and canvas size."""
+    for side in (900, 4000, 8000):
+        store = paint.TileStore()
+        # Fill the canvas so every tile exists, as in a long session.
+        store.render(
+            store.keys_in(0, 0, side - 1, side - 1),
+            [("rectangle", (0, 0, side - 1, side - 1), {"fill": "#EEEEEE"})],
+        )
+        store.take_dirty()
+        for length in (50, 500):
+            stroke = paint.Stroke("#000000", 4, "line")
+            for x, y in spiral(200, cx=side // 2, cy=side // 2, radius=length / 2):
+                stroke.append(x, y)
+            primitives = list(stroke.primitives())
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                store.render(store.keys_in(*stroke.bbox()), primitives, over=True)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(
+                f"canvas {side:>5}px  stroke {length:>4}px  "
+                f"{len(store.take_dirty()):>3} dirty tiles  {elapsed * 1000:7.2f} ms"
+            )
+
+
+def bench_format(args):
+    """Save, open and decode times of a .paint document with many stroke points."""
+    document = paint.Document(900, 600)
+    per_stroke = 1000
+    for i in range(args.points // per_stroke):
+        stroke = paint.Stroke("#000000", 2, "line")
+        for x, y in spiral(per_stroke, radius=50 + i % 200):
+            stroke.append(x, y)
+        document.add(stroke)
+    path = os.path.join(tempfile.mkdtemp(), "bench.paint")
+    start = time.perf_counter()
+    paint.save_document(document, path)
+    saved = time.perf_counter()
+    loaded = paint.load_document(path)
+    opened = time.perf_counter()
+    loaded.materialize()
+    decoded = time.perf_counter()
+    print(
+        f"{args.points} points  {os.path.getsize(path) / 1e6:.1f} MB  "
+        f"save {(saved - start) * 1000:.0f} ms  open {(opened - saved) * 1000:.0f} ms  "
+        f"decode all {(decoded - opened) * 1000:.0f} ms"
+    )
+    os.remove(path)
+
+
+def bench_simplify(args):
+    """Points kept and median time to simplify a freehand stroke, by simplification tolerance."""
+    points = [
+        coord for point in spiral(args.points, radius=280, turns=12) for coord in point
+    ]
+    for tolerance in args.tolerances:
+        times = []
+        for _ in range(args.repeat):
+            stroke = paint.Stroke("#000000", 2, "line", points)
+            start = time.perf_counter()
+            stroke.simplify(tolerance)
+            times.append(time.perf_counter() - start)
+        elapsed = statistics.median(times)
+        start = time.perf_counter()
+        samples = paint.catmull_rom(stroke.points)
+        fitted = time.perf_counter() - start
+        print(
+            f"tolerance {tolerance:4.1f}px  {len(points) // 2} -> {len(stroke.points) // 2:>5} points "
+            f"({len(points) / len(stroke.points):5.1f}x)  simplify {elapsed * 1000:6.2f} ms  "
+            f"spline {len(samples) // 2:>5} samples {fitted * 1000:6.2f} ms"
+        )
+
+
+def bench_stamps(args):
+    """Stamps and largest gap of a stamp stroke drawn at several pen speeds, one stamp per event (before)
+    vs stamps placed by distance (after), and the time to render the stroke as one image.
+    """
+    size = args.size
+    for speed in (1, 4, 16, 48):
+        path = [(100 + i * speed, 300) for i in range(args.length // speed + 1)]
+        stroke = paint.Stroke("#000000", size, "round", [c for p in path for c in p])
+        start = time.perf_counter()
+        centres = stroke.stamps()
+        placed = time.perf_counter() - start
+        x0, y0, x1, y1 = (math.floor(value) for value in stroke.bbox())
+        image = paint.Image.new("RGBA", (x1 - x0 + 2, y1 - y0 + 2), (0, 0, 0, 0))
+        start = time.perf_counter()
+        paint.RasterRenderer.on(image, (x0, y0)).render(stroke.primitives())
+        rendered = time.perf_counter() - start
+        gap = max(speed - 2 * size, 0)
+        after_gap = max(float(np.diff(centres[:, 0]).max()) - 2 * size, 0)
+        print(
+            f"{speed:>3} px/event  before {len(path):>5} stamps gap {gap:>3} px  "
+            f"after {len(centres):>5} stamps gap {after_gap:>3.0f} px  "
+            f"place {placed * 1000:5.2f} ms  render {rendered * 1000:6.2f} ms"
+        )
+
+
+def bench_fonts(args):
+    """Time to list the font families from Tk vs from the disk cache, and time to the first frame."""
+    root = tk.Tk()
+    start = time.perf_counter()
+    families = sorted(
+        family for family in tk.font.families(root) if not family.startswith("@")
+    )
+    scanned = time.perf_counter() - start
+    path = os.path.join(tempfile.mkdtemp(), "fonts.json")
+    paint.font_families(root, path)
+    start = time.perf_counter()
+    paint.font_fingerprint()
+    fingerprint = time.perf_counter() - start
+    start = time.perf_counter()
+    paint.font_families(root, path)
+    cached = time.perf_counter() - start
+    root.destroy()
+    print(
+        f"{len(families)} families  Tk scan {scanned * 1000:.1f} ms  "
+        f"fingerprint {fingerprint * 1000:.1f} ms  cached list {cached * 1000:.1f} ms"
+    )
+    start = time.perf_counter()
+    root, app = make_app()
+    first_frame = time.perf_counter() - start
+    close_app(root, app)
+    print(
+        f"first frame {first_frame * 1000:.0f} ms "
+        f"(listing the families eagerly would add {scanned * 1000:.0f} ms)"
+    )
+
+
+def bench_icons(args):
+    """Time to decode the toolbar and menu icons as separate PNGs (before) vs from the atlas (after),
+    and time to the first frame.
+    """
+    root = tk.Tk()
+    before = []
+    after = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        icons = [
+            tk.PhotoImage(
+                master=root,
+                file=os.path.join(paint.ASSETS_DIR, file),
+                width=size,
+                height=size,
+            )
+            for file, size in ICONS.values()
+        ]
+        before.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        atlas = paint.IconAtlas(root)
+        icons = [atlas.get(name) for name in ICONS]
+        after.append(time.perf_counter() - start)
+    root.destroy()
+    print(
+        f"{len(ICONS)} icons  separate PNGs {statistics.median(before) * 1000:.2f} ms  "
+        f"atlas {statistics.median(after) * 1000:.2f} ms"
+    )
+    start = time.perf_counter()
+    root, app = make_app()
+    first_frame = time.perf_counter() - start
+    close_app(root, app)
+    print(f"first frame {first_frame * 1000:.0f} ms")
+
+
+def random_shapes(count, side, seed=1):
+    """Return count small random rectangles spread over a side x side square."""
+    rng = random.Random(seed)
+    shapes = []
+    for _ in range(count):
+        x = rng.randrange(side)
+        y = rng.randrange(side)
+        w = rng.randrange(2, 24)
+        h = rng.randrange(2, 24)
+        shapes.append(paint.Shape("rectangle", (x, y, x + w, y + h), "#000000"))
+    return shapes
+
+
+def query_latency(query, queries):
+    """Mean latency in microseconds of calling query(*args) for every args of queries."""
+    start = time.perf_counter()
+    for args in queries:
+        query(*args)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def bench_index(args):
+    """Point and rectangle query latency of the spatial index vs canvas.find_overlapping."""
+    canvas = None
+    if not args.no_canvas:
+        root = tk.Tk()
+        canvas = tk.Canvas(root)
+    for count in args.sizes:
+        side = min(int(count**0.5 * 20), 32000)  # Same density at every size
+        rng = random.Random(2)
+        points = [
+            (rng.randrange(side), rng.randrange(side)) for _ in range(args.queries)
+        ]
+        rects = [(x, y, x + 100, y + 100) for x, y in points]
+        index = paint.GridIndex()
+        start = time.perf_counter()
+        for element_id, shape in enumerate(random_shapes(count, side), 1):
+            shape.id = element_id
+            index.insert(shape)
+        build = time.perf_counter() - start
+        print(f"{count:>9} primitives  (index build {build:.2f} s)")
+        print(
+            f"    index   point {query_latency(index.query_point, points):9.1f} us"
+            f"   rect {query_latency(index.query_rect, rects):9.1f} us"
+        )
+        if canvas is not None:
+            canvas.delete("all")
+            for shape in index.elements.values():
+                canvas.create_rectangle(*shape.coords)
+            point_rects = [(x, y, x, y) for x, y in points]
+            print(
+                f"    canvas  point {query_latency(canvas.find_overlapping, point_rects):9.1f} us"
+                f"   rect {query_latency(canvas.find_overlapping, rects):9.1f} us"
+            )
+    if canvas is not None:
+        root.destroy()
+
+
+def bench_viewport(args):
+    """Zoom and pan times on a document of random walks, baked into tiles as a loaded document is."""
+    root, app = make_app()
+    width, height = args.size
+    rng = np.random.default_rng(5)
+    starts = rng.integers((0, 0), (width, height), size=(args.strokes, 1, 2))
+    steps = rng.integers(-6, 7, size=(args.strokes, args.points, 2))
+    paths = np.clip(starts + np.cumsum(steps, axis=1), 0, (width - 1, height - 1))
+    document = paint.Document(width, height)
+    for path in paths.astype(np.int16):
+        document.add(paint.Stroke("#000000", 2, "line", path.ravel().tolist()))
+    app.set_document(document)
+    root.update()
+    print(f"{args.strokes * args.points} points on {width}x{height}")
+
+    def measure(label, action):
+        start = time.perf_counter()
+        action()
+        root.update()
+        print(
+            f"{label:>10}: {(time.perf_counter() - start) * 1000:8.1f} ms  "
+            f"{len(app.canvas.find_all()):6d} items  "
+            f"{len(app.view.tiles.tiles):4d} tiles  {paint.process_memory() or 0:6.0f} MB"
+        )
+
+    for zoom in (0.5, 0.25, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 1.0):
+        measure(f"zoom {zoom:g}", lambda: app.view.zoom_to(zoom))
+    app.view.zoom_to(2.0)
+    shift = app.canvas.winfo_width() // 4
+    for step in range(1, 5):
+        measure(
+            f"pan {step}",
+            lambda: (app.view.scroll_by(shift, 0), app.view.viewport_changed()),
+        )
+    close_app(root, app)
+
+
+def bench_layers(args):
+    """Time to draw a stroke on the top layer and to hide the bottom layer, as the layers below the top
+    one hold more strokes, against rendering the whole drawing once.
+    """
+    root, app = make_app()
+    rng = np.random.default_rng(7)
+    points = spiral(200)
+    for count in args.layers:
+        document = paint.Document(900, 600)
+        for position in range(count):
+            if position:
+                document.add_layer()
+            starts = rng.integers((0, 0), (900, 600), size=(args.strokes, 1, 2))
+            steps = rng.integers(-6, 7, size=(args.strokes, args.points, 2))
+            paths = np.clip(starts + np.cumsum(steps, axis=1), 0, (899, 599))
+            for path in paths.astype(np.int16):
+                document.add(paint.Stroke("#000000", 2, "line", path.ravel().tolist()))
+        document.add_layer("Top")
+        app.set_document(document)
+        root.update()
+        start = time.perf_counter()
+        replay_stroke(app, points)
+        root.update()
+        draw = time.perf_counter() - start
+        start = time.perf_counter()
+        document.layers[0].visible = False
+        app.layers_changed()
+        root.update()
+        hide = time.perf_counter() - start
+        start = time.perf_counter()
+        paint.render_document(document)
+        render = time.perf_counter() - start
+        print(
+            f"{count:2d} layers below x {args.strokes} strokes  "
+            f"draw on top {draw * 1000:7.1f} ms  hide bottom {hide * 1000:7.1f} ms  "
+            f"render all {render * 1000:7.1f} ms"
+        )
+    close_app(root, app)
+
+
+def bench_fill(args):
+    """Time of a bucket fill from the middle of a blank page, of a page crossed by strokes and of a
+    noisy page, vectorized run fill vs PIL's pixel by pixel flood fill, then of the whole bucket tool
+    on a drawing of those strokes: rendering the page for each click vs clicks in a row kept up to date
+    by a RenderCache.
+    """
+    width, height = args.size
+    rng = np.random.default_rng(3)
+    blank = paint.Image.new("RGB", (width, height), "#FFFFFF")
+    strokes = blank.copy()
+    draw = paint.ImageDraw.Draw(strokes)
+    document = paint.Document(width, height)
+    for _ in range(args.strokes):
+        points = rng.integers(0, (width, height), size=(8, 2)).ravel().tolist()
+        draw.line(points, fill="#000000", width=3)
+        document.add(paint.Stroke("#000000", 3, "line", points))
+    noise = paint.Image.fromarray(
+        rng.integers(200, 256, size=(height, width, 3), dtype=np.uint8), "RGB"
+    )
+    x, y = width // 2, height // 2
+    for name, image in (("blank", blank), ("strokes", strokes), ("noise", noise)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            x0, y0, mask = paint.flood_fill(image, x, y, args.tolerance)
+        runs = (time.perf_counter() - start) / args.repeat
+        start = time.perf_counter()
+        paint.ImageDraw.floodfill(
+            image.copy(), (x, y), (0, 0, 255), thresh=args.tolerance
+        )
+        pixel = time.perf_counter() - start
+        print(
+            f"{name:<8} {width}x{height}  {int(np.count_nonzero(mask)):>8} px filled  "
+            f"runs {runs * 1000:7.1f} ms  PIL floodfill {pixel * 1000:7.1f} ms"
+        )
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        fill = paint.fill_for(document, x, y, "#0000FF", args.tolerance)
+    cold = (time.perf_counter() - start) / args.repeat
+    # Clicks in a row, each fill being added and noted by the cache as the bucket tool does
+    cache = paint.RenderCache()
+    paint.fill_for(document, x, y, "#0000FF", args.tolerance, cache)
+    colors = itertools.cycle(("#FF0000", "#00FF00", "#0000FF"))
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        fill = paint.fill_for(document, x, y, next(colors), args.tolerance, cache)
+        document.add(fill)
+        cache.changed(added=[fill])
+    warm = (time.perf_counter() - start) / args.repeat
+    print(
+        f"bucket   {width}x{height}  {fill.mask.width}x{fill.mask.height} fill box  "
+        f"page rendered {cold * 1000:7.1f} ms  from the cache {warm * 1000:7.1f} ms"
+    )
+
+
+def bench_export(args):
+    """Longest stall of the main thread while a drawing is exported to each image format: encoded
+    synchronously (before) vs by an export worker thread, the main thread ticking every 5 ms as the
+    Tk event loop would.
+    """
+    rng = np.random.default_rng(11)
+    width, height = args.size
+    document = paint.Document(width, height)
+    for _ in range(args.strokes):
+        start = rng.integers((0, 0), (width, height), size=(1, 2))
+        path = np.clip(
+            start + np.cumsum(rng.integers(-8, 9, (100, 2)), axis=0), 0, None
+        )
+        document.add(paint.Stroke("#000000", 3, "line", path.ravel().tolist()))
+    directory = tempfile.mkdtemp()
+    for extension in (".png", ".jpg", ".webp"):
+        image_format = paint.EXPORT_FORMATS[extension]
+        settings = paint.EXPORT_SETTINGS[image_format]
+        path = os.path.join(directory, f"bench{extension}")
+        start = time.perf_counter()
+        paint.render_document(document).save(path, image_format, **settings)
+        blocking = time.perf_counter() - start
+        job = paint.ExportJob(document, path, image_format, settings).start()
+        start = last = time.perf_counter()
+        stall = 0.0
+        while not job.done:
+            time.sleep(0.005)
+            now = time.perf_counter()
+            stall = max(stall, now - last - 0.005)
+            last = now
+        elapsed = time.perf_counter() - start
+        print(
+            f"{image_format:<5} {width}x{height}  synchronous: stall {blocking * 1000:7.0f} ms  "
+            f"worker: {elapsed * 1000:7.0f} ms, longest stall {stall * 1000:6.1f} ms"
+        )
+        os.remove(path)
+
+
+def bench_svg(args):
+    """Time, size and <path> count of the SVG export of random walk strokes in a few colours, the
+    consecutive strokes of the same colour being merged into one path.
+    """
+    rng = np.random.default_rng(13)
+    document = paint.Document(4000, 4000)
+    colors = ["#000000", "#EC1C24", "#0ED145"]
+    starts = rng.integers(0, 4000, size=(args.strokes, 1, 2))
+    steps = rng.integers(-6, 7, size=(args.strokes, args.points, 2))
+    paths = np.clip(starts + np.cumsum(steps, axis=1), 0, 3999).astype(np.int16)
+    for number, path in enumerate(paths):
+        color = colors[number // args.run % len(colors)]
+        document.add(paint.Stroke(color, 2, "line", path.ravel().tolist()))
+    path = os.path.join(tempfile.mkdtemp(), "bench.svg")
+    start = time.perf_counter()
+    paint.save_svg(document, path)
+    elapsed = time.perf_counter() - start
+    with open(path, encoding="utf-8") as file:
+        elements = file.read().count("<path")
+    print(
+        f"{args.strokes} strokes x {args.points - 1} segments  {elapsed * 1000:.0f} ms  "
+        f"{os.path.getsize(path) / 1e6:.1f} MB  {elements} paths"
+    )
+    os.remove(path)
+
+
+def bench_import(args):
+    """Time to import a synthetic photo: header read, first (draft) mip level and whole pyramid, then
+    time to draw a viewport of it at a few zoom levels, from the pyramid vs scaling the full photo.
+    """
+    rng = np.random.default_rng(17)
+    width, height = args.size
+    noise = rng.integers(
+        0, 256, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8
+    )
+    photo = paint.Image.fromarray(noise, "RGB").resize(
+        (width, height), paint.Image.BILINEAR
+    )
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=90)
+    data = buffer.getvalue()
+    start = time.perf_counter()
+    picture = paint.Picture(0, 0, data)
+    header = time.perf_counter() - start
+    picture.start()
+    while not picture.levels:
+        time.sleep(0.001)
+    first = time.perf_counter() - start
+    picture.build()
+    built = time.perf_counter() - start
+    print(
+        f"{width}x{height} JPEG {len(data) / 1e6:.1f} MB  header {header * 1000:.1f} ms  "
+        f"first level {first * 1000:.0f} ms  {len(picture.levels)} levels {built * 1000:.0f} ms"
+    )
+    view_width, view_height = args.viewport
+    full = picture.levels[0]
+    for zoom in args.zooms:
+        primitive = paint.scale_primitive(next(picture.primitives()), zoom)
+        origin = (width * zoom - view_width) / 2, (height * zoom - view_height) / 2
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            viewport = paint.Image.new("RGBA", (view_width, view_height), (0, 0, 0, 0))
+            paint.RasterRenderer.on(viewport, origin, preview=True).render([primitive])
+        pyramid = (time.perf_counter() - start) / args.repeat
+        start = time.perf_counter()
+        full.resize((max(round(width * zoom), 1), max(round(height * zoom), 1)))
+        whole = time.perf_counter() - start
+        print(
+            f"zoom {zoom:<6g} {view_width}x{view_height}  pyramid {pyramid * 1000:6.1f} ms  "
+            f"full photo scaled {whole * 1000:7.1f} ms"
+        )
+
+
+########### Interactive suite ###########
+# A trace is {"name": ..., "setup": [[method, *args], ...], "text": ..., "events": [...]}: the
+# PaintApp methods to call first (the toolbar buttons), the text of the text entry, then the
+# events to generate: ["press" | "motion" | "release", x, y] on the canvas or ["key", sequence]
+# on the main window. Recorded traces in that format can be passed with --traces.
+EVENT_SEQUENCES = {
+    "press": "<ButtonPress-1>",
+    "motion": "<B1-Motion>",
+    "release": "<ButtonRelease-1>",
+}
+
+
+def drag(points):
+    """Return the press, motion... and release events of a mouse drag along points."""
+    (x, y), *rest = points
+    events = [["press", x, y]]
+    events += [["motion", x, y] for x, y in rest]
+    events.append(["release", *points[-1]])
+    return events
+
+
+def scribbles(rng, count, length):
+    """Return the events of count random freehand drags of length motion events each."""
+    events = []
+    for _ in range(count):
+        x, y = rng.randrange(100, 800), rng.randrange(100, 500)
+        angle = rng.uniform(0, 2 * math.pi)
+        points = []
+        for _ in range(length + 1):
+            angle += rng.uniform(-0.4, 0.4)
+            x = min(max(x + 6 * math.cos(angle), 0), 899)
+            y = min(max(y + 6 * math.sin(angle), 0), 599)
+            points.append((round(x), round(y)))
+        events += drag(points)
+    return events
+
+
+def synthetic_traces(seed=5, strokes=40, length=60):
+    """Return reproducible traces covering every pen type, the eraser, every shape tool, text, undo and clear."""
+    rng = random.Random(seed)
+    traces = []
+    for pen_type in paint.PEN_TYPES:
+        traces.append(
+            {
+                "name": f"pen-{pen_type}",
+                "setup": [["select_pen_tool"], ["select_pen_type", pen_type]],
+                "events": scribbles(rng, strokes, length),
+            }
+        )
+    traces.append(
+        {
+            "name": "eraser",
+            "setup": [["select_pen_tool"], ["select_size", 10]],
+            "events": scribbles(rng, strokes, length)
+            + [["call", "select_eraser_tool"]]
+            + scribbles(rng, strokes // 2, length),
+        }
+    )
+    for tool, method in (
+        ("rectangle", "draw_rectangle"),
+        ("frectangle", "draw_filled_rectangle"),
+        ("circle", "draw_circle"),
+        ("fcircle", "draw_filled_circle"),
+        ("line", "draw_line"),
+    ):
+        events = []
+        for _ in range(strokes):
+            x, y = rng.randrange(900), rng.randrange(600)
+            events += drag([(x, y), (x + 20, y + 10), (x + 60, y + 40)])
+        traces.append({"name": tool, "setup": [[method]], "events": events})
+    events = []
+    for _ in range(strokes):
+        x, y = rng.randrange(900), rng.randrange(600)
+        events += [["press", x, y], ["release", x, y]]
+    traces.append(
+        {"name": "text", "setup": [["draw_text"]], "text": "Paint", "events": events}
+    )
+    traces.append(
+        {
+            "name": "undo",
+            "setup": [["select_pen_tool"]],
+            "events": scribbles(rng, strokes, length)
+            + [["key", "<Control-z>"]] * strokes
+            + [["key", "<Control-y>"]] * strokes,
+        }
+    )
+    events = []
+    for _ in range(10):
+        events += scribbles(rng, strokes // 10, length) + [["key", "<Control-n>"]]
+    traces.append({"name": "clear", "setup": [["select_pen_tool"]], "events": events})
+    return traces
+
+
+def percentiles(samples):
+    """Return the p50, p90, p99 and max of latency samples in seconds, as milliseconds."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": ordered[-1] * 1000}
+
+
+def run_trace(root, app, trace):
+    """Replay a trace on a fresh drawing and return its measures."""
+    app.select_pen_tool()
+    app.clear_canvas()
+    app.history.clear()
+    app.entry_text.delete(0, tk.END)
+    app.entry_text.insert(0, trace.get("text", ""))
+    for method, *arguments in trace.get("setup", ()):
+        getattr(app, method)(*arguments)
+    root.focus_force()  # Key events go to the focused window
+    root.update()
+    latencies = {}
+    started = time.perf_counter()
+    for kind, *arguments in trace["events"]:
+        if kind == "call":
+            getattr(app, arguments[0])(*arguments[1:])
+            continue
+        start = time.perf_counter()
+        if kind == "key":
+            root.event_generate(arguments[0])
+        else:
+            x, y = arguments
+            app.canvas.event_generate(EVENT_SEQUENCES[kind], x=x, y=y)
+        latencies.setdefault(kind, []).append(time.perf_counter() - start)
+        root.update_idletasks()  # Redraw as the event loop would
+    root.update()
+    elapsed = time.perf_counter() - started
+    count = sum(len(samples) for samples in latencies.values())
+    return {
+        "events": count,
+        "seconds": elapsed,
+        "events_per_second": count / elapsed,
+        "latency_ms": {
+            kind: percentiles(samples) for kind, samples in latencies.items()
+        },
+        "canvas_items": len(app.canvas.find_all()),
+        "elements": len(app.document),
+        "rss_mb": paint.process_memory(),
+    }
+
+
+def start_xvfb():
+    """Start a virtual X server for the run and point DISPLAY at it, return its process."""
+    number = 99
+    while os.path.exists(f"/tmp/.X11-unix/X{number}"):
+        number += 1
+    server = subprocess.Popen(
+        ["Xvfb", f":{number}", "-screen", "0", "1600x1000x24", "-nolisten", "tcp"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+            break
+        time.sleep(0.05)
+    os.environ["DISPLAY"] = f":{number}"
+    return server
+
+
+def git_commit():
+    """Return the commit the benchmarks run on, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """Replay input traces through event_generate: handler latency, events/s, canvas items and RSS."""
+    server = start_xvfb() if args.xvfb else None
+    try:
+        if args.traces:
+            with open(args.traces, encoding="utf-8") as file:
+                traces = json.load(file)
+        else:
+            traces = synthetic_traces(strokes=args.strokes, length=args.length)
+        root, app = make_app()
+        results = {}
+        for trace in traces:
+            if args.only and trace["name"] not in args.only:
+                continue
+            result = results[trace["name"]] = run_trace(root, app, trace)
+            latency = " ".join(
+                f"{kind} p50 {values['p50']:.2f} p99 {values['p99']:.2f}"
+                for kind, values in result["latency_ms"].items()
+            )
+            rss = result["rss_mb"]
+            print(
+                f"{trace['name']:>11}: {result['events_per_second']:8.0f} events/s  "
+                f"{result['canvas_items']:>6} items  "
+                f"{'-' if rss is None else f'{rss:.0f}'} MB  ms: {latency}"
+            )
+        close_app(root, app)
+    finally:
+        if server is not None:
+            server.terminate()
+    if args.json:
+        report = {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "tk": tk.TkVersion,
+            "platform": sys.platform,
+            "traces": "synthetic" if not args.traces else args.traces,
+            "results": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Paint application benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    strokes = commands.add_parser("strokes", help=bench_strokes.__doc__)
+    strokes.add_argument("--strokes", type=int, default=20)
+    strokes.add_argument("--points", type=int, default=1000)
+    strokes.set_defaults(func=bench_strokes)
+
+    flatten = commands.add_parser("flatten", help=bench_flatten.__doc__)
+    flatten.add_argument("--strokes", type=int, default=40_000)
+    flatten.add_argument("--every", type=int, default=5_000)
+    flatten.set_defaults(func=bench_flatten)
+
+    tiles = commands.add_parser("tiles", help=bench_tiles.__doc__)
+    tiles.add_argument("--repeat", type=int, default=20)
+    tiles.set_defaults(func=bench_tiles)
+
+    document_format = commands.add_parser("format", help=bench_format.__doc__)
+    document_format.add_argument("--points", type=int, default=1_000_000)
+    document_format.set_defaults(func=bench_format)
+
+    simplify = commands.add_parser("simplify", help=bench_simplify.__doc__)
+    simplify.add_argument("--points", type=int, default=10_000)
+    simplify.add_argument(
+        "--tolerances", type=float, nargs="+", default=[0.5, 0.8, 1.5, 3.0]
+    )
+    simplify.add_argument("--repeat", type=int, default=20)
+    simplify.set_defaults(func=bench_simplify)
+
+    stamps = commands.add_parser("stamps", help=bench_stamps.__doc__)
+    stamps.add_argument("--length", type=int, default=2000)
+    stamps.add_argument("--size", type=int, default=4)
+    stamps.set_defaults(func=bench_stamps)
+
+    fonts = commands.add_parser("fonts", help=bench_fonts.__doc__)
+    fonts.set_defaults(func=bench_fonts)
+
+    icons = commands.add_parser("icons", help=bench_icons.__doc__)
+    icons.add_argument("--repeat", type=int, default=20)
+    icons.set_defaults(func=bench_icons)
+
+    index = commands.add_parser("index", help=bench_index.__doc__)
+    index.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    index.add_argument("--queries", type=int, default=1000)
+    index.add_argument(
+        "--no-canvas",
+        action="store_true",
+        help="Skip the canvas.find_overlapping comparison (no display needed).",
+    )
+    index.set_defaults(func=bench_index)
+
+    viewport = commands.add_parser("viewport", help=bench_viewport.__doc__)
+    viewport.add_argument("--strokes", type=int, default=2000)
+    viewport.add_argument("--points", type=int, default=500)
+    viewport.add_argument("--size", type=paint.parse_size, default=(900, 600))
+    viewport.set_defaults(func=bench_viewport)
+
+    layers = commands.add_parser("layers", help=bench_layers.__doc__)
+    layers.add_argument("--layers", type=int, nargs="+", default=[1, 4, 16])
+    layers.add_argument("--strokes", type=int, default=500)
+    layers.add_argument("--points", type=int, default=200)
+    layers.set_defaults(func=bench_layers)
+
+    fill = commands.add_parser("fill", help=bench_fill.__doc__)
+    fill.add_argument("--size", type=paint.parse_size, default=(3840, 2160))
+    fill.add_argument("--strokes", type=int, default=200)
+    fill.add_argument("--tolerance", type=int, default=paint.FILL_TOLERANCE)
+    fill.add_argument("--repeat", type=int, default=5)
+    fill.set_defaults(func=bench_fill)
+
+    export = commands.add_parser("export", help=bench_export.__doc__)
+    export.add_argument("--size", type=paint.parse_size, default=(3840, 2160))
+    export.add_argument("--strokes", type=int, default=5000)
+    export.set_defaults(func=bench_export)
+
+    svg = commands.add_parser("svg", help=bench_svg.__doc__)
+    svg.add_argument("--strokes", type=int, default=20000)
+    svg.add_argument("--points", type=int, default=51)
+    svg.add_argument(
+        "--run", type=int, default=100, help="Strokes drawn in a row in one colour."
+    )
+    svg.set_defaults(func=bench_svg)
+
+    picture = commands.add_parser("import", help=bench_import.__doc__)
+    picture.add_argument("--size", type=paint.parse_size, default=(8660, 5773))
+    picture.add_argument("--viewport", type=paint.parse_size, default=(900, 600))
+    picture.add_argument(
+        "--zooms", type=float, nargs="+", default=[2.0, 1.0, 0.5, 0.125]
+    )
+    picture.add_argument("--repeat", type=int, default=5)
+    picture.set_defaults(func=bench_import)
+
+    suite = commands.add_parser("suite", help=bench_suite.__doc__)
+    suite.add_argument("--json", help="Write the results to this JSON file.")
+    suite.add_argument("--traces", help="JSON file of recorded traces to replay.")
+    suite.add_argument("--only", nargs="+", help="Names of the traces to replay.")
+    suite.add_argument("--strokes", type=int, default=40)
+    suite.add_argument("--length", type=int, default=60)
+    suite.add_argument(
+        "--xvfb", action="store_true", help="Run on a private Xvfb display."
+    )
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,50 +5,3785 @@
 ########### Imports Necessary libraries ###########
 import tkinter as tk
 from tkinter import ttk
-from tkinter import colorchooser, filedialog, messagebox, font
-import PIL.ImageGrab as ImageGrab
+from tkinter import colorchooser, filedialog, messagebox, font, simpledialog
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps, ImageTk
+import numpy as np
 from tktooltip import ToolTip  # Provides a tooltip (pop-up) widget for tkinter
-import re  # Support for regular expressions (RE).
+import argparse
+import base64
+import functools
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import mmap
+import operator
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from xml.sax.saxutils import escape, quoteattr
 
 PAINTVERSION = "Paint 1.1.0"
+APP_DIR = os.path.join(os.path.expanduser("~"), ".paint")  # Per-user journal and caches
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+HISTORY_MAX_ENTRIES = 500  # Undo steps kept before the oldest ones are dropped
+HISTORY_MAX_BYTES = 64 * 1024 * 1024  # Memory budget of the undo history
+GRID_CELL_SIZE = 64  # Side in pixels of the spatial index cells
+FLATTEN_MAX_ITEMS = 5000  # Canvas items kept before older elements are flattened
+FLATTEN_KEEP_STEPS = 50  # Most recent undo steps whose elements always stay live
+TILE_SIZE = 256  # Side in pixels of the raster backing store tiles
+STAMP_SPACING = 0.5  # Distance between two pen stamps, as a fraction of the pen size
+SIMPLIFY_TOLERANCE = 0.8  # Max distance in pixels of the dropped points of a finished stroke (0 keeps them all)
+SIMPLIFY_CHUNK = (
+    128  # Points of a stroke between two cuts that simplification always keeps
+)
+CURVE_FITTING = False  # Draw finished strokes as Catmull-Rom splines through their simplified points
+CURVE_SPACING = 4  # Distance in pixels between two samples of a Catmull-Rom spline
+DOCUMENT_MAX_SIZE = 32000  # Largest document side in pixels, as points are int16
+PAGE_OUTLINE = "#A0A4AB"  # Border of the document page on the Canvas
+ZOOM_MIN = 0.05  # Smallest zoom level of the Canvas
+ZOOM_MAX = 16.0  # Largest zoom level of the Canvas
+ZOOM_STEP = 1.25  # Zoom factor of one mouse wheel notch
+ZOOM_CACHE_LEVELS = 3  # Zoom levels whose tiles are kept, so zooming back is instant
+VIEW_MARGIN = 0.5  # Part of the viewport realized beyond each of its sides
+LOD_CELL = 1.0  # Screen pixels per point kept of a zoomed out stroke
+LOD_STAMP_SIZE = 2  # Stamp strokes thinner on screen than this are drawn as lines
+FILL_TOLERANCE = 32  # Largest channel difference of the pixels a bucket fill spreads to
+FILL_PROBE = 256  # Half side of the window a bucket fill tries first around the click
+FILL_WINDOW = 4096  # Side of the part of a large page a bucket fill looks in first
+RENDER_CACHE_CHANGES = 256  # Edits a RenderCache catches up with before rendering anew
+PICTURE_TOP_SIZE = 256  # Largest side of the coarsest mip level of an imported picture
+PICTURE_POLL_MS = 100  # How often the Tk thread shows the mip levels built meanwhile
+PICTURE_PLACEHOLDER = "#E4E6EA"  # Drawn where a picture is not decoded yet
+EXPORT_PROGRESS_STEP = (
+    256  # Elements rendered or saved between two export progress reports
+)
+EXPORT_POLL_MS = 50  # How often the Tk thread shows the progress of a running export
+EXPORT_STATUS_MS = 3000  # How long the outcome of an export stays shown
+
+
+########### Document model ###########
+# The drawing is kept as a Document of elements (strokes, shapes, texts, fills and
+# pictures) that know nothing about Tk. Points are packed in signed 16-bit arrays, so a
+# stroke point costs 4 bytes instead of a full canvas item configuration.
+# Elements are stacked by layer, then by (z, id): z is the id of the element when it was drawn,
+# and the pieces left by the eraser inherit the z of the stroke they were cut from.
+
+
+def clip_polyline(points, cx, cy, radius):
+    """Cut the part of a polyline inside a circle.\n
+    Return None when the circle does not touch the polyline, else the list of the flat point lists left outside.
+    """
+    count = len(points) // 2
+    r2 = radius * radius
+    if count == 1:
+        dx, dy = points[0] - cx, points[1] - cy
+        return [] if dx * dx + dy * dy <= r2 else None
+    pieces = []
+    current = []
+    touched = False
+    for i in range(count - 1):
+        ax, ay, bx, by = points[2 * i : 2 * i + 4]
+        dx, dy = bx - ax, by - ay
+        fx, fy = ax - cx, ay - cy
+        a = dx * dx + dy * dy
+        b = 2 * (fx * dx + fy * dy)
+        c = fx * fx + fy * fy - r2
+        disc = b * b - 4 * a * c
+        if a == 0 or disc <= 0:
+            t0 = t1 = None
+            if a == 0 and c <= 0:  # Zero-length segment inside the circle
+                t0, t1 = 0.0, 1.0
+        else:
+            root = math.sqrt(disc)
+            t0 = (-b - root) / (2 * a)
+            t1 = (-b + root) / (2 * a)
+            if t1 <= 0 or t0 >= 1:
+                t0 = t1 = None
+        if t0 is None:  # Segment entirely outside the circle
+            if not current:
+                current = [ax, ay]
+            current += [bx, by]
+            continue
+        touched = True
+        if t0 > 0:
+            if not current:
+                current = [ax, ay]
+            current += [round(ax + t0 * dx), round(ay + t0 * dy)]
+        if current:
+            pieces.append(current)
+        current = []
+        if t1 < 1:
+            current = [round(ax + t1 * dx), round(ay + t1 * dy), bx, by]
+    if current:
+        pieces.append(current)
+    if not touched:
+        return None
+    return [piece for piece in pieces if len(piece) >= 4]
+
+
+def simplify_polyline(points, tolerance):
+    """Ramer-Douglas-Peucker simplification of a flat int16 polyline, return the flat array of the points kept.\n
+    Every dropped point is within tolerance pixels of the simplified polyline. The polyline is first cut
+    every SIMPLIFY_CHUNK points, then the segments are split level by level. The segments still to check
+    are kept as (left, right) indices of their end points, whose inside points are all unchecked, so each
+    level is one vectorized pass over those points, per segment values being spread with np.repeat.
+    """
+    coords = np.frombuffer(points, dtype=np.int16).reshape(-1, 2)
+    count = len(coords)
+    if count < 3 or tolerance <= 0:
+        return array("h", points)
+    xs = coords[:, 0].astype(np.float64)
+    ys = coords[:, 1].astype(np.float64)
+    keep = np.zeros(count, dtype=bool)
+    keep[::SIMPLIFY_CHUNK] = True
+    keep[-1] = True
+    left = np.arange(0, count - 1, SIMPLIFY_CHUNK)
+    right = np.minimum(left + SIMPLIFY_CHUNK, count - 1)
+    tolerance2 = tolerance * tolerance
+    while True:
+        counts = right - left - 1
+        left = left[counts > 0]
+        right = right[counts > 0]
+        counts = counts[counts > 0]
+        if not len(counts):
+            break
+        ends = np.cumsum(counts)
+        total = int(ends[-1])
+        starts = ends - counts
+        inside = np.arange(total) + np.repeat(left + 1 - starts, counts)
+        lx = xs[left]
+        ly = ys[left]
+        abx = xs[right] - lx
+        aby = ys[right] - ly
+        apx = xs[inside] - np.repeat(lx, counts)
+        apy = ys[inside] - np.repeat(ly, counts)
+        # Within a segment the distance to the chord is |cross| / length, so cross**2 ranks the points.
+        # A closed segment (zero length) ranks them by their distance to its end points instead.
+        score = np.repeat(abx, counts) * apy - np.repeat(aby, counts) * apx
+        score *= score
+        limit = abx * abx + aby * aby
+        closed = limit == 0
+        limit *= tolerance2
+        if closed.any():
+            ring = np.repeat(closed, counts)
+            score[ring] = apx[ring] ** 2 + apy[ring] ** 2
+            limit[closed] = tolerance2
+        farthest = np.maximum.reduceat(score, starts)
+        far = farthest > limit
+        # One split per segment: the first of its farthest points.
+        first = np.minimum.reduceat(
+            np.where(score == np.repeat(farthest, counts), np.arange(total), total),
+            starts,
+        )
+        middle = inside[first[far]]
+        keep[middle] = True
+        left = np.column_stack((left[far], middle)).ravel()
+        right = np.column_stack((middle, right[far])).ravel()
+    simplified = array("h")
+    simplified.frombytes(coords[keep].tobytes())
+    return simplified
+
+
+def decimate_polyline(points, cell):
+    """Level-of-detail geometry of a flat int16 polyline: keep one point per cell x cell square it enters.\n
+    Return the flat int16 array of the points kept, which always include the first and last ones.
+    """
+    coords = np.frombuffer(points, dtype=np.int16).reshape(-1, 2)
+    if len(coords) < 3 or cell <= 1:
+        return array("h", points)
+    cells = np.floor_divide(coords, cell)
+    keep = np.ones(len(coords), dtype=bool)
+    keep[1:-1] = (cells[1:-1] != cells[:-2]).any(axis=1)
+    decimated = array("h")
+    decimated.frombytes(coords[keep].tobytes())
+    return decimated
+
+
+def catmull_rom(points, spacing=CURVE_SPACING):
+    """Sample the Catmull-Rom spline through the points of a flat int16 array about every spacing pixels.\n
+    Return the flat int16 array of the samples, which starts and ends at the first and last points.
+    """
+    control = np.frombuffer(points, dtype=np.int16).reshape(-1, 2).astype(np.float64)
+    if len(control) < 3:
+        return array("h", points)
+    padded = np.concatenate(
+        (2 * control[:1] - control[1:2], control, 2 * control[-1:] - control[-2:-1])
+    )
+    p0, p1, p2, p3 = padded[:-3], padded[1:-2], padded[2:-1], padded[3:]
+    lengths = np.hypot(*(p2 - p1).T)
+    steps = np.maximum(np.ceil(lengths / spacing), 1).astype(np.intp)
+    segment = np.repeat(np.arange(len(steps)), steps)
+    first = np.repeat(np.cumsum(steps) - steps, steps)  # First sample of every segment
+    t = ((np.arange(steps.sum()) - first) / steps[segment])[:, None]
+    a, b, c, d = p0[segment], p1[segment], p2[segment], p3[segment]
+    curve = 0.5 * (
+        2 * b
+        + (c - a) * t
+        + (2 * a - 5 * b + 4 * c - d) * t**2
+        + (3 * b - a - 3 * c + d) * t**3
+    )
+    curve = np.concatenate((curve, control[-1:]))
+    samples = array("h")
+    samples.frombytes(np.clip(np.rint(curve), -32768, 32767).astype(np.int16).tobytes())
+    return samples
+
+
+def stamp_centres(points, spacing, offset=0.0):
+    """Place stamps every spacing pixels along a flat polyline, the first one offset pixels from its start.\n
+    Return the (n, 2) int array of the stamp centres and the offset of the next stamp after the polyline end,
+    so the stamps of a growing stroke can be placed segment by segment.
+    """
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    along = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T))))
+    total = along[-1]
+    positions = np.arange(offset, total + 1e-9, spacing)
+    centres = np.column_stack(
+        (
+            np.interp(positions, along, coords[:, 0]),
+            np.interp(positions, along, coords[:, 1]),
+        )
+    )
+    after = positions[-1] + spacing - total if len(positions) else offset - total
+    return np.rint(centres).astype(np.intp), after
+
+
+def stamp_primitive(pen_type, x, y, size, color):
+    """Return the primitive of one "round", "square", "arrow" or "diamond" pen stamp centred on (x, y)."""
+    options = {"fill": color, "outline": color}
+    if pen_type == "round":
+        return "oval", (x - size, y - size, x + size, y + size), options
+    if pen_type == "square":
+        return "rectangle", (x - size, y - size, x + size, y + size), options
+    if pen_type == "arrow":
+        return (
+            "polygon",
+            (x - size, y - size, x - size, y + size, x, y + size),
+            options,
+        )
+    return (
+        "polygon",
+        (x - size, y, x, y - size, x + size, y, x, y + size),
+        options,
+    )
+
+
+class Stroke:
+    """A freehand stroke drawn with the pen tool.\n
+    The points are the path of the pen. A "line" stroke is drawn as a polyline along it, the other pen
+    types stamp their shape every spacing pixels along it, however fast the pen moved.
+    """
+
+    __slots__ = (
+        "id",
+        "z",
+        "layer",
+        "color",
+        "size",
+        "pen_type",
+        "_points",
+        "source",
+        "curve",
+    )
+
+    def __init__(self, color, size, pen_type="line", points=(), curve=False):
+        self.id = None
+        self.z = None
+        self.layer = None  # Id of the layer holding the stroke
+        self.color = color
+        self.size = size
+        self.pen_type = pen_type
+        self._points = array("h", points)  # Flat x0, y0, x1, y1, ...
+        self.source = (
+            None  # (flags, count, bbox, encoded bytes) of a stroke not decoded yet
+        )
+        self.curve = curve  # The points are the control points of a Catmull-Rom spline
+
+    @classmethod
+    def lazy(cls, color, size, pen_type, flags, count, bbox, data):
+        """Return a stroke whose points are only decoded from data when first used."""
+        stroke = cls(color, size, pen_type, curve=bool(flags & 2))
+        stroke._points = None
+        stroke.source = (flags, count, bbox, data)
+        return stroke
+
+    @property
+    def points(self):
+        """The flat int16 array of the stroke points, decoded on first use for a loaded stroke.\n
+        An export thread may decode them too: the points are set before the source is dropped, so
+        whoever finds the source gone finds the points.
+        """
+        if self._points is None:
+            source = self.source
+            if source is not None:
+                flags, count, bbox, data = source
+                self._points = decode_points(data, flags, count)
+                self.source = None
+        return self._points
+
+    def append(self, x, y):
+        """Add a point at the end of the stroke."""
+        self.points.append(x)
+        self.points.append(y)
+
+    def path(self):
+        """Return the flat array of the polyline actually drawn: the points, or the spline sampled through them."""
+        if self.curve:
+            return catmull_rom(self.points)
+        return self.points
+
+    @property
+    def spacing(self):
+        """Distance in pixels between two stamps of the stroke."""
+        return max(1.0, self.size * STAMP_SPACING)
+
+    def stamps(self):
+        """Return the (n, 2) int array of the stamp centres, the end of the path always getting one."""
+        centres, after = stamp_centres(self.points, self.spacing)
+        if after < self.spacing:  # The last stamp is not on the end point
+            centres = np.concatenate((centres, [self.points[-2:]]))
+        return centres
+
+    def simplify(self, tolerance, curve=False):
+        """Drop the points of a finished stroke that are within tolerance pixels of the simplified path.
+
+        Args:
+            tolerance (float): max distance in pixels of a dropped point.
+            curve (bool, optional): draw a line stroke as a spline through the points kept. Defaults to False.
+        """
+        self._points = simplify_polyline(self.points, tolerance)
+        self.curve = curve and self.pen_type == "line" and len(self._points) > 4
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the stroke."""
+        source = self.source
+        if source is not None:
+            return 64 + 4 * source[1]
+        return 64 + self._points.itemsize * len(self._points)
+
+    def bbox(self):
+        """Return the (x0, y0, x1, y1) box covered by the stroke, including its width."""
+        source = self.source
+        if source is not None:
+            return source[2]
+        path = self.path()
+        xs = path[0::2]
+        ys = path[1::2]
+        pad = self.size
+        return min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad
+
+    def boxes(self, first=0):
+        """Yield the box of every segment of the path from the point number first, for the spatial index.\n
+        A stroke that was not decoded yet is indexed by its whole box.
+        """
+        source = self.source
+        if source is not None:
+            yield source[2]
+            return
+        points = self.path()
+        pad = self.size
+        count = len(points) // 2
+        if count > 1:
+            for i in range(max(first, 1), count):
+                x0, y0, x1, y1 = points[2 * i - 2 : 2 * i + 2]
+                yield (
+                    min(x0, x1) - pad,
+                    min(y0, y1) - pad,
+                    max(x0, x1) + pad,
+                    max(y0, y1) + pad,
+                )
+        else:
+            for i in range(first, count):
+                x, y = points[2 * i], points[2 * i + 1]
+                yield x - pad, y - pad, x + pad, y + pad
+
+    def erase(self, x, y, radius):
+        """Erase a disk of the stroke.\n
+        Return None when the stroke is not touched, else the strokes left (possibly none).
+        """
+        reach = self.size / 2 if self.pen_type == "line" else self.size
+        pieces = clip_polyline(self.path(), x, y, radius + reach)
+        if pieces is None:
+            return None
+        return [Stroke(self.color, self.size, self.pen_type, piece) for piece in pieces]
+
+    def primitives(self):
+        """Yield the canvas primitives that draw the stroke."""
+        if self.pen_type == "line":
+            path = self.path()
+            if len(path) >= 4:
+                yield "line", path, {
+                    "fill": self.color,
+                    "width": self.size,
+                    "capstyle": "round",
+                    "joinstyle": "round",
+                }
+        else:
+            for x, y in self.stamps().tolist():
+                yield stamp_primitive(self.pen_type, x, y, self.size, self.color)
+
+
+class Shape:
+    """A rectangle, oval or straight line drawn with the Shapes tools."""
+
+    __slots__ = ("id", "z", "layer", "kind", "coords", "outline", "fill", "width")
+
+    def __init__(self, kind, coords, outline, fill="", width=1):
+        self.id = None
+        self.z = None
+        self.layer = None
+        self.kind = kind  # "rectangle", "oval" or "line"
+        self.coords = array("h", coords)  # x0, y0, x1, y1
+        self.outline = outline
+        self.fill = fill
+        self.width = width
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the shape."""
+        return 64 + self.coords.itemsize * len(self.coords)
+
+    def bbox(self):
+        """Return the (x0, y0, x1, y1) box covered by the shape, including its outline."""
+        x0, y0, x1, y1 = self.coords
+        pad = self.width
+        return (
+            min(x0, x1) - pad,
+            min(y0, y1) - pad,
+            max(x0, x1) + pad,
+            max(y0, y1) + pad,
+        )
+
+    def boxes(self, first=0):
+        """Yield the box of the shape, for the spatial index."""
+        yield self.bbox()
+
+    def erase(self, x, y, radius):
+        """Return [] when the eraser disk touches the shape (it is deleted whole), else None."""
+        x0, y0, x1, y1 = self.coords
+        reach = radius + self.width / 2
+        if self.kind == "line":
+            dx, dy = x1 - x0, y1 - y0
+            length = dx * dx + dy * dy
+            t = 0 if length == 0 else ((x - x0) * dx + (y - y0) * dy) / length
+            t = min(max(t, 0), 1)
+            touched = math.hypot(x - x0 - t * dx, y - y0 - t * dy) <= reach
+        elif self.kind == "rectangle":
+            left, right = min(x0, x1), max(x0, x1)
+            top, bottom = min(y0, y1), max(y0, y1)
+            outside = max(left - x, x - right, top - y, y - bottom)
+            touched = outside <= reach and (self.fill or outside >= -reach)
+        else:
+            rx, ry = abs(x1 - x0) / 2, abs(y1 - y0) / 2
+            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+            # Distance to the oval, approximated along the ray from its centre.
+            distance = math.hypot(x - cx, y - cy)
+            if distance == 0:
+                edge = min(rx, ry)
+            else:
+                angle = math.atan2((y - cy) * rx, (x - cx) * ry)
+                edge = math.hypot(rx * math.cos(angle), ry * math.sin(angle))
+            outside = distance - edge
+            touched = outside <= reach and (self.fill or outside >= -reach)
+        return [] if touched else None
+
+    def primitives(self):
+        """Yield the canvas primitive that draws the shape."""
+        if self.kind == "line":
+            yield "line", self.coords, {"fill": self.outline, "width": self.width}
+        else:
+            yield self.kind, self.coords, {
+                "outline": self.outline,
+                "fill": self.fill,
+                "width": self.width,
+            }
+
+
+class Text:
+    """A text placed with the Text tool."""
+
+    __slots__ = ("id", "z", "layer", "x", "y", "text", "color", "font")
+
+    def __init__(self, x, y, text, color, font):
+        self.id = None
+        self.z = None
+        self.layer = None
+        self.x = x
+        self.y = y
+        self.text = text
+        self.color = color
+        self.font = tuple(font)  # (family, size, style)
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the text."""
+        return 96 + len(self.text)
+
+    def bbox(self):
+        """Return an estimated (x0, y0, x1, y1) box of the text, anchored on its west side."""
+        size = abs(self.font[1]) * 96 // 72
+        return self.x, self.y - size, self.x + size * len(self.text), self.y + size
+
+    def boxes(self, first=0):
+        """Yield the box of the text, for the spatial index."""
+        yield self.bbox()
+
+    def erase(self, x, y, radius):
+        """Return [] when the eraser disk touches the text (it is deleted whole), else None."""
+        x0, y0, x1, y1 = self.bbox()
+        touched = x0 - radius <= x <= x1 + radius and y0 - radius <= y <= y1 + radius
+        return [] if touched else None
+
+    def primitives(self):
+        """Yield the canvas primitive that draws the text."""
+        yield "text", (self.x, self.y), {
+            "anchor": "w",
+            "fill": self.color,
+            "text": self.text,
+            "font": self.font,
+        }
+
+
+def flood_fill(image, x, y, tolerance=FILL_TOLERANCE):
+    """Find the region of an RGB image reached from (x, y) through pixels of about the same colour.\n
+    The region is first looked for in a window of FILL_PROBE pixels around (x, y), and in the whole
+    image only when it reaches the border of that window, so a small region costs no more than the
+    window. Return (x0, y0, mask), the mask being a uint8 array of the box of the region, 255 where
+    filled, or None when (x, y) is outside of the image.
+    """
+    width, height = image.size
+    if not (0 <= x < width and 0 <= y < height):
+        return None
+    table = []
+    for value in image.getpixel((x, y))[:3]:
+        table += [255 if abs(level - value) <= tolerance else 0 for level in range(256)]
+    left, top = max(x - FILL_PROBE, 0), max(y - FILL_PROBE, 0)
+    right, bottom = min(x + FILL_PROBE, width), min(y + FILL_PROBE, height)
+    if (right - left) * (bottom - top) < width * height:
+        x0, y0, mask = flood_fill_window(
+            image.crop((left, top, right, bottom)), x - left, y - top, table
+        )
+        x1, y1 = x0 + mask.shape[1], y0 + mask.shape[0]
+        if (
+            (x0 > 0 or left == 0)
+            and (y0 > 0 or top == 0)
+            and (x1 < right - left or right == width)
+            and (y1 < bottom - top or bottom == height)
+        ):
+            return x0 + left, y0 + top, mask
+    return flood_fill_window(image, x, y, table)
+
+
+def flood_fill_window(image, x, y, table):
+    """Flood fill an RGB image from (x, y) through the pixels that table maps to 255 on every channel.\n
+    The matching pixels are found in one pass of lookup tables, then cut into runs along the rows. Two
+    runs of neighbouring rows are linked when they overlap, and the linked runs are joined by a
+    vectorized union-find: each round hooks the larger root of every link to the smaller one, then
+    jumps every run to its root. Return (x0, y0, mask) as flood_fill does.
+    """
+    width, height = image.size
+    matching = np.zeros((height, width + 2), bool)  # Padded by a column on each side
+    # Once converted to grey, only the pixels matching on the three channels are 255.
+    np.equal(np.asarray(image.point(table).convert("L")), 255, out=matching[:, 1:-1])
+    # Run starts and ends (the column after the run) alternate, row after row, as the keys
+    # row * stride + column.
+    stride = width + 1
+    changes = np.flatnonzero(matching[:, 1:] != matching[:, :-1])
+    starts = changes[0::2]
+    ends = changes[1::2]
+    # The runs of the next row overlapping a run end after its start and start before its end.
+    low = np.searchsorted(ends, starts + stride, side="right")
+    high = np.searchsorted(starts, ends + stride, side="left")
+    counts = np.maximum(high - low, 0)
+    upper = np.repeat(np.arange(len(starts)), counts)
+    lower = np.arange(len(upper)) + np.repeat(
+        low - (np.cumsum(counts) - counts), counts
+    )
+    parent = np.arange(len(starts))
+    while True:
+        a = parent[upper]
+        b = parent[lower]
+        linked = a != b
+        if not linked.any():
+            break
+        upper = upper[linked]
+        lower = lower[linked]
+        parent[np.maximum(a[linked], b[linked])] = np.minimum(a[linked], b[linked])
+        while True:
+            jumped = parent[parent]
+            if (jumped == parent).all():
+                break
+            parent = jumped
+    seed = np.searchsorted(ends, y * stride + x, side="right")
+    chosen = parent == parent[seed]
+    starts = starts[chosen]
+    ends = ends[chosen]
+    rows = starts // stride
+    starts -= rows * stride
+    ends -= rows * stride
+    x0, y0 = int(starts.min()), int(rows.min())
+    # Each row of the mask toggles on at the start of a run and off at its end.
+    toggles = np.zeros((int(rows.max()) + 1 - y0, int(ends.max()) + 1 - x0), bool)
+    toggles[rows - y0, starts - x0] = True
+    toggles[rows - y0, ends - x0] = True
+    filled = np.logical_xor.accumulate(toggles, axis=1)[:, :-1]
+    return x0, y0, filled.view(np.uint8) * np.uint8(255)
+
+
+class Fill:
+    """A region filled with the Bucket tool, kept as a mask of its pixels and one colour."""
+
+    __slots__ = ("id", "z", "layer", "x", "y", "mask", "color")
+
+    def __init__(self, x, y, mask, color):
+        self.id = None
+        self.z = None
+        self.layer = None
+        self.x = x  # Top left corner of the mask
+        self.y = y
+        self.mask = mask  # PIL "L" image, 255 where filled
+        self.color = color
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the fill."""
+        return 64 + self.mask.width * self.mask.height
+
+    def bbox(self):
+        """Return the (x0, y0, x1, y1) box of the mask."""
+        return self.x, self.y, self.x + self.mask.width, self.y + self.mask.height
+
+    def boxes(self, first=0):
+        """Yield the box of the fill, for the spatial index."""
+        yield self.bbox()
+
+    def erase(self, x, y, radius):
+        """Return [] when the eraser disk touches a filled pixel (the fill is deleted whole), else None."""
+        left = math.floor(x - radius)
+        top = math.floor(y - radius)
+        window = np.asarray(
+            self.mask.crop(
+                (
+                    left - self.x,
+                    top - self.y,
+                    math.ceil(x + radius) + 1 - self.x,
+                    math.ceil(y + radius) + 1 - self.y,
+                )
+            )
+        )
+        rows, columns = np.nonzero(window)
+        distances = (columns + left - x) ** 2 + (rows + top - y) ** 2
+        return [] if (distances <= radius * radius).any() else None
+
+    def primitives(self):
+        """Yield the primitive that paints the colour through the mask."""
+        yield "bitmap", (self.x, self.y), {
+            "bitmap": self.mask,
+            "foreground": self.color,
+            "anchor": "nw",
+        }
+
+
+def fill_box(document, x, y, size):
+    """Return the (x0, y0, x1, y1) box of the page a bucket fill at (x, y) looks in: the whole page along
+    its sides up to size pixels long, else size pixels around (x, y), moved to stay within the page.
+    """
+
+    def span(center, length):
+        if length <= size:
+            return 0, length
+        start = min(max(center - size // 2, 0), length - size)
+        return start, start + size
+
+    x0, x1 = span(x, document.width)
+    y0, y1 = span(y, document.height)
+    return x0, y0, x1, y1
+
+
+def fill_for(document, x, y, color, tolerance=FILL_TOLERANCE, cache=None):
+    """Return the Fill the bucket tool makes when clicked at (x, y), found on the rendered visible layers.\n
+    Only the fill_box() of FILL_WINDOW pixels is rendered, by cache (a RenderCache) when given, and the
+    box doubles for as long as the region reaches one of its sides inside the page, so the whole region
+    is filled however large. Return None outside of the page, or when the clicked pixel already has
+    the colour.
+    """
+    x, y = math.floor(x), math.floor(y)
+    if not (0 <= x < document.width and 0 <= y < document.height):
+        return None
+    size = FILL_WINDOW
+    while True:
+        x0, y0, x1, y1 = box = fill_box(document, x, y, size)
+        if cache is not None and size == FILL_WINDOW:
+            image = cache.render(document, box)
+        else:
+            image = render_document(document, box=box)
+        if image.getpixel((x - x0, y - y0)) == ImageColor.getrgb(color):
+            return None
+        left, top, mask = flood_fill(image, x - x0, y - y0, tolerance)
+        right, bottom = x0 + left + mask.shape[1], y0 + top + mask.shape[0]
+        if (
+            (left > 0 or x0 == 0)
+            and (top > 0 or y0 == 0)
+            and (right < x1 or x1 == document.width)
+            and (bottom < y1 or y1 == document.height)
+        ):
+            return Fill(x0 + left, y0 + top, Image.fromarray(mask, "L"), color)
+        size *= 2
+
+
+class Picture:
+    """A photo imported with File > Import, kept as its encoded file and drawn from a pyramid of mip levels.\n
+    Level n is the photo scaled down by 2**n, the coarsest one fitting in PICTURE_TOP_SIZE. The levels are
+    built by build(), usually on a background thread: a JPEG first gets a coarse level from a fast draft
+    decode, then every level is made from the full photo by halving the previous one.
+    """
+
+    __slots__ = (
+        "id",
+        "z",
+        "layer",
+        "x",
+        "y",
+        "width",
+        "height",
+        "data",
+        "levels",
+        "lock",
+    )
+
+    def __init__(self, x, y, data):
+        self.id = None
+        self.z = None
+        self.layer = None
+        self.x = x  # Top left corner
+        self.y = y
+        self.data = data  # Bytes of the JPG or PNG file
+        with Image.open(io.BytesIO(data)) as image:
+            self.width, self.height = image.size
+            if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # Rotated a quarter turn
+                self.width, self.height = self.height, self.width
+        self.levels = {}  # level -> RGB image, replaced whole, never changed in place
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self):
+        """True once every mip level is built."""
+        return 0 in self.levels
+
+    def build(self):
+        """Build the mip levels, unless done already. A caller finding another thread building them waits."""
+        with self.lock:
+            if self.complete:
+                return
+            with Image.open(io.BytesIO(self.data)) as image:
+                if image.format == "JPEG":
+                    image.draft("RGB", (self.width // 8, self.height // 8))
+                    draft = ImageOps.exif_transpose(image.convert("RGB"))
+                    # Published as a new dict, as level() reads the levels without the lock.
+                    self.levels = {round(math.log2(self.width / draft.width)): draft}
+            with Image.open(io.BytesIO(self.data)) as image:
+                current = ImageOps.exif_transpose(image.convert("RGB"))
+            levels = {0: current}
+            while max(current.size) > PICTURE_TOP_SIZE:
+                current = current.reduce(2)
+                levels[len(levels)] = current
+            self.levels = levels
+
+    def start(self):
+        """Build the mip levels on a background thread."""
+        threading.Thread(target=self.build, name="mipmaps", daemon=True).start()
+
+    def level(self, scale, wait=False):
+        """Return the mip level to draw the picture from at a scale: the coarsest one at least as fine, or
+        the finest one built so far. Return None when none is built yet, unless wait is True.
+        """
+        if wait:
+            self.build()
+        levels = self.levels
+        if not levels:
+            return None
+        wanted = max(0, math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        finer = [level for level in levels if level <= wanted]
+        return levels[max(finer) if finer else min(levels)]
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the picture file; the mip levels are a cache built again on demand."""
+        return 64 + len(self.data)
+
+    def bbox(self):
+        """Return the (x0, y0, x1, y1) box of the picture."""
+        return self.x, self.y, self.x + self.width, self.y + self.height
+
+    def boxes(self, first=0):
+        """Yield the box of the picture, for the spatial index."""
+        yield self.bbox()
+
+    def erase(self, x, y, radius):
+        """Return None: the eraser never erases a picture, deleting its layer does."""
+        return None
+
+    def primitives(self):
+        """Yield the primitive that draws the picture."""
+        yield "image", (self.x, self.y), {"picture": self, "anchor": "nw"}
+
+
+# Shape tools of the toolbar -> (element kind, filled, coords starting at the release point)
+SHAPE_TOOLS = {
+    "rectangle": ("rectangle", False, False),
+    "frectangle": ("rectangle", True, False),
+    "circle": ("oval", False, True),
+    "fcircle": ("oval", True, True),
+    "line": ("line", False, True),
+}
+
+
+def shape_for(tool, x0, y0, x1, y1, color, size):
+    """Return the Shape a shape tool draws when dragged from (x0, y0) to (x1, y1)."""
+    kind, filled, reverse = SHAPE_TOOLS[tool]
+    coords = (x1, y1, x0, y0) if reverse else (x0, y0, x1, y1)
+    return Shape(kind, coords, outline=color, fill=color if filled else "", width=size)
+
+
+def eraser_radius(size):
+    """Return the radius of the eraser for a brush size."""
+    return max(size / 2, 3)
+
+
+def parse_size(text):
+    """Parse a "WIDTHxHEIGHT" document size such as "20000x20000", raise ValueError when it is not one."""
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"{text!r} is not a size such as 1920x1080") from None
+    if not (0 < width <= DOCUMENT_MAX_SIZE and 0 < height <= DOCUMENT_MAX_SIZE):
+        raise ValueError(f"Width and height go from 1 to {DOCUMENT_MAX_SIZE} pixels")
+    return width, height
+
+
+class Layer:
+    """A named layer of the drawing, whose elements are stacked above the ones of the layers below it."""
+
+    __slots__ = ("id", "name", "visible", "opacity")
+
+    def __init__(self, layer_id, name, visible=True, opacity=1.0):
+        self.id = layer_id
+        self.name = name
+        self.visible = visible
+        self.opacity = opacity  # 0.0 to 1.0, applied when the layer is composited
+
+
+class Document:
+    """An ordered collection of drawing elements on a stack of layers, bottom to top.\n
+    Elements are stacked by layer first, then by z within their layer.
+    """
+
+    __slots__ = (
+        "width",
+        "height",
+        "background",
+        "elements",
+        "next_id",
+        "ordered",
+        "index",
+        "source",
+        "loaded",
+        "layers",
+        "layer",
+        "next_layer_id",
+        "positions",
+    )
+
+    def __init__(self, width, height, background="#FFFFFF"):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.elements = {}  # element id -> element, in stacking order
+        self.next_id = 1
+        self.ordered = True  # False once restore() put an element back out of order
+        self.layers = [Layer(1, "Background")]  # Bottom to top
+        self.layer = self.layers[0]  # Layer receiving the new elements
+        self.next_layer_id = 2
+        self.positions = {1: 0}  # layer id -> position in the stack of layers
+        self.index = GridIndex(key=self.key)  # Where every element is, for hit-testing
+        self.source = None  # Memory-mapped file the document was loaded from
+        self.loaded = (
+            []
+        )  # Strokes loaded from source, decoded or not, in the document or not
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __iter__(self):
+        if not self.ordered:
+            self.elements = dict(
+                sorted(self.elements.items(), key=lambda item: self.key(item[1]))
+            )
+            self.ordered = True
+        return iter(self.elements.values())
+
+    def key(self, element):
+        """Return the stacking key of an element: the position of its layer, its z and its id."""
+        return self.positions[element.layer], element.z, element.id
+
+    def add(self, element):
+        """Add an element on top of the current layer (or at its z when already set) and return it."""
+        element.id = self.next_id
+        self.next_id += 1
+        if element.layer is None:
+            element.layer = self.layer.id
+        if element.z is None:
+            element.z = element.id
+        self.restore(element)
+        return element
+
+    def extend(self, stroke, x, y):
+        """Append a point to a stroke of the drawing, indexing only the new segment."""
+        stroke.append(x, y)
+        self.index.insert(stroke, len(stroke.points) // 2 - 1)
+
+    def simplify(self, stroke, tolerance, curve=False):
+        """Simplify a finished stroke of the drawing (see Stroke.simplify) and index it again."""
+        self.index.remove(stroke)
+        stroke.simplify(tolerance, curve)
+        self.index.insert(stroke)
+
+    def remove(self, element):
+        """Remove an element from the drawing."""
+        del self.elements[element.id]
+        self.index.remove(element)
+
+    def restore(self, element):
+        """Put a removed element back at its original stacking position.\n
+        The elements are only re-sorted when the drawing is next iterated, so this stays O(1).
+        """
+        if self.elements:
+            last = self.elements[next(reversed(self.elements))]
+            if self.key(element) < self.key(last):
+                self.ordered = False
+        self.elements[element.id] = element
+        self.index.insert(element)
+
+    def clear(self):
+        """Remove every element and return them, bottom to top."""
+        removed = list(self.elements.values())
+        self.elements.clear()
+        self.index.clear()
+        return removed
+
+    def restack(self):
+        """Number the layers again after they changed, the elements being re-sorted when next iterated."""
+        self.positions = {
+            layer.id: position for position, layer in enumerate(self.layers)
+        }
+        self.ordered = False
+
+    def add_layer(self, name=None):
+        """Add an empty layer just above the current one, make it the current layer and return it."""
+        layer = Layer(self.next_layer_id, name or f"Layer {self.next_layer_id}")
+        self.insert_layer(self.positions[self.layer.id] + 1, layer)
+        self.layer = layer
+        return layer
+
+    def insert_layer(self, position, layer):
+        """Put a layer in the stack at a position, as when a deleted layer is restored."""
+        self.layers.insert(position, layer)
+        self.next_layer_id = max(self.next_layer_id, layer.id + 1)
+        self.restack()
+
+    def remove_layer(self, layer):
+        """Take a layer out of the stack and return its position, its elements must be removed first.\n
+        The layer below it (or above it, for the bottom layer) becomes the current one.
+        """
+        position = self.positions[layer.id]
+        del self.layers[position]
+        if self.layer is layer:
+            self.layer = self.layers[max(position - 1, 0)]
+        self.restack()
+        return position
+
+    def move_layer(self, layer, position):
+        """Move a layer to another position in the stack."""
+        self.layers.remove(layer)
+        self.layers.insert(position, layer)
+        self.restack()
+
+    def snapshot(self):
+        """Return a copy of the drawing sharing its elements, to be read by another thread while this
+        one keeps editing. The copy has its own layers and element order but no spatial index.
+        """
+        copy = Document(self.width, self.height, self.background)
+        copy.layers = [
+            Layer(layer.id, layer.name, layer.visible, layer.opacity)
+            for layer in self.layers
+        ]
+        copy.layer = copy.layers[self.positions[self.layer.id]]
+        copy.positions = dict(self.positions)
+        copy.next_layer_id = self.next_layer_id
+        copy.next_id = self.next_id
+        copy.elements = {element.id: element for element in self}
+        return copy
+
+    def layer_elements(self, layer):
+        """Return the elements of a layer, bottom to top."""
+        return [element for element in self if element.layer == layer.id]
+
+    def bbox(self):
+        """Return the (x0, y0, x1, y1) box covered by all the elements, or None for an empty drawing."""
+        boxes = self.index.bboxes.values()
+        if not boxes:
+            return None
+        return (
+            min(box[0] for box in boxes),
+            min(box[1] for box in boxes),
+            max(box[2] for box in boxes),
+            max(box[3] for box in boxes),
+        )
+
+    def materialize(self):
+        """Decode every lazily loaded stroke and release the file it was loaded from.\n
+        The strokes removed since loading are decoded too, as the undo history may still hold them.
+        """
+        if self.source is None:
+            return
+        for stroke in self.loaded:
+            stroke.points
+        self.loaded = []
+        self.source.close()
+        self.source = None
+
+    def find_at(self, x, y, radius=0):
+        """Return the elements near a point, bottom to top."""
+        return self.index.query_point(x, y, radius)
+
+    def find_in(self, x0, y0, x1, y1):
+        """Return the elements overlapping a rectangle, bottom to top."""
+        return self.index.query_rect(x0, y0, x1, y1)
+
+    def erase(self, x, y, radius):
+        """Erase a disk of the current layer: touched shapes and texts are removed, touched strokes are clipped.\n
+        Return the list of (removed element, pieces left) pairs, the pieces keeping the stacking position of the element.
+        """
+        changes = []
+        for element in self.find_at(x, y, radius):
+            if element.layer != self.layer.id:
+                continue
+            pieces = element.erase(x, y, radius)
+            if pieces is None:
+                continue
+            self.remove(element)
+            for piece in pieces:
+                piece.z = element.z
+                piece.layer = element.layer
+                self.add(piece)
+            changes.append((element, pieces))
+        return changes
+
+    def erase_along(self, x0, y0, x1, y1, radius):
+        """Erase along a path from (x0, y0) to (x1, y1) and return the changes in order, as erase() does.\n
+        The path is sampled every half radius so fast moves leave nothing behind.
+        """
+        changes = []
+        steps = max(1, math.ceil(math.hypot(x1 - x0, y1 - y0) / (radius / 2)))
+        for step in range(1, steps + 1):
+            x = x0 + (x1 - x0) * step / steps
+            y = y0 + (y1 - y0) * step / steps
+            changes += self.erase(x, y, radius)
+        return changes
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by all the elements."""
+        return sum(element.nbytes for element in self)
+
+    def primitives(self, layer=None):
+        """Yield the canvas primitives of the elements of one layer, or of every visible layer, bottom to top."""
+        if layer is None:
+            visible = {layer.id for layer in self.layers if layer.visible}
+        else:
+            visible = {layer.id}
+        for element in self:
+            if element.layer in visible:
+                yield from element.primitives()
+
+
+########### Native .paint documents ###########
+# A .paint file is PAINT_MAGIC, a little-endian uint16 format version, then chunks made of a
+# 4-byte tag, a uint32 payload length and the payload. Readers skip the chunks they do not know.
+#   DOCU  width, height (uint32) and background colour
+#   STYL  uint16 index and colour string, defined before the elements using it
+#   STRK  colour index, size, pen type, flags, point count, bbox, then the points as int16
+#         (x, y) deltas from the previous point, zlib-compressed when flags & 1; flags & 2 marks
+#         the control points of a Catmull-Rom spline
+#   SHAP  outline and fill colour indexes, width, kind, then the x0, y0, x1, y1 int16 coords
+#   TEXT  x, y, colour index, font size, then font family, font style and text strings
+#   FILL  colour index, x, y (int16), width, height (uint16), then the mask as zlib-compressed
+#         bits, a row after the other
+#   PICT  x, y (int16), then the JPG or PNG file of an imported picture
+#   LAYR  uint32 id, flags (1 visible, 2 current layer), uint8 opacity and name string of a layer;
+#         the layers are written bottom to top, each followed by its elements
+#   END   end of the document
+PAINT_MAGIC = b"\x89PAINT\r\n"
+PAINT_FORMAT_VERSION = 1
+PEN_TYPES = ("line", "round", "square", "arrow", "diamond")
+SHAPE_KINDS = ("rectangle", "oval", "line")
+NO_COLOR = 0xFFFF  # Colour index of an empty ("") colour
+COMPRESS_MIN_POINTS = 64  # Shorter strokes are stored uncompressed
+CHUNK_HEADER = struct.Struct("<4sI")
+STROKE_HEADER = struct.Struct("<HHBBI4h")
+SHAPE_RECORD = struct.Struct("<HHHB4h")
+TEXT_HEADER = struct.Struct("<hhHh")
+FILL_HEADER = struct.Struct("<HhhHH")
+PICTURE_HEADER = struct.Struct("<hh")
+LAYER_HEADER = struct.Struct("<IBB")
+
+
+class PaintFormatError(ValueError):
+    """Raised when a file is not a valid .paint document."""
+
+
+def encode_points(points):
+    """Delta-encode a flat int16 point array, return (flags, bytes)."""
+    coords = np.frombuffer(points, dtype=np.int16).reshape(-1, 2)
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), np.int16))
+    data = deltas.astype("<i2").tobytes()
+    if len(coords) >= COMPRESS_MIN_POINTS:
+        return 1, zlib.compress(data, 1)
+    return 0, data
+
+
+def decode_points(data, flags, count):
+    """Decode the int16 point array written by encode_points."""
+    if flags & 1:
+        data = zlib.decompress(data)
+    deltas = np.frombuffer(data, dtype="<i2", count=2 * count).reshape(-1, 2)
+    points = array("h")
+    points.frombytes(np.cumsum(deltas, axis=0, dtype=np.int16).tobytes())
+    return points
+
+
+def pack_string(text):
+    """Encode a string as a uint16 length followed by UTF-8 bytes."""
+    data = text.encode("utf-8")
+    return struct.pack("<H", len(data)) + data
+
+
+def unpack_string(buffer, offset):
+    """Decode a string written by pack_string, return (text, next offset)."""
+    (length,) = struct.unpack_from("<H", buffer, offset)
+    start = offset + 2
+    return bytes(buffer[start : start + length]).decode("utf-8"), start + length
+
+
+def encode_chunk(tag, payload):
+    """Return a whole chunk: header then payload."""
+    return CHUNK_HEADER.pack(tag, len(payload)) + payload
+
+
+def encode_layer(layer, current=False):
+    """Return the LAYR chunk of a layer."""
+    flags = (1 if layer.visible else 0) | (2 if current else 0)
+    header = LAYER_HEADER.pack(layer.id, flags, round(layer.opacity * 255))
+    return encode_chunk(b"LAYR", header + pack_string(layer.name))
+
+
+def decode_layer(payload):
+    """Build the layer of a LAYR chunk, return (layer, True when it is the current layer)."""
+    layer_id, flags, opacity = LAYER_HEADER.unpack_from(payload)
+    name = unpack_string(payload, LAYER_HEADER.size)[0]
+    return Layer(layer_id, name, bool(flags & 1), opacity / 255), bool(flags & 2)
+
+
+def encode_element(element, styles):
+    """Yield the chunks of one element, preceded by the STYL chunks of the colours it introduces.
+
+    Args:
+        element (Stroke | Shape | Text | Fill | Picture): the element to encode.
+        styles (dict): colour -> index of the colours already written, updated in place.
+    """
+
+    def color_index(color):
+        if not color:
+            return NO_COLOR
+        if color not in styles:
+            styles[color] = len(styles)
+            chunks.append(
+                encode_chunk(
+                    b"STYL", struct.pack("<H", styles[color]) + pack_string(color)
+                )
+            )
+        return styles[color]
+
+    chunks = []
+    if isinstance(element, Stroke):
+        color = color_index(element.color)
+        flags, data = encode_points(element.points)
+        if element.curve:
+            flags |= 2
+        header = STROKE_HEADER.pack(
+            color,
+            element.size,
+            PEN_TYPES.index(element.pen_type),
+            flags,
+            len(element.points) // 2,
+            *(min(max(round(value), -32768), 32767) for value in element.bbox()),
+        )
+        chunks.append(encode_chunk(b"STRK", header + data))
+    elif isinstance(element, Shape):
+        outline = color_index(element.outline)
+        fill = color_index(element.fill)
+        record = SHAPE_RECORD.pack(
+            outline,
+            fill,
+            element.width,
+            SHAPE_KINDS.index(element.kind),
+            *element.coords,
+        )
+        chunks.append(encode_chunk(b"SHAP", record))
+    elif isinstance(element, Fill):
+        color = color_index(element.color)
+        header = FILL_HEADER.pack(
+            color, element.x, element.y, element.mask.width, element.mask.height
+        )
+        bits = np.packbits(np.asarray(element.mask) > 127)
+        chunks.append(encode_chunk(b"FILL", header + zlib.compress(bits.tobytes())))
+    elif isinstance(element, Picture):
+        header = PICTURE_HEADER.pack(element.x, element.y)
+        chunks.append(encode_chunk(b"PICT", header + element.data))
+    else:
+        color = color_index(element.color)
+        family, size, style = element.font
+        payload = (
+            TEXT_HEADER.pack(element.x, element.y, color, size)
+            + pack_string(family)
+            + pack_string(style)
+            + pack_string(element.text)
+        )
+        chunks.append(encode_chunk(b"TEXT", payload))
+    return chunks
+
+
+def save_document(document, path, progress=None):
+    """Stream a document to a .paint file, element by element.\n
+    The file is written next to path and renamed over it once complete. progress, when given, is
+    called with the fraction of the elements written so far; when it raises, the file is left as it was.
+    """
+    document.materialize()
+    temporary = f"{path}.tmp"
+    styles = {}
+    total = len(document)
+    try:
+        with open(temporary, "wb") as file:
+            file.write(PAINT_MAGIC + struct.pack("<H", PAINT_FORMAT_VERSION))
+            file.write(
+                encode_chunk(
+                    b"DOCU",
+                    struct.pack("<II", document.width, document.height)
+                    + pack_string(document.background),
+                )
+            )
+            written = 0  # Layers written, each before its elements
+            for count, element in enumerate(document, 1):
+                while written <= document.positions[element.layer]:
+                    layer = document.layers[written]
+                    file.write(encode_layer(layer, layer is document.layer))
+                    written += 1
+                for chunk in encode_element(element, styles):
+                    file.write(chunk)
+                if progress is not None and count % EXPORT_PROGRESS_STEP == 0:
+                    progress(count / total)
+            for layer in document.layers[written:]:
+                file.write(encode_layer(layer, layer is document.layer))
+            file.write(encode_chunk(b"END ", b""))
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def decode_element(tag, payload, styles):
+    """Build the element of a STRK, SHAP, TEXT, FILL or PICT chunk, or return None for another chunk.\n
+    Stroke points are left encoded until they are first used.
+    """
+
+    def color(index):
+        return "" if index == NO_COLOR else styles[index]
+
+    if tag == b"STRK":
+        color_index, size, pen, flags, count, *bbox = STROKE_HEADER.unpack_from(payload)
+        if not flags & 1 and len(payload) - STROKE_HEADER.size < 4 * count:
+            raise PaintFormatError("a stroke has fewer points than its header tells")
+        return Stroke.lazy(
+            color(color_index),
+            size,
+            PEN_TYPES[pen],
+            flags,
+            count,
+            tuple(bbox),
+            payload[STROKE_HEADER.size :],
+        )
+    if tag == b"SHAP":
+        outline, fill, width, kind, *coords = SHAPE_RECORD.unpack_from(payload)
+        return Shape(SHAPE_KINDS[kind], coords, color(outline), color(fill), width)
+    if tag == b"TEXT":
+        x, y, color_index, size = TEXT_HEADER.unpack_from(payload)
+        family, offset = unpack_string(payload, TEXT_HEADER.size)
+        style, offset = unpack_string(payload, offset)
+        text, offset = unpack_string(payload, offset)
+        return Text(x, y, text, color(color_index), (family, size, style))
+    if tag == b"FILL":
+        color_index, x, y, width, height = FILL_HEADER.unpack_from(payload)
+        bits = np.frombuffer(zlib.decompress(payload[FILL_HEADER.size :]), np.uint8)
+        mask = np.unpackbits(bits, count=width * height).reshape(height, width)
+        return Fill(
+            x, y, Image.fromarray(mask * np.uint8(255), "L"), color(color_index)
+        )
+    if tag == b"PICT":
+        x, y = PICTURE_HEADER.unpack_from(payload)
+        return Picture(x, y, bytes(payload[PICTURE_HEADER.size :]))
+    return None
+
+
+def load_document(path):
+    """Open a .paint file.\n
+    The file is memory-mapped and only the chunk headers are read; stroke points are decoded lazily.
+    A file that is empty, truncated (a chunk running past its end or no END chunk) or has a damaged
+    chunk raises PaintFormatError.
+    """
+    start = len(PAINT_MAGIC) + 2
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < start:  # An empty file cannot be mapped
+            raise PaintFormatError(f"{path} is not a .paint document")
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    if view[: len(PAINT_MAGIC)] != PAINT_MAGIC:
+        raise PaintFormatError(f"{path} is not a .paint document")
+    (version,) = struct.unpack_from("<H", buffer, len(PAINT_MAGIC))
+    if version > PAINT_FORMAT_VERSION:
+        raise PaintFormatError(f"{path} needs a newer version of Paint")
+    document = Document(900, 600)
+    styles = {}
+    layers = []
+    current = None
+    offset = start
+    ended = False
+    while offset + CHUNK_HEADER.size <= len(buffer):
+        tag, length = CHUNK_HEADER.unpack_from(buffer, offset)
+        offset += CHUNK_HEADER.size
+        if offset + length > len(buffer):
+            raise PaintFormatError(f"{path} is truncated")
+        payload = view[offset : offset + length]
+        offset += length
+        if tag == b"END ":
+            ended = True
+            break
+        try:
+            current = read_chunk(document, tag, payload, styles, layers, current)
+        except (
+            struct.error,
+            zlib.error,
+            KeyError,
+            IndexError,
+            UnicodeDecodeError,
+        ) as e:
+            raise PaintFormatError(
+                f"{path} has a damaged {tag.decode('ascii', 'replace')} chunk: {e}"
+            ) from None
+    if not ended:
+        raise PaintFormatError(f"{path} is truncated")
+    if layers:
+        document.layer = current or layers[-1]
+        document.next_layer_id = max(layer.id for layer in layers) + 1
+    document.source = buffer
+    return document
+
+
+def read_chunk(document, tag, payload, styles, layers, current):
+    """Apply one chunk of a .paint file to the document being loaded, return the current layer so far."""
+    if tag == b"DOCU":
+        document.width, document.height = struct.unpack_from("<II", payload)
+        document.background = unpack_string(payload, 8)[0]
+    elif tag == b"STYL":
+        (index,) = struct.unpack_from("<H", payload)
+        styles[index] = unpack_string(payload, 2)[0]
+    elif tag == b"LAYR":
+        # The layers replace the default one, the next elements go to the last one read.
+        layer, is_current = decode_layer(payload)
+        layers.append(layer)
+        document.layers = list(layers)
+        document.layer = layer
+        document.restack()
+        if is_current:
+            current = layer
+    else:
+        element = decode_element(tag, payload, styles)
+        if element is not None:
+            document.add(element)
+            if isinstance(element, Stroke):
+                document.loaded.append(element)
+    return current
+
+
+########### Spatial index ###########
+class GridIndex:
+    """Uniform grid over the boxes of the drawn elements, answering point and rectangle queries.\n
+    Strokes are indexed segment by segment, so a long scribble only occupies the cells it crosses.
+    """
+
+    def __init__(self, cell_size=GRID_CELL_SIZE, key=operator.attrgetter("z", "id")):
+        self.cell_size = cell_size
+        self.key = key  # Stacking key of an element, for the bottom to top results
+        self.cells = {}  # (column, row) -> set of element ids
+        self.element_cells = {}  # element id -> set of (column, row)
+        self.bboxes = {}  # element id -> [x0, y0, x1, y1]
+        self.elements = {}  # element id -> element
+
+    def __len__(self):
+        return len(self.elements)
+
+    def cell_range(self, x0, y0, x1, y1):
+        """Yield the (column, row) keys of the cells overlapping a box."""
+        size = self.cell_size
+        for column in range(int(x0) // size, int(x1) // size + 1):
+            for row in range(int(y0) // size, int(y1) // size + 1):
+                yield column, row
+
+    def insert(self, element, first=0):
+        """Index an element, or only its segments from the point number first for a growing stroke."""
+        cells = self.element_cells.setdefault(element.id, set())
+        bbox = self.bboxes.get(element.id)
+        for box in element.boxes(first):
+            if bbox is None:
+                bbox = self.bboxes[element.id] = list(box)
+            else:
+                bbox[0] = min(bbox[0], box[0])
+                bbox[1] = min(bbox[1], box[1])
+                bbox[2] = max(bbox[2], box[2])
+                bbox[3] = max(bbox[3], box[3])
+            for key in self.cell_range(*box):
+                if key not in cells:
+                    cells.add(key)
+                    ids = self.cells.get(key)
+                    if ids is None:
+                        self.cells[key] = {element.id}
+                    else:
+                        ids.add(element.id)
+        self.elements[element.id] = element
+
+    def remove(self, element):
+        """Remove an element from the index."""
+        for key in self.element_cells.pop(element.id, ()):
+            ids = self.cells[key]
+            ids.discard(element.id)
+            if not ids:
+                del self.cells[key]
+        self.bboxes.pop(element.id, None)
+        self.elements.pop(element.id, None)
+
+    def clear(self):
+        """Remove every element from the index."""
+        self.cells.clear()
+        self.element_cells.clear()
+        self.bboxes.clear()
+        self.elements.clear()
+
+    def query_rect(self, x0, y0, x1, y1):
+        """Return the elements whose box overlaps the rectangle, bottom to top."""
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        found = set()
+        for key in self.cell_range(x0, y0, x1, y1):
+            ids = self.cells.get(key)
+            if ids:
+                found.update(ids)
+        result = []
+        for element_id in found:
+            bx0, by0, bx1, by1 = self.bboxes[element_id]
+            if bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1:
+                result.append(self.elements[element_id])
+        result.sort(key=self.key)
+        return result
+
+    def query_point(self, x, y, radius=0):
+        """Return the elements whose box is within radius of the point, bottom to top."""
+        return self.query_rect(x - radius, y - radius, x + radius, y + radius)
+
+
+########### Undo history ###########
+class Edit:
+    """One undoable step: the elements it added to and removed from the document."""
+
+    __slots__ = ("added", "removed", "nbytes")
+
+    def __init__(self, added=(), removed=()):
+        self.added = list(added)
+        self.removed = list(removed)
+        self.nbytes = sum(element.nbytes for element in self.added + self.removed)
+
+    def apply(self, document, view):
+        """Do (or redo) the edit."""
+        for element in self.removed:
+            document.remove(element)
+            view.hide(element)
+        for element in self.added:
+            document.restore(element)
+            view.show(element)
+
+    def revert(self, document, view):
+        """Undo the edit."""
+        for element in self.added:
+            document.remove(element)
+            view.hide(element)
+        for element in self.removed:
+            document.restore(element)
+            view.show(element)
+
+    def discard(self, view, undone):
+        """Release the canvas items only this edit still needed, once it leaves the history."""
+        for element in self.added if undone else self.removed:
+            view.remove(element)
+
+
+class LayerEdit(Edit):
+    """Deleting a layer: its elements are removed with it, and both come back on undo."""
+
+    __slots__ = ("layer", "position")
+
+    def __init__(self, layer, position, removed=()):
+        super().__init__(removed=removed)
+        self.layer = layer
+        self.position = position  # Position of the layer in the stack
+
+    def apply(self, document, view):
+        super().apply(document, view)
+        document.remove_layer(self.layer)
+        view.layers_changed()
+
+    def revert(self, document, view):
+        document.insert_layer(self.position, self.layer)
+        document.layer = self.layer
+        super().revert(document, view)
+        view.layers_changed()
+
+
+class PictureEdit(Edit):
+    """Importing a picture: its new layer, the picture and the page grown to hold it come and go together."""
+
+    __slots__ = ("layer", "position", "size", "grown")
+
+    def __init__(self, picture, layer, position, size, grown):
+        super().__init__(added=[picture])
+        self.layer = layer
+        self.position = position  # Position of the layer in the stack
+        self.size = size  # Page width and height before the import
+        self.grown = grown  # Page width and height after it
+
+    def apply(self, document, view):
+        document.insert_layer(self.position, self.layer)
+        self.resize(document, view, self.grown)
+        super().apply(document, view)
+        view.layers_changed()
+
+    def revert(self, document, view):
+        super().revert(document, view)
+        document.remove_layer(self.layer)
+        self.resize(document, view, self.size)
+        view.layers_changed()
+
+    @staticmethod
+    def resize(document, view, size):
+        """Give the page a size, when it differs."""
+        if (document.width, document.height) != size:
+            document.width, document.height = size
+            view.update_page()
+
+
+class History:
+    """Undo and redo stacks of Edit steps, capped by entry count and memory."""
+
+    def __init__(
+        self,
+        document,
+        view,
+        max_entries=HISTORY_MAX_ENTRIES,
+        max_bytes=HISTORY_MAX_BYTES,
+    ):
+        self.document = document
+        self.view = view
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.nbytes = 0
+
+    def push(self, edit):
+        """Record an edit that was just done, dropping the redo steps and the oldest history if needed."""
+        for undone in self.redo_stack:
+            self.nbytes -= undone.nbytes
+            undone.discard(self.view, undone=True)
+        self.redo_stack.clear()
+        self.undo_stack.append(edit)
+        self.nbytes += edit.nbytes
+        while self.undo_stack and (
+            len(self.undo_stack) > self.max_entries or self.nbytes > self.max_bytes
+        ):
+            oldest = self.undo_stack.popleft()
+            self.nbytes -= oldest.nbytes
+            oldest.discard(self.view, undone=False)
+
+    def undo(self):
+        """Revert the last edit and return it, or None when there is nothing to undo."""
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        edit.revert(self.document, self.view)
+        self.redo_stack.append(edit)
+        return edit
+
+    def redo(self):
+        """Apply again the last undone edit and return it, or None when there is nothing to redo."""
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        edit.apply(self.document, self.view)
+        self.undo_stack.append(edit)
+        return edit
+
+    def clear(self):
+        """Forget all the history, releasing what it kept alive."""
+        while self.undo_stack:
+            self.undo_stack.popleft().discard(self.view, undone=False)
+        while self.redo_stack:
+            self.redo_stack.pop().discard(self.view, undone=True)
+        self.nbytes = 0
+
+
+########### Operation journal ###########
+# The journal is an append-only file holding every finished operation since the drawing was last
+# started, opened or recovered, so a crash loses at most the operations of the last sync interval.
+# It is JOURNAL_MAGIC, then records made of a uint32 payload length, the CRC32 of the payload and
+# the payload. A record whose length or CRC does not check out is a torn write: it and everything
+# after it are dropped. Payloads are:
+#   D  width, height (uint32) and background colour of a new drawing
+#   L  the LAYR chunks of every layer, bottom to top, after the layers changed
+#   P  width and height (uint32) of the page after it was resized
+#   A/X/C/U/R/S  an add, erase, clear, undo, redo or snapshot: the number of removed, restored and
+#      new elements (uint32), their ids, the z of the new elements, then the .paint chunks of the
+#      new elements (STYL chunks included, so every record stands on its own), each preceded by
+#      an LREF chunk holding the uint32 id of its layer when it differs from the previous one
+JOURNAL_MAGIC = b"\x89PAINTJ\n"
+JOURNAL_PATH = os.path.join(APP_DIR, "journal.wal")
+JOURNAL_SYNC_INTERVAL = 0.25  # Seconds between two fsyncs of the journal
+RECORD_HEADER = struct.Struct("<II")
+OPERATION_HEADER = struct.Struct("<cIII")
+
+
+def encode_operation(op, removed=(), restored=(), added=()):
+    """Return the payload of an operation record.
+
+    Args:
+        op (bytes): one of b"A", b"X", b"C", b"U", b"R" or b"S".
+        removed (list): ids of the elements taken out of the drawing.
+        restored (list): ids of elements already journaled and put back in the drawing.
+        added (list): elements new to the journal.
+    """
+    parts = [
+        OPERATION_HEADER.pack(op, len(removed), len(restored), len(added)),
+        array("I", [*removed, *restored]).tobytes(),
+        array("I", [element.id for element in added]).tobytes(),
+        array("I", [element.z for element in added]).tobytes(),
+    ]
+    styles = {}
+    layer = None
+    for element in added:
+        if element.layer != layer:
+            layer = element.layer
+            parts.append(encode_chunk(b"LREF", struct.pack("<I", layer)))
+        parts.extend(encode_element(element, styles))
+    return b"".join(parts)
+
+
+def read_journal(path):
+    """Return the payloads of the valid records of a journal and the length of its valid part.\n
+    A torn or corrupted record ends the journal.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(JOURNAL_MAGIC):
+        return [], 0
+    payloads = []
+    offset = len(JOURNAL_MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        payloads.append(payload)
+        offset = start + length
+    return payloads, offset
+
+
+def replay_journal(path):
+    """Rebuild the drawing recorded in a journal, or return None when it holds no drawing."""
+    document = None
+    journaled = {}  # element id -> every element the journal introduced
+    for payload in read_journal(path)[0]:
+        op = payload[:1]
+        if op == b"D":
+            width, height = struct.unpack_from("<II", payload, 1)
+            document = Document(width, height, unpack_string(payload, 9)[0])
+            journaled.clear()
+            continue
+        if document is None:
+            continue
+        if op == b"L":
+            layers = []
+            offset = 1
+            while offset + CHUNK_HEADER.size <= len(payload):
+                tag, length = CHUNK_HEADER.unpack_from(payload, offset)
+                offset += CHUNK_HEADER.size
+                layer, is_current = decode_layer(payload[offset : offset + length])
+                offset += length
+                layers.append(layer)
+                if is_current:
+                    document.layer = layer
+            document.layers = layers
+            if document.layer not in layers:
+                document.layer = layers[-1]
+            document.next_layer_id = max(layer.id for layer in layers) + 1
+            document.restack()
+            continue
+        if op == b"P":
+            document.width, document.height = struct.unpack_from("<II", payload, 1)
+            continue
+        _, removed, restored, added = OPERATION_HEADER.unpack_from(payload)
+        ids = array("I")
+        ids.frombytes(
+            payload[
+                OPERATION_HEADER.size : OPERATION_HEADER.size
+                + 4 * (removed + restored + 2 * added)
+            ]
+        )
+        for element_id in ids[:removed]:
+            if element_id in document.elements:
+                document.remove(journaled[element_id])
+        for element_id in ids[removed : removed + restored]:
+            if element_id in journaled and element_id not in document.elements:
+                document.restore(journaled[element_id])
+        new_ids = ids[removed + restored : removed + restored + added]
+        new_z = ids[removed + restored + added :]
+        styles = {}
+        layer = document.layer.id  # Journals written before layers have no LREF
+        offset = OPERATION_HEADER.size + 4 * len(ids)
+        position = 0
+        while offset + CHUNK_HEADER.size <= len(payload) and position < added:
+            tag, length = CHUNK_HEADER.unpack_from(payload, offset)
+            offset += CHUNK_HEADER.size
+            chunk = payload[offset : offset + length]
+            offset += length
+            if tag == b"STYL":
+                (index,) = struct.unpack_from("<H", chunk)
+                styles[index] = unpack_string(chunk, 2)[0]
+                continue
+            if tag == b"LREF":
+                (layer,) = struct.unpack_from("<I", chunk)
+                continue
+            element = decode_element(tag, chunk, styles)
+            element.id = new_ids[position]
+            element.z = new_z[position]
+            element.layer = layer
+            position += 1
+            journaled[element.id] = element
+            document.restore(element)
+            document.next_id = max(document.next_id, element.id + 1)
+    return document
+
+
+class Journal:
+    """Append-only journal of the finished operations, written and synced by a background thread.\n
+    The Tk thread only queues the operations, the writer thread encodes them and batches the fsyncs.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, sync_interval=JOURNAL_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def pending(self):
+        """Return True when a journal left by a previous session holds operations."""
+        try:
+            return os.path.getsize(self.path) > len(JOURNAL_MAGIC)
+        except OSError:
+            return False
+
+    def start(self):
+        """Start the writer thread."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="journal", daemon=True)
+        self.thread.start()
+
+    def reset(self, document):
+        """Replace the journal by a snapshot of a drawing, when it is opened or recovered."""
+        self.queue.put(None)  # Truncate
+        header = struct.pack("<II", document.width, document.height)
+        self.queue.put((b"D", header + pack_string(document.background)))
+        self.log_layers(document)
+        self.log(b"S", added=list(document))
+
+    def log_layers(self, document):
+        """Queue the layers of a drawing after they changed, encoded now as they may change again."""
+        chunks = [
+            encode_layer(layer, layer is document.layer) for layer in document.layers
+        ]
+        self.queue.put((b"L", b"".join(chunks)))
+
+    def log_page(self, document):
+        """Queue the size of the page of a drawing after it was resized."""
+        self.queue.put((b"P", struct.pack("<II", document.width, document.height)))
+
+    def log(self, op, removed=(), restored=(), added=()):
+        """Queue an operation, the elements being referenced by id when already journaled.
+
+        Args:
+            op (bytes): b"A" add, b"X" erase, b"C" clear, b"U" undo, b"R" redo or b"S" snapshot.
+            removed (list): elements taken out of the drawing.
+            restored (list): elements already journaled, put back in the drawing.
+            added (list): finished elements new to the journal.
+        """
+        self.queue.put(
+            (
+                op,
+                [element.id for element in removed],
+                [element.id for element in restored],
+                list(added),
+            )
+        )
+
+    def close(self, remove=True):
+        """Flush the queued operations and stop the writer, deleting the journal after a clean exit."""
+        # Never started: the journal left by a previous session is kept.
+        if self.thread is None:
+            return
+        self.queue.put(False)
+        self.thread.join()
+        self.thread = None
+        if remove:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def run(self):
+        """Writer thread: append the queued operations, with one fsync per batch."""
+        last_sync = 0.0
+        with open(self.path, "ab") as file:
+            while True:
+                batch = [self.queue.get()]
+                # Let a burst of operations gather so it shares one fsync.
+                delay = last_sync + self.sync_interval - time.monotonic()
+                if delay > 0 and batch[0] is not False:
+                    time.sleep(delay)
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = False in batch  # Queued by close(), always last
+                for entry in batch:
+                    if entry is False:
+                        break
+                    if entry is None:
+                        file.truncate(0)
+                        file.write(JOURNAL_MAGIC)
+                        continue
+                    if entry[0] in (b"D", b"L", b"P"):
+                        payload = entry[0] + entry[1]
+                    else:
+                        payload = encode_operation(*entry)
+                    file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+                    file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+                last_sync = time.monotonic()
+                if stop:
+                    return
+
+
+########### Off-screen rendering ###########
+# A primitive is a (kind, coords, options) tuple, where kind is a canvas item type
+# ("line", "oval", "rectangle", "polygon", "text"), coords a flat sequence of numbers
+# and options a dict using the canvas option names (fill, outline, width, font, ...).
+# A "bitmap" primitive paints its foreground colour through a PIL "L" mask at (x, y), enlarged
+# by its "scale" option; the canvas shows it as an image item (see CanvasView.create_sprite).
+# An "image" primitive draws a Picture at (x, y) scaled by its "scale" option, from a mip level.
+
+TK_TO_PIL_ANCHORS = {
+    "nw": "la",
+    "n": "ma",
+    "ne": "ra",
+    "w": "lm",
+    "center": "mm",
+    "e": "rm",
+    "sw": "ld",
+    "s": "md",
+    "se": "rd",
+}
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(family, size, style=""):
+    """Find a PIL font matching a Tk font description, falling back to the default font.
+
+    Args:
+        family (str): Font family name as shown in the Text frame.
+        size (int): Tk font size, points when positive and pixels when negative.
+        style (str, optional): Tk font style such as "bold". Defaults to "".
+    """
+    pixels = round(size * 96 / 72) if size > 0 else -size
+    bold = "bold" in style
+    names = [family, family.replace(" ", "")]
+    if bold:
+        names = (
+            [f"{name} Bold" for name in names] + [f"{name}bd" for name in names] + names
+        )
+    for name in names:
+        for extension in (".ttf", ".otf", ".ttc"):
+            try:
+                return ImageFont.truetype(name + extension, pixels)
+            except OSError:
+                pass
+    if shutil.which("fc-match"):
+        pattern = f"{family}:bold" if bold else family
+        try:
+            path = subprocess.run(
+                ["fc-match", "-f", "%{file}", pattern],
+                capture_output=True,
+                text=True,
+                timeout=5,
+            ).stdout
+            return ImageFont.truetype(path, pixels)
+        except (OSError, subprocess.SubprocessError):
+            pass
+    try:
+        return ImageFont.load_default(pixels)
+    except TypeError:  # Pillow < 10.1 has no sizeable default font
+        return ImageFont.load_default()
+
+
+def scale_primitive(primitive, zoom):
+    """Return a primitive scaled by zoom around the origin: coordinates, line widths and font sizes."""
+    kind, coords, options = primitive
+    coords = np.multiply(coords, zoom).tolist()
+    if "width" in options:
+        options = dict(options, width=max(float(options["width"]) * zoom, 1.0))
+    if "font" in options:
+        family, size, style = options["font"]
+        size = int(size)
+        scaled = max(round(abs(size) * zoom), 1)
+        options = dict(options, font=(family, scaled if size > 0 else -scaled, style))
+    if kind in ("bitmap", "image"):
+        options = dict(options, scale=options.get("scale", 1) * zoom)
+    return kind, coords, options
+
+
+class RasterRenderer:
+    """Draw canvas primitives into an in-memory PIL image, without any display or screen capture.\n
+    A preview renderer draws pictures from the mip levels built so far instead of waiting for them.
+    """
+
+    def __init__(self, width, height, background="#FFFFFF"):
+        self.image = Image.new("RGB", (width, height), background)
+        self.draw = ImageDraw.Draw(self.image)
+        self.origin = (0, 0)
+        self.preview = False
+
+    @classmethod
+    def on(cls, image, origin=(0, 0), preview=False):
+        """Return a renderer drawing on an existing image whose top left corner is at origin."""
+        renderer = cls.__new__(cls)
+        renderer.image = image
+        renderer.draw = ImageDraw.Draw(image)
+        renderer.origin = origin
+        renderer.preview = preview
+        return renderer
+
+    def render(self, primitives):
+        """Draw every primitive in order and return the image."""
+        ox, oy = self.origin
+        for kind, coords, options in primitives:
+            if ox or oy:
+                coords = (
+                    (np.asarray(coords, dtype=np.float64).reshape(-1, 2) - self.origin)
+                    .ravel()
+                    .tolist()
+                )
+            getattr(self, f"draw_{kind}")(coords, options)
+        return self.image
+
+    @staticmethod
+    def pairs(coords):
+        """Turn a flat [x0, y0, x1, y1, ...] sequence into a list of (x, y) tuples."""
+        return list(zip(coords[0::2], coords[1::2]))
+
+    @staticmethod
+    def box(coords, width):
+        """Order a bounding box and grow it by half the outline width, as Tk centers outlines on the box."""
+        x0, y0, x1, y1 = coords[:4]
+        grow = width / 2 if width > 1 else 0
+        return (
+            min(x0, x1) - grow,
+            min(y0, y1) - grow,
+            max(x0, x1) + grow,
+            max(y0, y1) + grow,
+        )
+
+    def draw_line(self, coords, options):
+        """Draw a (poly)line, with round joins and caps when requested."""
+        fill = options.get("fill") or None
+        width = max(int(round(float(options.get("width", 1)))), 1)
+        points = self.pairs(coords)
+        if fill is None or len(points) < 2:
+            return
+        self.draw.line(points, fill=fill, width=width, joint="curve")
+        if options.get("capstyle") == tk.ROUND and width > 2:
+            r = width / 2
+            for x, y in (points[0], points[-1]):
+                self.draw.ellipse((x - r, y - r, x + r, y + r), fill=fill)
+
+    def draw_rectangle(self, coords, options):
+        """Draw an empty or filled rectangle."""
+        width = int(round(float(options.get("width", 1))))
+        self.draw.rectangle(
+            self.box(coords, width),
+            fill=options.get("fill") or None,
+            outline=options.get("outline") or None,
+            width=max(width, 1),
+        )
+
+    def draw_oval(self, coords, options):
+        """Draw an empty or filled oval."""
+        width = int(round(float(options.get("width", 1))))
+        self.draw.ellipse(
+            self.box(coords, width),
+            fill=options.get("fill") or None,
+            outline=options.get("outline") or None,
+            width=max(width, 1),
+        )
+
+    def draw_polygon(self, coords, options):
+        """Draw a filled polygon."""
+        self.draw.polygon(
+            self.pairs(coords),
+            fill=options.get("fill") or None,
+            outline=options.get("outline") or None,
+        )
+
+    def draw_text(self, coords, options):
+        """Draw a text with the font given as a (family, size, style) tuple."""
+        family, size, style = options["font"]
+        self.draw.text(
+            (coords[0], coords[1]),
+            options.get("text", ""),
+            fill=options.get("fill") or "#000000",
+            font=load_font(family, int(size), style),
+            anchor=TK_TO_PIL_ANCHORS.get(options.get("anchor", "center"), "mm"),
+        )
+
+    def draw_bitmap(self, coords, options):
+        """Paint the foreground colour through a mask whose top left corner is at coords.\n
+        Only the part of the mask over the image is scaled, so a zoomed in fill costs no more than the view.
+        """
+        mask = options["bitmap"]
+        scale = options.get("scale", 1)
+        x, y = coords[0], coords[1]
+        if scale == 1:
+            x, y = round(x), round(y)
+        x0 = max(math.floor(x), 0)
+        y0 = max(math.floor(y), 0)
+        x1 = min(math.ceil(x + mask.width * scale), self.image.width)
+        y1 = min(math.ceil(y + mask.height * scale), self.image.height)
+        if x1 <= x0 or y1 <= y0:
+            return
+        box = (
+            max((x0 - x) / scale, 0),
+            max((y0 - y) / scale, 0),
+            min((x1 - x) / scale, mask.width),
+            min((y1 - y) / scale, mask.height),
+        )
+        if scale == 1:
+            mask = mask.crop(tuple(int(value) for value in box))
+        else:
+            mask = mask.resize((x1 - x0, y1 - y0), Image.NEAREST, box=box)
+        # A mask of 0 and 255 pastes the same as a "1" mask, which is several times faster.
+        mask = mask.convert("1", dither=Image.Dither.NONE)
+        self.image.paste(options["foreground"], (x0, y0, x1, y1), mask)
+
+    def draw_image(self, coords, options):
+        """Draw a picture whose top left corner is at coords, from the coarsest mip level fine enough for
+        its scale. Only the part of the level over the image is resampled, so no draw costs more than
+        the target image, whatever the size of the photo.
+        """
+        picture = options["picture"]
+        scale = options.get("scale", 1)
+        x, y = coords[0], coords[1]
+        x0 = max(math.floor(x), 0)
+        y0 = max(math.floor(y), 0)
+        x1 = min(math.ceil(x + picture.width * scale), self.image.width)
+        y1 = min(math.ceil(y + picture.height * scale), self.image.height)
+        if x1 <= x0 or y1 <= y0:
+            return
+        level = picture.level(scale, wait=not self.preview)
+        if level is None:
+            self.draw.rectangle((x0, y0, x1 - 1, y1 - 1), fill=PICTURE_PLACEHOLDER)
+            return
+        factor = level.width / picture.width / scale  # Level pixels per target pixel
+        box = (
+            max((x0 - x) * factor, 0),
+            max((y0 - y) * factor, 0),
+            min((x1 - x) * factor, level.width),
+            min((y1 - y) * factor, level.height),
+        )
+        self.image.paste(
+            level.resize((x1 - x0, y1 - y0), Image.BILINEAR, box=box), (x0, y0)
+        )
+
+
+def render_document(document, progress=None, box=None):
+    """Render the visible layers of a document into an RGB image of its page, each with its opacity.\n
+    Opaque layers are drawn straight on the page, the others on a transparent image blended over it.
+    The elements are walked once, layer after layer. progress, when given, is called with the fraction
+    of the elements walked so far and may raise to stop the rendering. box, when given, is the
+    (x0, y0, x1, y1) part of the page to render alone, its elements being found by the spatial index.
+    """
+    x0, y0, x1, y1 = box or (0, 0, document.width, document.height)
+    image = Image.new("RGB", (x1 - x0, y1 - y0), document.background)
+    elements = document if box is None else document.find_in(x0, y0, x1, y1)
+    layers = {layer.id: layer for layer in document.layers}
+    total = len(elements)
+    count = 0
+
+    def walked(elements):
+        nonlocal count
+        for element in elements:
+            count += 1
+            if progress is not None and count % EXPORT_PROGRESS_STEP == 0:
+                progress(count / total)
+            yield element
+
+    for layer_id, group in itertools.groupby(elements, operator.attrgetter("layer")):
+        layer = layers[layer_id]
+        if not layer.visible or layer.opacity <= 0:
+            count += sum(1 for _ in group)
+            continue
+        primitives = (
+            primitive for element in walked(group) for primitive in element.primitives()
+        )
+        if layer.opacity >= 1:
+            RasterRenderer.on(image, (x0, y0)).render(primitives)
+            continue
+        overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        RasterRenderer.on(overlay, (x0, y0)).render(primitives)
+        opacity = layer.opacity
+        image.paste(
+            overlay, mask=overlay.getchannel("A").point(lambda a: round(a * opacity))
+        )
+    return image
+
+
+class RenderCache:
+    """The rendered visible layers of a part of the page, kept by the bucket tool from one click to the next.\n
+    Edits are only noted as they are made. At the next render, an element added above everything under it
+    is drawn over the kept image, and the box of any other change is rendered again, so a fill after a
+    stroke costs the stroke rather than the page. Another document, page size, background or stack of
+    layers renders the part again in full, as does a part that the kept image does not cover.
+    """
+
+    def __init__(self):
+        self.box = None  # (x0, y0, x1, y1) part of the page kept
+        self.image = None
+        self.state = None  # What the image depends on besides the elements
+        self.changes = []  # (element, added) pairs, in the order they were made
+
+    def clear(self):
+        """Forget the kept image."""
+        self.box = self.image = self.state = None
+        self.changes = []
+
+    def changed(self, added=(), removed=()):
+        """Note the elements added to the document (restored ones included) and removed from it."""
+        if self.image is None:
+            return
+        self.changes.extend((element, False) for element in removed)
+        self.changes.extend((element, True) for element in added)
+        if len(self.changes) > RENDER_CACHE_CHANGES:
+            self.clear()
+
+    def render(self, document, box):
+        """Return an RGB image of a box of the page, as render_document() does."""
+        state = (
+            document,
+            document.width,
+            document.height,
+            document.background,
+            [(layer.id, layer.visible, layer.opacity) for layer in document.layers],
+        )
+        x0, y0, x1, y1 = box
+        if (
+            self.image is None
+            or state != self.state
+            or not (
+                self.box[0] <= x0
+                and self.box[1] <= y0
+                and x1 <= self.box[2]
+                and y1 <= self.box[3]
+            )
+        ):
+            self.clear()
+            self.image = render_document(document, box=box)
+            self.box = box
+            self.state = state
+            return self.image
+        for element, added in self.changes:
+            if added and self.on_top(document, element):
+                RasterRenderer.on(self.image, self.box[:2]).render(element.primitives())
+            else:
+                self.render_again(document, element.bbox())
+        self.changes = []
+        if box == self.box:
+            return self.image
+        left, top = self.box[:2]
+        return self.image.crop((x0 - left, y0 - top, x1 - left, y1 - top))
+
+    def on_top(self, document, element):
+        """Return True when an element is in the document, on a visible opaque layer and above every
+        element of a visible layer overlapping it, so drawing it over the kept image is enough.
+        """
+        layers = {layer.id: layer for layer in document.layers}
+        layer = layers[element.layer] if element.id in document.elements else None
+        if layer is None or not layer.visible or layer.opacity < 1:
+            return False
+        for other in reversed(document.find_in(*element.bbox())):
+            if other is element:
+                return True
+            layer = layers[other.layer]
+            if layer.visible and layer.opacity > 0:
+                return False
+        return False
+
+    def render_again(self, document, box):
+        """Render again the part of the kept image within a document box, with a margin for antialiasing
+        and estimated text boxes.
+        """
+        left, top, right, bottom = self.box
+        x0 = max(math.floor(box[0]) - 2, left)
+        y0 = max(math.floor(box[1]) - 2, top)
+        x1 = min(math.ceil(box[2]) + 2, right)
+        y1 = min(math.ceil(box[3]) + 2, bottom)
+        if x0 < x1 and y0 < y1:
+            self.image.paste(
+                render_document(document, box=(x0, y0, x1, y1)), (x0 - left, y0 - top)
+            )
+
+
+########### Export ###########
+# Exports run on a worker thread that renders a snapshot of the drawing and encodes it, while the
+# Tk thread keeps drawing. The worker never calls Tk: it publishes its progress on the ExportJob
+# and the Tk thread polls it. SVG files are not rendered: the primitives of the elements are
+# streamed to the file as paths, texts and images.
+EXPORT_FORMATS = {
+    ".png": "PNG",
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".webp": "WEBP",
+    ".svg": "SVG",  # Written by save_svg, not PIL
+}
+EXPORT_SETTINGS = {  # PIL format -> default encoder settings, as Image.save options
+    "PNG": {"compress_level": 6},
+    "JPEG": {"quality": 90, "progressive": False},
+    "WEBP": {"quality": 90, "lossless": False},
+}
+EXPORT_RENDER_SHARE = 0.8  # Progress bar share of the rendering, the rest is encoding
+SVG_PATH_MAX_POINTS = 4096  # Points merged into one SVG <path> at most
+SVG_VERTICAL_ANCHORS = {"a": "hanging", "m": "middle", "d": "text-after-edge"}
+SVG_HORIZONTAL_ANCHORS = {"l": "start", "m": "middle", "r": "end"}
+
+
+def svg_numbers(values):
+    """Format coordinates for SVG path data."""
+    return " ".join(f"{value:g}" for value in values)
+
+
+def svg_path_style(kind, options):
+    """Return the (name, value) SVG attributes painting a "line", "rectangle", "oval" or "polygon"
+    primitive, or None when it paints nothing.
+    """
+    width = f"{float(options.get('width', 1)):g}"
+    if kind == "line":
+        if not options.get("fill"):
+            return None
+        return (
+            ("fill", "none"),
+            ("stroke", options["fill"]),
+            ("stroke-width", width),
+            (
+                "stroke-linecap",
+                "round" if options.get("capstyle") == "round" else "butt",
+            ),
+            ("stroke-linejoin", options.get("joinstyle", "round")),
+        )
+    fill = options.get("fill") or "none"
+    outline = options.get("outline")
+    if not outline:
+        return None if fill == "none" else (("fill", fill),)
+    return ("fill", fill), ("stroke", outline), ("stroke-width", width)
+
+
+def svg_path_data(kind, coords):
+    """Return the SVG path data of a "line", "rectangle", "oval" or "polygon" primitive.\n
+    Rectangles and ovals are always drawn the same way round, so filled ones merged into one path
+    never cut holes in each other.
+    """
+    if kind == "line":
+        return f"M{svg_numbers(coords[:2])}L{svg_numbers(coords[2:])}"
+    if kind == "polygon":
+        return f"M{svg_numbers(coords[:2])}L{svg_numbers(coords[2:])}Z"
+    x0, y0, x1, y1 = coords[:4]
+    x0, x1 = min(x0, x1), max(x0, x1)
+    y0, y1 = min(y0, y1), max(y0, y1)
+    if kind == "rectangle":
+        return f"M{x0:g} {y0:g}H{x1:g}V{y1:g}H{x0:g}Z"
+    rx, ry, cy = (x1 - x0) / 2, (y1 - y0) / 2, (y0 + y1) / 2
+    arc = f"A{rx:g} {ry:g} 0 1 0"
+    return f"M{x0:g} {cy:g}{arc} {x1:g} {cy:g}{arc} {x0:g} {cy:g}Z"
+
+
+def svg_attributes(attributes):
+    """Format (name, value) pairs as XML attributes."""
+    return " ".join(f"{name}={quoteattr(str(value))}" for name, value in attributes)
+
+
+def svg_element(kind, coords, options):
+    """Return the SVG element of a "text", "bitmap" or "image" primitive."""
+    x, y = coords[0], coords[1]
+    if kind == "image":
+        picture = options["picture"]
+        scale = options.get("scale", 1)
+        with Image.open(io.BytesIO(picture.data)) as image:
+            mime = Image.MIME[image.format]
+        data = base64.b64encode(picture.data).decode("ascii")
+        attributes = (
+            ("x", f"{x:g}"),
+            ("y", f"{y:g}"),
+            ("width", f"{picture.width * scale:g}"),
+            ("height", f"{picture.height * scale:g}"),
+            ("href", f"data:{mime};base64,{data}"),
+        )
+        return f"<image {svg_attributes(attributes)}/>\n"
+    if kind == "bitmap":
+        mask = options["bitmap"]
+        scale = options.get("scale", 1)
+        image = Image.new("RGBA", mask.size, options["foreground"])
+        image.putalpha(mask)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        data = base64.b64encode(buffer.getvalue()).decode("ascii")
+        attributes = (
+            ("x", f"{x:g}"),
+            ("y", f"{y:g}"),
+            ("width", f"{mask.width * scale:g}"),
+            ("height", f"{mask.height * scale:g}"),
+            ("style", "image-rendering:pixelated"),
+            ("href", f"data:image/png;base64,{data}"),
+        )
+        return f"<image {svg_attributes(attributes)}/>\n"
+    family, size, style = options["font"]
+    size = int(size)
+    horizontal, vertical = TK_TO_PIL_ANCHORS.get(options.get("anchor", "center"), "mm")
+    attributes = [
+        ("x", f"{x:g}"),
+        ("y", f"{y:g}"),
+        ("fill", options.get("fill") or "#000000"),
+        ("font-family", family),
+        ("font-size", f"{round(size * 96 / 72) if size > 0 else -size}px"),
+        ("text-anchor", SVG_HORIZONTAL_ANCHORS[horizontal]),
+        ("dominant-baseline", SVG_VERTICAL_ANCHORS[vertical]),
+    ]
+    if "bold" in style:
+        attributes.append(("font-weight", "bold"))
+    if "italic" in style:
+        attributes.append(("font-style", "italic"))
+    text = escape(options.get("text", ""))
+    return f"<text {svg_attributes(attributes)}>{text}</text>\n"
+
+
+def svg_path(data, style):
+    """Return the <path> element of merged path data."""
+    return f'<path d="{"".join(data)}" {svg_attributes(style)}/>\n'
+
+
+def svg_document(document, progress=None):
+    """Yield the SVG text of the visible layers of a document, piece by piece, element after element.\n
+    Consecutive lines and shapes of the same style are merged into one <path>, up to SVG_PATH_MAX_POINTS
+    points. A shape filled and outlined in two colours is never merged, as a merged path paints all its
+    fills before all its outlines. progress is called as by render_document.
+    """
+    width, height = document.width, document.height
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}">\n'
+        f'<rect width="{width}" height="{height}" fill={quoteattr(document.background)}/>\n'
+    )
+    layers = {layer.id: layer for layer in document.layers}
+    total = len(document)
+    count = 0
+    for layer_id, elements in itertools.groupby(document, operator.attrgetter("layer")):
+        layer = layers[layer_id]
+        if not layer.visible or layer.opacity <= 0:
+            count += sum(1 for _ in elements)
+            continue
+        opacity = f' opacity="{layer.opacity:g}"' if layer.opacity < 1 else ""
+        yield f'<g id="layer-{layer.id}"{opacity}>\n'
+        style = None  # Attributes of the path being merged
+        data = []
+        points = 0
+        for element in elements:
+            count += 1
+            if progress is not None and count % EXPORT_PROGRESS_STEP == 0:
+                progress(count / total)
+            for kind, coords, options in element.primitives():
+                if kind in ("text", "bitmap", "image"):
+                    if data:
+                        yield svg_path(data, style)
+                        data = []
+                    yield svg_element(kind, coords, options)
+                    continue
+                attributes = svg_path_style(kind, options)
+                if attributes is None:
+                    continue
+                if data and (attributes != style or points >= SVG_PATH_MAX_POINTS):
+                    yield svg_path(data, style)
+                    data = []
+                if not data:
+                    style = attributes
+                    points = 0
+                data.append(svg_path_data(kind, coords))
+                points += len(coords) // 2
+                colors = dict(attributes)
+                if (
+                    colors["fill"] != "none"
+                    and colors.get("stroke", colors["fill"]) != colors["fill"]
+                ):
+                    yield svg_path(data, style)
+                    data = []
+        if data:
+            yield svg_path(data, style)
+        yield "</g>\n"
+    yield "</svg>\n"
+
+
+def save_svg(document, path, progress=None):
+    """Stream the SVG of a document to a file, written next to path and renamed over it once complete."""
+    temporary = f"{path}.tmp"
+    try:
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.writelines(svg_document(document, progress))
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class ExportCancelled(Exception):
+    """Raised in the export worker when the export was cancelled."""
+
+
+class ExportJob:
+    """Export of a drawing to an image file, an SVG file or a .paint document, run by a worker thread.\n
+    progress is the fraction done, or None while the image is being encoded, whose progress is unknown.
+    Once done, saved tells whether the file was written, and error holds the exception that stopped
+    a failed export.
+    """
+
+    def __init__(self, document, path, image_format=None, settings=None):
+        self.document = document.snapshot()
+        self.path = path
+        self.image_format = image_format  # None for a .paint document
+        self.settings = settings or {}
+        self.progress = 0.0
+        self.done = False
+        self.saved = (
+            False  # True once the file is written, False after a failure or cancel
+        )
+        self.error = None
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="export", daemon=True)
+
+    def start(self):
+        """Start the worker thread and return the job."""
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        """Ask the worker to stop at its next progress report, leaving no file behind."""
+        self.cancelled.set()
+
+    def report(self, progress):
+        """Publish the progress of the worker, raise ExportCancelled once the export was cancelled."""
+        if self.cancelled.is_set():
+            raise ExportCancelled()
+        self.progress = progress
+
+    def run(self):
+        """Worker thread: render and encode, or save the document, through a temporary file."""
+        try:
+            if self.image_format is None:
+                save_document(self.document, self.path, self.report)
+                self.saved = True
+            elif self.image_format == "SVG":
+                save_svg(self.document, self.path, self.report)
+                self.saved = True
+            else:
+                image = render_document(
+                    self.document,
+                    lambda done: self.report(done * EXPORT_RENDER_SHARE),
+                )
+                self.report(None)
+                temporary = f"{self.path}.tmp"
+                try:
+                    with open(temporary, "wb") as file:
+                        image.save(
+                            ReportingFile(file, self),
+                            self.image_format,
+                            **self.settings,
+                        )
+                    self.report(1.0)
+                    os.replace(temporary, self.path)
+                    self.saved = True
+                except BaseException:
+                    try:
+                        os.remove(temporary)
+                    except FileNotFoundError:
+                        pass
+                    raise
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+
+
+class ReportingFile:
+    """File wrapper through which an image is encoded, so the export can be cancelled while it is."""
+
+    def __init__(self, file, job):
+        self.file = file
+        self.job = job
+
+    def write(self, data):
+        self.job.report(None)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        if name == "fileno":  # PIL would then encode straight to the descriptor
+            raise AttributeError(name)
+        return getattr(self.file, name)
+
+
+class ExportDialog(simpledialog.Dialog):
+    """Dialog choosing the encoder settings of an image export: PNG compression level,
+    JPEG quality and progressive mode, WebP quality and lossless mode.\n
+    result is the chosen settings, or None when cancelled.
+    """
+
+    def __init__(self, parent, image_format, settings):
+        self.image_format = image_format
+        self.settings = settings
+        self.variables = {}
+        super().__init__(parent, f"Export {image_format}")
+
+    def body(self, master):
+        """Create the widgets of the settings of the format."""
+        row = 0
+        for name, value in self.settings.items():
+            if isinstance(value, bool):
+                variable = tk.BooleanVar(master, value)
+                ttk.Checkbutton(master, text=name.capitalize(), variable=variable).grid(
+                    row=row, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5
+                )
+            else:
+                variable = tk.IntVar(master, value)
+                low, high = (0, 9) if name == "compress_level" else (1, 100)
+                ttk.Label(master, text=name.replace("_", " ").capitalize()).grid(
+                    row=row, column=0, sticky=tk.W, padx=5, pady=5
+                )
+                tk.Scale(
+                    master,
+                    from_=low,
+                    to=high,
+                    orient=tk.HORIZONTAL,
+                    length=160,
+                    variable=variable,
+                ).grid(row=row, column=1, padx=5, pady=5)
+            self.variables[name] = variable
+            row += 1
+
+    def apply(self):
+        """Keep the chosen settings."""
+        self.result = {
+            name: variable.get() for name, variable in self.variables.items()
+        }
+
+
+########### Tiled raster backing store ###########
+class TileStore:
+    """Sparse grid of TILE_SIZE x TILE_SIZE RGBA tiles held as NumPy arrays.\n
+    Drawing marks only the tiles it touches as dirty, so only those need to be uploaded again.
+    """
+
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        # (column, row) -> uint8 array of shape (tile_size, tile_size, 4)
+        self.tiles = {}
+        self.dirty = set()
+
+    def keys_in(self, x0, y0, x1, y1):
+        """Return the (column, row) keys of the tiles overlapping a box."""
+        size = self.tile_size
+        return [
+            (column, row)
+            for column in range(math.floor(x0) // size, math.floor(x1) // size + 1)
+            for row in range(math.floor(y0) // size, math.floor(y1) // size + 1)
+        ]
+
+    def box(self, key):
+        """Return the (x0, y0, x1, y1) box covered by a tile."""
+        column, row = key
+        size = self.tile_size
+        return column * size, row * size, (column + 1) * size, (row + 1) * size
+
+    def render(self, keys, primitives, over=False):
+        """Render primitives once over the region covering keys, then split it into those tiles.\n
+        With over=True the region is composited over the current tiles, else it replaces them.
+        """
+        keys = list(keys)
+        if not keys:
+            return
+        size = self.tile_size
+        left = min(column for column, row in keys)
+        top = min(row for column, row in keys)
+        right = max(column for column, row in keys)
+        bottom = max(row for column, row in keys)
+        region = Image.new(
+            "RGBA", ((right - left + 1) * size, (bottom - top + 1) * size), (0, 0, 0, 0)
+        )
+        RasterRenderer.on(region, (left * size, top * size), preview=True).render(
+            primitives
+        )
+        pixels = np.asarray(region)
+        for column, row in keys:
+            x = (column - left) * size
+            y = (row - top) * size
+            tile = pixels[y : y + size, x : x + size]
+            below = self.tiles.get((column, row))
+            if over and below is not None:
+                tile = np.asarray(
+                    Image.alpha_composite(
+                        Image.fromarray(below, "RGBA"),
+                        Image.fromarray(np.ascontiguousarray(tile), "RGBA"),
+                    )
+                )
+            self.set((column, row), tile)
+
+    def set(self, key, tile):
+        """Replace the pixels of a tile and mark it dirty, dropping it when fully transparent."""
+        if tile[:, :, 3].any():
+            self.tiles[key] = np.array(tile)
+        else:
+            self.tiles.pop(key, None)
+        self.dirty.add(key)
+
+    def drop(self, key):
+        """Forget a tile without marking it dirty, as when it leaves the realized region."""
+        self.tiles.pop(key, None)
+        self.dirty.discard(key)
+
+    def take_dirty(self):
+        """Return the dirty tile keys and forget them."""
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def image(self, key):
+        """Return a tile as a PIL image, or None for a tile that is empty."""
+        tile = self.tiles.get(key)
+        if tile is None:
+            return None
+        return Image.fromarray(tile, "RGBA")
+
+
+########### Font families ###########
+FONT_CACHE_PATH = os.path.join(APP_DIR, "fonts.json")
+# Font directories of Windows, Linux and macOS, and the fontconfig caches that fc-cache rewrites
+# whenever fonts are installed. The missing ones are skipped.
+FONT_DIRS = [
+    os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts"),
+    os.path.join(
+        os.environ.get("LOCALAPPDATA", os.path.expanduser("~/AppData/Local")),
+        "Microsoft",
+        "Windows",
+        "Fonts",
+    ),
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts"),
+    "/Library/Fonts",
+    "/System/Library/Fonts",
+    os.path.expanduser("~/Library/Fonts"),
+    "/var/cache/fontconfig",
+    os.path.expanduser("~/.cache/fontconfig"),
+]
+
+
+def font_fingerprint(dirs=FONT_DIRS, depth=2):
+    """Return a digest of the modification times of the font directories and their subdirectories.\n
+    Installing or removing a font changes the time of the directory holding it.
+    """
+    digest = hashlib.sha1(str(tk.TkVersion).encode())
+    pending = [(path, 0) for path in reversed(dirs)]
+    while pending:
+        path, level = pending.pop()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        digest.update(f"{path}\0{mtime}\0".encode())
+        if level < depth:
+            try:
+                with os.scandir(path) as entries:
+                    subdirs = sorted(entry.path for entry in entries if entry.is_dir())
+            except OSError:
+                continue
+            pending.extend((subdir, level + 1) for subdir in reversed(subdirs))
+    return digest.hexdigest()
+
+
+def font_families(root=None, path=FONT_CACHE_PATH):
+    """Return the sorted font families installed, without the vertical "@" variants of Windows.\n
+    The list is cached on disk and only asked to Tk again when the font fingerprint changed.
+    """
+    fingerprint = font_fingerprint()
+    try:
+        with open(path, encoding="utf-8") as file:
+            cache = json.load(file)
+        if cache["fingerprint"] == fingerprint:
+            return cache["families"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    families = sorted(
+        family for family in font.families(root) if not family.startswith("@")
+    )
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({"fingerprint": fingerprint, "families": families}, file)
+        os.replace(temporary, path)
+    except OSError:
+        pass
+    return families
+
+
+########### Canvas view ###########
+class CanvasView:
+    """Mirror a Document on a tk.Canvas, keeping the canvas items of every element.\n
+    Once there are too many items, the older settled elements are flattened (baked) into a tiled background
+    and their items deleted. Elements stacked below baked_until are drawn by the background tiles only.\n
+    Canvas coordinates are document coordinates times the zoom level, and panning scrolls the canvas.
+    Once realized, the view only has the items and tiles of the region around the viewport, zoomed out
+    strokes being drawn from decimated geometry, so its memory follows the viewport, not the document size.
+    The page of the document is a rectangle below every other item, and also the scroll region.\n
+    Only the elements of the active layer have items. Every other layer is flattened into its own cached
+    tiles, and the visible layers below and above the active one are composited into two tile sets, the
+    canvas stacking page < below tiles < active layer tiles < active layer items < above tiles. Editing the
+    active layer never renders the other layers again, a cached layer is only rendered again when it changes.
+    """
+
+    def __init__(self, canvas, document):
+        self.canvas = canvas
+        self.document = document
+        self.items = {}  # element id -> list of canvas item ids
+        self.item_count = 0
+        self.hidden = {}  # element id -> element whose items are hidden
+        self.active = document.layer.id  # Layer whose elements have canvas items
+        self.active_visible = True
+        self.baked_until = (0, 0)  # (z, id) key of the first element that is not baked
+        self.tiles = TileStore()  # Pixels of the baked elements of the active layer
+        self.tile_items = {}  # tile key -> (PhotoImage, canvas image item)
+        self.invalid_tiles = set()  # Tiles to render again from the document
+        self.layer_tiles = {}  # layer id -> TileStore of an inactive layer, flattened
+        self.invalid_layers = {}  # layer id -> keys of its cached tiles to render again
+        # Visible layers below and above the active one, composited with their opacity
+        self.composites = {"below": TileStore(), "above": TileStore()}
+        self.composite_items = {"below": {}, "above": {}}  # like tile_items
+        self.invalid_composites = set()
+        self.refresh_pending = False
+        self.sprites = (
+            {}
+        )  # element id -> PhotoImage of a stamp stroke or fill drawn as one image item
+        self.stamp_offsets = (
+            {}
+        )  # stroke id -> where the next stamp of a stroke being drawn goes
+        self.zoom = 1.0
+        # Document box whose elements have items, None until the view is realized
+        self.region = None
+        # Keys of the tiles rendered for the region, None when every tile is rendered
+        self.tile_keys = None
+        self.realize_pending = False
+        # zoom -> (active layer TileStore, layer tiles, tile keys) of the last zoom levels
+        self.zoomed_tiles = {}
+        self.lod_cell = None  # Decimation cell of the cached paths, in document pixels
+        self.lod = {}  # stroke id -> decimated path
+        self.page = None
+        self.ceiling = (
+            None  # Hidden item just below the above tiles, under which items go
+        )
+        self.update_page()
+
+    def to_document(self, x, y):
+        """Return the document point under a point of the Canvas widget, such as the one of a mouse event.\n
+        It is clamped to the int16 range of the stroke points.
+        """
+        x = round(self.canvas.canvasx(x) / self.zoom)
+        y = round(self.canvas.canvasy(y) / self.zoom)
+        return min(max(x, -32768), 32767), min(max(y, -32768), 32767)
+
+    def update_page(self):
+        """Create or resize the page rectangle and the scroll region to the document at the current zoom level."""
+        width = self.document.width * self.zoom
+        height = self.document.height * self.zoom
+        if self.page is None:
+            self.page = self.canvas.create_rectangle(
+                0,
+                0,
+                width,
+                height,
+                fill=self.document.background,
+                outline=PAGE_OUTLINE,
+                tags="page",
+            )
+            self.canvas.tag_lower(self.page)
+            self.ceiling = self.canvas.create_line(0, 0, 0, 0, state=tk.HIDDEN)
+        else:
+            self.canvas.coords(self.page, 0, 0, width, height)
+        self.canvas.configure(scrollregion=(0, 0, width, height))
+
+    def scaled(self, coords):
+        """Return document coordinates as canvas coordinates."""
+        if self.zoom == 1:
+            return coords
+        return np.multiply(coords, self.zoom).tolist()
+
+    def primitives(self, element):
+        """Yield the primitives of an element in canvas coordinates.\n
+        Zoomed out, a stroke is drawn along its decimated path, and a stamp stroke too thin to show
+        its stamps as a plain line.
+        """
+        zoom = self.zoom
+        if zoom == 1:
+            yield from element.primitives()
+            return
+        if zoom < 1 and isinstance(element, Stroke):
+            width = element.size if element.pen_type == "line" else 2 * element.size
+            if element.pen_type == "line" or (
+                width * zoom < LOD_STAMP_SIZE and len(element.points) >= 4
+            ):
+                # Power of two cells, so the paths are decimated once for every zoom octave.
+                cell = 2 ** math.floor(math.log2(LOD_CELL / zoom))
+                if cell != self.lod_cell:
+                    self.lod.clear()
+                    self.lod_cell = cell
+                path = self.lod.get(element.id)
+                if path is None:
+                    path = self.lod[element.id] = decimate_polyline(
+                        element.path(), cell
+                    )
+                if len(path) >= 4:
+                    yield "line", self.scaled(path), {
+                        "fill": element.color,
+                        "width": max(width * zoom, 1.0),
+                        "capstyle": "round",
+                        "joinstyle": "round",
+                    }
+                return
+        for primitive in element.primitives():
+            yield scale_primitive(primitive, zoom)
+
+    def create(self, kind, coords, options):
+        """Create one canvas item from a primitive."""
+        return self.place(getattr(self.canvas, f"create_{kind}")(*coords, **options))
+
+    def place(self, item):
+        """Stack a new item of the active layer below the tiles of the layers above it, hidden with its layer."""
+        if self.composite_items["above"]:
+            self.canvas.tag_lower(item, self.ceiling)
+        if not self.active_visible:
+            self.canvas.itemconfigure(item, state=tk.HIDDEN)
+        return item
+
+    def create_sprite(self, element):
+        """Render an element into one image and create a single canvas item for it: all the stamps
+        of a stamp stroke, the mask of a fill or the visible part of a picture.\n
+        The image is clipped to the realized region, so a zoomed in sprite stays small.
+        """
+        x0, y0, x1, y1 = element.bbox()
+        if self.region is not None:
+            rx0, ry0, rx1, ry1 = self.region
+            x0, y0, x1, y1 = max(x0, rx0), max(y0, ry0), min(x1, rx1), min(y1, ry1)
+        x0, y0, x1, y1 = (math.floor(value * self.zoom) for value in (x0, y0, x1, y1))
+        image = Image.new(
+            "RGBA", (max(x1 - x0, 0) + 2, max(y1 - y0, 0) + 2), (0, 0, 0, 0)
+        )
+        RasterRenderer.on(image, (x0, y0), preview=True).render(
+            self.primitives(element)
+        )
+        photo = ImageTk.PhotoImage(image)
+        self.sprites[element.id] = photo
+        return self.place(self.canvas.create_image(x0, y0, anchor=tk.NW, image=photo))
+
+    def is_baked(self, element):
+        """Return True when the element is drawn by tiles: the background tiles of the active layer,
+        or the cached tiles of its own layer.
+        """
+        return (
+            element.layer != self.active or (element.z, element.id) < self.baked_until
+        )
+
+    def in_region(self, element):
+        """Return True when the element overlaps the realized region, as every element does until realized."""
+        if self.region is None:
+            return True
+        box = self.document.index.bboxes.get(element.id) or element.bbox()
+        x0, y0, x1, y1 = self.region
+        return box[0] <= x1 and x0 <= box[2] and box[1] <= y1 and y0 <= box[3]
+
+    def add(self, element, above=None):
+        """Create the canvas items of a new element, on top or just above the items of another element.\n
+        An element outside the realized region gets no items until the viewport reaches it.
+        """
+        if self.is_baked(element):
+            self.invalidate(element.bbox(), element.layer)
+            return
+        if not self.in_region(element):
+            return
+        if isinstance(element, (Fill, Picture)) or (
+            isinstance(element, Stroke) and element.pen_type != "line"
+        ):
+            items = [self.create_sprite(element)]
+        else:
+            items = [self.create(*primitive) for primitive in self.primitives(element)]
+        self.items[element.id] = items
+        self.item_count += len(items)
+        below = self.items.get(above.id) if above is not None else None
+        if below:
+            for item in reversed(items):
+                self.canvas.tag_raise(item, below[-1])
+
+    def extend(self, stroke):
+        """Update the canvas after a point was appended to a stroke being drawn.\n
+        A line stroke keeps a single polyline item, the new point being inserted at its end so a long
+        stroke costs no more per point than a short one. A stamp stroke gets the stamps of its new
+        segment, placed by distance so fast moves leave no gap; they are merged by finish().
+        """
+        items = self.items.get(stroke.id)
+        if stroke.pen_type == "line":
+            if items is None:
+                self.add(stroke)
+            else:
+                self.canvas.insert(
+                    items[0], tk.END, self.scaled(list(stroke.points[-2:]))
+                )
+            return
+        if items is None:
+            items = self.items[stroke.id] = []
+        centres, self.stamp_offsets[stroke.id] = stamp_centres(
+            stroke.points[-4:], stroke.spacing, self.stamp_offsets.get(stroke.id, 0.0)
+        )
+        for x, y in centres.tolist():
+            items.append(
+                self.create(
+                    *scale_primitive(
+                        stamp_primitive(
+                            stroke.pen_type, x, y, stroke.size, stroke.color
+                        ),
+                        self.zoom,
+                    )
+                )
+            )
+        self.item_count += len(centres)
+
+    def finish(self, stroke):
+        """Update the canvas items of a finished stroke, whose points may have been simplified.\n
+        A line stroke gets its final path, the stamps of a stamp stroke are merged into one image item.
+        """
+        self.stamp_offsets.pop(stroke.id, None)
+        self.lod.pop(stroke.id, None)
+        items = self.items.get(stroke.id)
+        if not items:
+            return
+        if stroke.pen_type == "line":
+            for kind, coords, options in self.primitives(stroke):
+                self.canvas.coords(items[0], *coords)
+        else:
+            self.remove(stroke)
+            self.add(stroke)
+
+    def hide(self, element):
+        """Hide the canvas items of a removed element, keeping their stacking position for undo."""
+        if self.is_baked(element):
+            self.remove(element)
+            self.invalidate(element.bbox(), element.layer)
+            return
+        for item in self.items.get(element.id, ()):
+            self.canvas.itemconfigure(item, state=tk.HIDDEN)
+        self.hidden[element.id] = element
+
+    def show(self, element):
+        """Show again the canvas items of a restored element.\n
+        When realize() dropped them, the region is realized again to put new ones at the right stacking position.
+        """
+        self.hidden.pop(element.id, None)
+        if self.is_baked(element):
+            self.remove(element)
+            self.invalidate(element.bbox(), element.layer)
+            return
+        items = self.items.get(element.id)
+        if items is None:
+            if self.in_region(element):
+                self.schedule_realize()
+            return
+        if self.active_visible:
+            for item in items:
+                self.canvas.itemconfigure(item, state=tk.NORMAL)
+
+    def hide_all(self, removed):
+        """Hide every canvas item at once, after the document was cleared.
+
+        Args:
+            removed (list): the elements removed from the document.
+        """
+        self.canvas.itemconfigure("all", state=tk.HIDDEN)
+        for element in removed:
+            if element.id in self.items:
+                self.hidden[element.id] = element
+        if self.active_visible:
+            self.canvas.itemconfigure("tile", state=tk.NORMAL)
+        self.canvas.itemconfigure("below", state=tk.NORMAL)
+        self.canvas.itemconfigure("above", state=tk.NORMAL)
+        self.canvas.itemconfigure(self.page, state=tk.NORMAL)
+        self.invalid_tiles.update(self.tiles.tiles)
+        for layer_id, store in self.layer_tiles.items():
+            self.invalid_layers.setdefault(layer_id, set()).update(store.tiles)
+        self.zoomed_tiles.clear()
+        self.schedule_refresh()
+
+    def remove(self, element):
+        """Delete the canvas items of an element."""
+        items = self.items.pop(element.id, ())
+        for item in items:
+            self.canvas.delete(item)
+        self.item_count -= len(items)
+        self.hidden.pop(element.id, None)
+        self.sprites.pop(element.id, None)
+        self.lod.pop(element.id, None)
+
+    def needs_flattening(self):
+        """Return True when the canvas holds more items than FLATTEN_MAX_ITEMS."""
+        return self.item_count > FLATTEN_MAX_ITEMS
+
+    def flatten(self, keep):
+        """Bake the elements stacked below every element of keep into the background tiles.\n
+        Args:
+            keep (set): ids of the recent elements that must stay live canvas items.
+        """
+        baked = []
+        for element in self.document:
+            if self.is_baked(element):
+                continue
+            if element.id in keep:
+                break
+            baked.append(element)
+        else:
+            element = None
+        if not baked:
+            return
+        if element is not None:
+            self.baked_until = (element.z, element.id)
+        else:  # Everything is baked, later pieces of the top element included
+            self.baked_until = (baked[-1].z, math.inf)
+        self.zoomed_tiles.clear()
+        keys = set()
+        for element in baked:
+            keys.update(self.tile_keys_in(element.bbox()))
+        self.tiles.render(
+            keys,
+            (primitive for element in baked for primitive in self.primitives(element)),
+            over=True,
+        )
+        for element in baked:
+            self.remove(element)
+        for element in list(self.hidden.values()):
+            if self.is_baked(element):
+                self.remove(element)
+        self.upload_tiles()
+
+    def tile_keys_in(self, box):
+        """Return the keys of the tiles overlapping a document box, within the realized region."""
+        if self.region is not None:
+            x0, y0, x1, y1 = self.region
+            box = max(box[0], x0), max(box[1], y0), min(box[2], x1), min(box[3], y1)
+            if box[0] > box[2] or box[1] > box[3]:
+                return []
+        return self.tiles.keys_in(*(value * self.zoom for value in box))
+
+    def invalidate(self, box, layer=None):
+        """Schedule the tiles overlapping a document box to be rendered again from the document:
+        the background tiles of the active layer, or the cached tiles of another layer.
+        """
+        self.zoomed_tiles.clear()
+        if layer is None or layer == self.active:
+            self.invalid_tiles.update(self.tile_keys_in(box))
+        else:
+            self.invalid_layers.setdefault(layer, set()).update(self.tile_keys_in(box))
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        """Refresh the invalid tiles once the current event is handled."""
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            self.canvas.after_idle(self.refresh_tiles)
+
+    def refresh_tiles(self):
+        """Render again the invalid tiles of the active layer and of the cached layers, then composite
+        again the layers below and above the active one where their cached tiles changed.
+        """
+        self.refresh_pending = False
+        keys = self.invalid_tiles
+        self.invalid_tiles = set()
+        active = self.active
+        self.render_tiles(
+            self.tiles,
+            keys,
+            lambda element: element.layer == active and self.is_baked(element),
+        )
+        for layer_id, keys in self.invalid_layers.items():
+            store = self.layer_tiles.setdefault(layer_id, TileStore())
+            self.render_tiles(
+                store,
+                keys,
+                lambda element, layer_id=layer_id: element.layer == layer_id,
+            )
+            store.dirty.clear()  # Only shown through the composites
+            self.invalid_composites.update(keys)
+        self.invalid_layers.clear()
+        self.composite()
+        self.upload_tiles()
+
+    def render_tiles(self, store, keys, test):
+        """Render into tiles of a store the elements passing test, found through the spatial index."""
+        if not keys:
+            return
+        size = store.tile_size / self.zoom
+        found = [
+            element
+            for element in self.document.find_in(
+                min(column for column, row in keys) * size,
+                min(row for column, row in keys) * size,
+                (max(column for column, row in keys) + 1) * size,
+                (max(row for column, row in keys) + 1) * size,
+            )
+            if test(element)
+        ]
+        if not found:  # Nothing to draw, as on an empty layer
+            empty = np.zeros((store.tile_size, store.tile_size, 4), np.uint8)
+            for key in keys:
+                if key in store.tiles:
+                    store.set(key, empty)
+            return
+        store.render(
+            keys,
+            (primitive for element in found for primitive in self.primitives(element)),
+        )
+
+    def composite(self):
+        """Composite the cached tiles of the visible layers below and above the active layer, with their
+        opacity, where the composites are invalid.
+        """
+        keys = self.invalid_composites
+        self.invalid_composites = set()
+        if not keys:
+            return
+        layers = self.document.layers
+        position = self.document.positions[self.active]
+        empty = np.zeros((TILE_SIZE, TILE_SIZE, 4), np.uint8)
+        for name, group in (
+            ("below", layers[:position]),
+            ("above", layers[position + 1 :]),
+        ):
+            stores = [
+                (self.layer_tiles[layer.id].tiles, layer.opacity)
+                for layer in group
+                if layer.visible and layer.opacity > 0 and layer.id in self.layer_tiles
+            ]
+            composite = self.composites[name]
+            for key in keys:
+                result = None
+                for tiles, opacity in stores:
+                    tile = tiles.get(key)
+                    if tile is None:
+                        continue
+                    if opacity < 1:
+                        tile = tile.copy()
+                        tile[:, :, 3] = tile[:, :, 3] * opacity
+                    if result is None:
+                        result = tile
+                    else:
+                        result = np.asarray(
+                            Image.alpha_composite(
+                                Image.fromarray(result, "RGBA"),
+                                Image.fromarray(tile, "RGBA"),
+                            )
+                        )
+                if result is not None or key in composite.tiles:
+                    composite.set(key, empty if result is None else result)
+
+    def reset(self, document):
+        """Show another document: drop every item and tile, then bake the whole document into tiles."""
+        self.canvas.delete("all")
+        self.document = document
+        self.page = None
+        self.update_page()
+        self.items.clear()
+        self.item_count = 0
+        self.hidden.clear()
+        self.sprites.clear()
+        self.lod.clear()
+        self.zoomed_tiles.clear()
+        self.tiles = TileStore()
+        self.tile_items.clear()
+        self.invalid_tiles.clear()
+        self.layer_tiles.clear()
+        self.invalid_layers.clear()
+        self.composites = {"below": TileStore(), "above": TileStore()}
+        self.composite_items = {"below": {}, "above": {}}
+        self.invalid_composites.clear()
+        self.active = document.layer.id
+        self.active_visible = document.layer.visible
+        self.tile_keys = None if self.region is None else set()
+        self.bake_active()
+        bbox = document.bbox()
+        if self.region is not None:
+            self.realize()
+        elif bbox is not None:
+            for layer in document.layers:
+                self.invalidate(bbox, layer.id)
+
+    def upload_tiles(self):
+        """Copy the dirty tiles to their canvas image items: the below tiles just above the page, the
+        tiles of the active layer just above them and the above tiles on top of everything.
+        """
+        self.upload(self.composites["below"], self.composite_items["below"], "below")
+        self.upload(self.tiles, self.tile_items, "tile")
+        self.upload(self.composites["above"], self.composite_items["above"], "above")
+
+    def upload(self, store, tile_items, tag):
+        """Copy the dirty tiles of a store to their canvas image items, tagged tag."""
+        for key in store.take_dirty():
+            image = store.image(key)
+            entry = tile_items.get(key)
+            if image is None:
+                if entry is not None:
+                    self.canvas.delete(entry[1])
+                    del tile_items[key]
+            elif entry is None:
+                photo = ImageTk.PhotoImage(image)
+                x, y = store.box(key)[:2]
+                item = self.canvas.create_image(
+                    x, y, anchor=tk.NW, image=photo, tags=tag
+                )
+                if tag == "above":
+                    if not tile_items:  # The items of the active layer stay below
+                        self.canvas.tag_raise(self.ceiling)
+                    self.canvas.tag_raise(item)
+                else:
+                    below = self.composite_items["below"].get(key)
+                    if tag == "below" or below is None:
+                        self.canvas.tag_raise(item, self.page)
+                    else:
+                        self.canvas.tag_raise(item, below[1])
+                    if tag == "tile" and not self.active_visible:
+                        self.canvas.itemconfigure(item, state=tk.HIDDEN)
+                tile_items[key] = (photo, item)
+            else:
+                entry[0].paste(image)
+
+    def drop_tile(self, key):
+        """Delete a tile of every layer and its canvas image items."""
+        self.tiles.drop(key)
+        for store in self.layer_tiles.values():
+            store.drop(key)
+        for name, store in self.composites.items():
+            store.drop(key)
+            entry = self.composite_items[name].pop(key, None)
+            if entry is not None:
+                self.canvas.delete(entry[1])
+        entry = self.tile_items.pop(key, None)
+        if entry is not None:
+            self.canvas.delete(entry[1])
+
+    def delete_tile_items(self):
+        """Delete the canvas image items of every tile, keeping the tiles."""
+        for tile_items in (self.tile_items, *self.composite_items.values()):
+            for photo, item in tile_items.values():
+                self.canvas.delete(item)
+            tile_items.clear()
+
+    def clear_items(self):
+        """Delete the canvas items of every element."""
+        for items in self.items.values():
+            if items:
+                self.canvas.delete(*items)
+        self.items.clear()
+        self.item_count = 0
+        self.hidden.clear()
+        self.sprites.clear()
+
+    def bake_active(self):
+        """Bake every element of the active layer, as when it was just loaded or activated."""
+        top = max(
+            (element for element in self.document if element.layer == self.active),
+            key=self.document.key,
+            default=None,
+        )
+        self.baked_until = (0, 0) if top is None else (top.z, math.inf)
+
+    def activate(self, layer):
+        """Make another layer the active one, whose elements get canvas items when drawn on.\n
+        The previous active layer is flattened into its cached tiles, and the cached tiles of the new
+        one become its background tiles, so no layer is rendered again.
+        """
+        if self.active in self.document.positions:
+            self.flatten(set())
+            self.layer_tiles[self.active] = self.tiles
+            if self.invalid_tiles:
+                self.invalid_layers[self.active] = self.invalid_tiles
+        self.clear_items()
+        self.delete_tile_items()
+        self.active = layer.id
+        self.tiles = self.layer_tiles.pop(layer.id, None) or TileStore()
+        self.tiles.dirty = set(self.tiles.tiles)  # Their canvas items were deleted
+        self.invalid_tiles = self.invalid_layers.pop(layer.id, set())
+        for store in self.composites.values():
+            store.dirty = set(store.tiles)
+        self.zoomed_tiles.clear()
+        self.bake_active()
+
+    def layers_changed(self):
+        """Follow a change of the layers of the document: another current layer, or a layer added,
+        deleted, moved, shown, hidden or made more or less opaque. Only the composites are made again.
+        """
+        document = self.document
+        if document.layer.id != self.active:
+            self.activate(document.layer)
+        for layer_id in list(self.layer_tiles):
+            if layer_id not in document.positions:  # Deleted
+                del self.layer_tiles[layer_id]
+                self.invalid_layers.pop(layer_id, None)
+        if document.layer.visible != self.active_visible:
+            self.active_visible = document.layer.visible
+            state = tk.NORMAL if self.active_visible else tk.HIDDEN
+            for element_id, items in self.items.items():
+                if element_id not in self.hidden:
+                    for item in items:
+                        self.canvas.itemconfigure(item, state=state)
+            for photo, item in self.tile_items.values():
+                self.canvas.itemconfigure(item, state=state)
+        for store in (*self.layer_tiles.values(), *self.composites.values()):
+            self.invalid_composites.update(store.tiles)
+        self.schedule_refresh()
+
+    def viewport(self):
+        """Return the (x0, y0, x1, y1) document box shown by the Canvas widget."""
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        if width <= 1 or height <= 1:  # Canvas not mapped yet
+            width = int(self.canvas.cget("width"))
+            height = int(self.canvas.cget("height"))
+        return (
+            self.canvas.canvasx(0) / self.zoom,
+            self.canvas.canvasy(0) / self.zoom,
+            self.canvas.canvasx(width) / self.zoom,
+            self.canvas.canvasy(height) / self.zoom,
+        )
+
+    def viewport_changed(self, event=None):
+        """Realize the view again once the viewport leaves the realized region, after a pan or a resize."""
+        if self.region is not None:
+            x0, y0, x1, y1 = self.viewport()
+            rx0, ry0, rx1, ry1 = self.region
+            if rx0 <= x0 and ry0 <= y0 and x1 <= rx1 and y1 <= ry1:
+                return
+        self.schedule_realize()
+
+    def schedule_realize(self):
+        """Realize the view once the current events are handled."""
+        if not self.realize_pending:
+            self.realize_pending = True
+            self.canvas.after_idle(self.realize)
+
+    def realize(self):
+        """Recreate the items of the elements overlapping the region around the viewport, in stacking order,
+        and render the tiles of that region. Items and tiles outside of it are dropped.
+        """
+        self.realize_pending = False
+        x0, y0, x1, y1 = self.viewport()
+        margin_x = (x1 - x0) * VIEW_MARGIN
+        margin_y = (y1 - y0) * VIEW_MARGIN
+        self.region = (x0 - margin_x, y0 - margin_y, x1 + margin_x, y1 + margin_y)
+        self.clear_items()
+        for element in self.document.find_in(*self.region):
+            if not self.is_baked(element):
+                self.add(element)
+        keys = set(self.tile_keys_in(self.region))
+        shown = set(self.tile_items) | set(self.tiles.tiles)
+        for store in (*self.layer_tiles.values(), *self.composites.values()):
+            shown.update(store.tiles)
+        for key in shown - keys:
+            self.drop_tile(key)
+        if self.tile_keys is not None:
+            missing = keys - self.tile_keys
+            if self.baked_until != (0, 0):
+                self.invalid_tiles.update(missing)
+            for layer in self.document.layers:
+                if layer.id != self.active:
+                    self.invalid_layers.setdefault(layer.id, set()).update(missing)
+        self.invalid_tiles &= keys
+        for layer_keys in self.invalid_layers.values():
+            layer_keys &= keys
+        self.invalid_composites &= keys
+        self.tile_keys = keys
+        self.refresh_tiles()
+        self.upload_tiles()  # Tiles brought back by zoom_to() are still dirty
+
+    def xview(self, *args):
+        """Scroll horizontally as Canvas.xview does, for the scrollbar, realizing the view again when needed."""
+        self.canvas.xview(*args)
+        self.viewport_changed()
+
+    def yview(self, *args):
+        """Scroll vertically as Canvas.yview does, for the scrollbar, realizing the view again when needed."""
+        self.canvas.yview(*args)
+        self.viewport_changed()
+
+    def scroll_by(self, dx, dy):
+        """Scroll the Canvas by (dx, dy) canvas pixels."""
+        self.canvas.scan_mark(0, 0)
+        self.canvas.scan_dragto(-round(dx), -round(dy), gain=1)
+
+    def zoom_to(self, zoom, x=None, y=None):
+        """Change the zoom level, keeping the document point under the widget point (x, y) in place.\n
+        The centre of the widget is kept when no point is given.
+        """
+        zoom = min(max(zoom, ZOOM_MIN), ZOOM_MAX)
+        if zoom == self.zoom:
+            return
+        if x is None or y is None:
+            x = self.canvas.winfo_width() // 2
+            y = self.canvas.winfo_height() // 2
+        cx = self.canvas.canvasx(x)
+        cy = self.canvas.canvasy(y)
+        ratio = zoom / self.zoom
+        # Keep the tiles of the current zoom level and bring back the ones of the new level, if any.
+        # The composites are made again from the cached layers.
+        self.delete_tile_items()
+        if self.tile_keys:
+            invalid = self.invalid_tiles.union(*self.invalid_layers.values())
+            self.zoomed_tiles[self.zoom] = (
+                self.tiles,
+                self.layer_tiles,
+                self.tile_keys - invalid,
+            )
+            while len(self.zoomed_tiles) > ZOOM_CACHE_LEVELS:
+                del self.zoomed_tiles[next(iter(self.zoomed_tiles))]
+        self.tiles, self.layer_tiles, self.tile_keys = self.zoomed_tiles.pop(
+            zoom, (TileStore(), {}, set())
+        )
+        self.tiles.dirty = set(self.tiles.tiles)  # Their canvas items were deleted
+        self.invalid_tiles.clear()
+        self.invalid_layers.clear()
+        self.composites = {"below": TileStore(), "above": TileStore()}
+        self.invalid_composites = set(self.tile_keys)
+        self.zoom = zoom
+        self.update_page()
+        self.scroll_by(cx * ratio - cx, cy * ratio - cy)
+        self.realize()
+
+
+########### Performance HUD ###########
+HUD_REFRESH_MS = 500  # Period of the overlay updates
+HUD_TICK_MS = 50  # Period of the timer measuring how late the Tk event loop runs it
+HUD_SAMPLES = 500  # Latest samples kept per handler
+
+
+def timed(handler):
+    """Decorate a PaintApp event handler so its latency is recorded while the performance HUD is shown.\n
+    With the HUD hidden, the only cost is one attribute check.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    def wrapper(self, *args, **kwargs):
+        hud = self.hud
+        if hud is None:
+            return handler(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return handler(self, *args, **kwargs)
+        finally:
+            hud.record(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def process_memory():
+    """Return the resident memory of the process in MB, or None where it cannot be read."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(
+        resource.RUSAGE_SELF
+    ).ru_maxrss  # Peak, in KB (bytes on macOS)
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def latency_percentiles(samples):
+    """Return the (p50, p99) of latency samples in seconds, as milliseconds."""
+    ordered = sorted(samples)
+    return (
+        ordered[len(ordered) // 2] * 1000,
+        ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] * 1000,
+    )
+
+
+class PerformanceHUD:
+    """Overlay in the corner of the Canvas showing its item count, the event handler latencies,
+    the lag of the Tk event loop and the process memory.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.samples = {}  # handler name -> latest latencies in seconds
+        self.lag = deque(maxlen=HUD_SAMPLES)  # How late the tick timer ran, in seconds
+        self.expected = None
+        self.label = tk.Label(
+            app.canvas,
+            justify=tk.LEFT,
+            font=("Courier", 9),
+            background="#202020",
+            foreground="#E0E0E0",
+            padx=6,
+            pady=4,
+        )
+        self.label.place(relx=1.0, x=-8, y=8, anchor=tk.NE)
+        self.tick_job = None
+        self.refresh_job = None
+        self.tick()
+        self.refresh()
+
+    def record(self, name, seconds):
+        """Add a latency sample of a handler."""
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=HUD_SAMPLES)
+        samples.append(seconds)
+
+    def tick(self):
+        """Measure how late the event loop runs a timer, which is how long it was kept busy."""
+        now = time.perf_counter()
+        if self.expected is not None:
+            self.lag.append(max(0.0, now - self.expected))
+        self.expected = now + HUD_TICK_MS / 1000
+        self.tick_job = self.app.root.after(HUD_TICK_MS, self.tick)
+
+    def refresh(self):
+        """Update the overlay text."""
+        lines = [f"{'canvas items':<22}{len(self.app.canvas.find_all()):>8}"]
+        for name, samples in sorted(self.samples.items()):
+            p50, p99 = latency_percentiles(samples)
+            lines.append(f"{name:<22}p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+        if self.lag:
+            p50, p99 = latency_percentiles(self.lag)
+            lines.append(f"{'idle loop lag':<22}p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+        memory = process_memory()
+        if memory is not None:
+            lines.append(f"{'memory':<22}{memory:>8.0f} MB")
+        self.label.configure(text="\n".join(lines))
+        self.refresh_job = self.app.root.after(HUD_REFRESH_MS, self.refresh)
+
+    def close(self):
+        """Stop measuring and remove the overlay."""
+        self.app.root.after_cancel(self.tick_job)
+        self.app.root.after_cancel(self.refresh_job)
+        self.label.destroy()
+
+
+########### Icons ###########
+ICON_ATLAS_PATH = os.path.join(ASSETS_DIR, "icons.png")
+
+
+class IconAtlas:
+    """The toolbar and menu icons, packed into one image by tools/build_atlas.py.\n
+    The atlas is decoded once, on first use, and each icon is sliced out of it the first time it is asked for.
+    """
+
+    def __init__(self, master, path=ICON_ATLAS_PATH):
+        self.master = master
+        self.path = path
+        with open(os.path.splitext(path)[0] + ".json", encoding="utf-8") as file:
+            self.boxes = json.load(file)  # icon name -> [x, y, width, height]
+        self.sheet = None
+        self.icons = (
+            {}
+        )  # (name, mirrored) -> PhotoImage, kept alive for the widgets showing them
+
+    def get(self, name, mirrored=False):
+        """Return the PhotoImage of an icon, flipped horizontally when mirrored is True."""
+        icon = self.icons.get((name, mirrored))
+        if icon is None:
+            if self.sheet is None:
+                self.sheet = tk.PhotoImage(master=self.master, file=self.path)
+            x, y, width, height = self.boxes[name]
+            icon = tk.PhotoImage(master=self.master, width=width, height=height)
+            flip = ("-subsample", -1, 1) if mirrored else ()
+            icon.tk.call(
+                icon, "copy", self.sheet, "-from", x, y, x + width, y + height, *flip
+            )
+            self.icons[(name, mirrored)] = icon
+        return icon
 
 
 class PaintApp:
     """Defining the PaintApp class."""
 
-    def __init__(self, root):
+    def __init__(self, root, document_size=None):
         """Inilialize the properties of PaintApp class
 
         Args:
             root (_type_): _description_
+            document_size (tuple, optional): (width, height) of the drawing. Defaults to the Canvas size.
         """
         self.root = root
 
         self.canvas_width = 900  # Canvas Width
         self.canvas_height = 600  # Canvas height
-        # Construct canvas widget
+        # Construct canvas widget, with scrollbars for the drawings larger than the window
+        self.canvas_frame = tk.Frame(self.root, bg="#F9F9F9")
+        self.canvas_frame.pack(
+            side=tk.BOTTOM, fill=tk.BOTH, expand=True, ipadx=4, ipady=4, padx=2, pady=2
+        )
         self.canvas = tk.Canvas(
-            self.root,
+            self.canvas_frame,
             width=self.canvas_width,
             height=self.canvas_height,
-            bg="#FFFFFF",
+            bg="#E1E4EA",
             bd=0,
             relief=tk.SUNKEN,
         )
-        self.canvas.pack(
-            side=tk.BOTTOM, fill=tk.BOTH, expand=True, ipadx=4, ipady=4, padx=2, pady=2
+        self.canvas.grid(row=0, column=0, sticky=tk.NSEW)
+        self.canvas_frame.rowconfigure(0, weight=1)
+        self.canvas_frame.columnconfigure(0, weight=1)
+        # The drawing itself lives in the document, the canvas is only a view of it.
+        width, height = document_size or (self.canvas_width, self.canvas_height)
+        self.document = Document(width, height, "#FFFFFF")
+        self.view = CanvasView(self.canvas, self.document)
+        self.x_scrollbar = ttk.Scrollbar(
+            self.canvas_frame, orient=tk.HORIZONTAL, command=self.view.xview
+        )
+        self.x_scrollbar.grid(row=1, column=0, sticky=tk.EW)
+        self.y_scrollbar = ttk.Scrollbar(
+            self.canvas_frame, orient=tk.VERTICAL, command=self.view.yview
         )
+        self.y_scrollbar.grid(row=0, column=1, sticky=tk.NS)
+        self.canvas.configure(
+            xscrollcommand=self.x_scrollbar.set, yscrollcommand=self.y_scrollbar.set
+        )
+        self.history = History(self.document, self.view)
+        # The bucket tool's render of the page, kept up to date by the edits
+        self.render_cache = RenderCache()
+        self.icons = IconAtlas(self.root)
+        # Every finished operation is journaled, so the drawing survives a crash.
+        self.journal = Journal()
 
         self.setup_navbar()
         self.setup_tools()
         self.setup_events()
         self.prev_x = None
         self.prev_y = None
+        self.stroke = None  # Stroke being drawn, between press and release
+        self.erased = []  # Elements removed by the current eraser drag
+        self.erase_pieces = {}  # Element id -> pieces left by the current eraser drag
+        self.simplify_tolerance = (
+            SIMPLIFY_TOLERANCE  # Simplification of the finished strokes
+        )
+        self.fit_curves = CURVE_FITTING
+        self.hud = None  # PerformanceHUD while shown
+        self.export_job = None  # ExportJob while an export runs
+        self.export_settings = {  # Encoder settings last chosen for each image format
+            image_format: dict(settings)
+            for image_format, settings in EXPORT_SETTINGS.items()
+        }
+        self.export_status = (
+            None  # Frame showing the progress of an export on the Canvas
+        )
+        self.export_status_job = None
+        self.root.protocol("WM_DELETE_WINDOW", self.exit)
+        self.root.after_idle(self.start_journal)
 
     def setup_navbar(self):
         """Setup the Navbar menu.\n
-        File menu -> Save and Exit \n
-        Edit menu -> Undo \n
+        File menu -> New, Save, Open, Import and Exit \n
+        Edit menu -> Undo and Redo \n
+        View menu -> Zoom In, Zoom Out, Actual Size and Performance HUD \n
         About menu -> About window
         """
         self.navbar = tk.Menu(
@@ -70,19 +3805,19 @@ class PaintApp:
             activeforeground="#FFFFFF",
         )
         self.navbar.add_cascade(label="File", menu=self.file_menu)
-        self.save_icon = tk.PhotoImage(
-            file="./assets/save_icon.png", height=16, width=16
-        )
         self.file_menu.add_command(
-            label="Save", image=self.save_icon, compound=tk.LEFT, command=self.save_as
+            label="New...", compound=tk.LEFT, command=self.new_document
         )
-        self.file_menu.add_separator(background="#EBEBEB")
-        self.exit_icon = tk.PhotoImage(
-            file="./assets/exit_icon.png", height=16, width=16
+        self.file_menu.add_command(label="Save", compound=tk.LEFT, command=self.save_as)
+        self.file_menu.add_command(
+            label="Open...", compound=tk.LEFT, command=self.open_document
         )
         self.file_menu.add_command(
-            label="Exit", image=self.exit_icon, compound=tk.LEFT, command=self.root.quit
+            label="Import...", compound=tk.LEFT, command=self.import_picture
         )
+        self.file_menu.add_separator(background="#EBEBEB")
+        self.file_menu.add_command(label="Exit", compound=tk.LEFT, command=self.exit)
+        self.lazy_menu_icons(self.file_menu, {"Save": "save", "Exit": "exit"})
 
         # Edit menu
         self.edit_menu = tk.Menu(
@@ -94,11 +3829,39 @@ class PaintApp:
             activeforeground="#FFFFFF",
         )
         self.navbar.add_cascade(label="Edit", menu=self.edit_menu)
-        self.undo_icon = tk.PhotoImage(
-            file="./assets/undo_icon.png", height=16, width=16
+        self.edit_menu.add_command(label="Undo", compound=tk.LEFT, command=self.undo)
+        self.edit_menu.add_command(label="Redo", compound=tk.LEFT, command=self.redo)
+        # The redo icon is the undo icon mirrored horizontally.
+        self.lazy_menu_icons(
+            self.edit_menu, {"Undo": ("undo", False), "Redo": ("undo", True)}
+        )
+
+        # View menu
+        self.view_menu = tk.Menu(
+            self.navbar,
+            tearoff=False,
+            background="#F7F9FC",
+            foreground="#19191A",
+            activebackground="#0060C0",
+            activeforeground="#FFFFFF",
+        )
+        self.navbar.add_cascade(label="View", menu=self.view_menu)
+        self.view_menu.add_command(
+            label="Zoom In", accelerator="Ctrl++", command=self.zoom_in
+        )
+        self.view_menu.add_command(
+            label="Zoom Out", accelerator="Ctrl+-", command=self.zoom_out
+        )
+        self.view_menu.add_command(
+            label="Actual Size", accelerator="Ctrl+0", command=self.zoom_reset
         )
-        self.edit_menu.add_command(
-            label="Undo", image=self.undo_icon, compound=tk.LEFT, command=self.undo
+        self.view_menu.add_separator()
+        self.hud_shown = tk.BooleanVar(value=False)
+        self.view_menu.add_checkbutton(
+            label="Performance HUD",
+            accelerator="F12",
+            variable=self.hud_shown,
+            command=self.toggle_hud,
         )
 
         # About menu
@@ -111,21 +3874,34 @@ class PaintApp:
             activeforeground="#FFFFFF",
         )
         self.navbar.add_cascade(label="About", menu=self.about_menu)
-        self.about_icon = tk.PhotoImage(
-            file="./assets/about_icon.png", height=16, width=16
-        )
-        self.about_menu.add_command(
-            label="About", image=self.about_icon, compound=tk.LEFT, command=self.about
-        )
+        self.about_menu.add_command(label="About", compound=tk.LEFT, command=self.about)
+        self.lazy_menu_icons(self.about_menu, {"About": "about"})
+
+    def lazy_menu_icons(self, menu, icons):
+        """Give the entries of a menu their icons only when the menu is first opened.
+
+        Args:
+            menu (tk.Menu): the menu.
+            icons (dict): entry label -> icon name, or (icon name, mirrored) pair.
+        """
+
+        def show_icons():
+            for label, icon in icons.items():
+                name, mirrored = icon if isinstance(icon, tuple) else (icon, False)
+                menu.entryconfigure(label, image=self.icons.get(name, mirrored))
+            menu.configure(postcommand="")
+
+        menu.configure(postcommand=show_icons)
 
     def setup_tools(self):
         """Setup the Tools LabelFrame.\n
-        Tools Frame -> Pen , Eraser and Clear canvas (New Page) \n
+        Tools Frame -> Pen , Eraser, Bucket fill with its tolerance and Clear canvas (New Page) \n
         Brush Size Frame -> Change the brush size from the dropdown list. \n
         Colours Frame -> Choose default colours or open color shooser palette.
         Pen style Frame -> Select pen style from the dropdown list ["line", "round", "square", "arrow", "diamond"] \n
         Shapes Frame -> Select shapes, rectangle, filled rectangle, circle(oval) , filled circle(oval), line \n
-        Text Frame -> Enter a text, choose font style and size then click the "I" button to draw it.
+        Text Frame -> Enter a text, choose font style and size then click the "I" button to draw it.\n
+        Layers Frame -> Select the layer to draw on, add, delete, move, show or hide layers and set their opacity.
         """
         self.selected_tool = "pen"  # Initialize selected tool to "pen"
         self.selected_color = "#000000"  # Initialize selected color to "black"
@@ -156,12 +3932,12 @@ class PaintApp:
         self.selected_pen_type = self.pen_types[
             0
         ]  # Initialize selected pen type to "line"
+        self.fill_tolerances = [0, 8, 16, 32, 48, 64, 96, 128]
+        self.fill_tolerance = FILL_TOLERANCE
 
-        # Getting all the font families installed in computer and display them in the text widget, so the user can change the font family from the dropdown list.
+        # The font families installed in computer are only listed when the dropdown list of the text widget
+        # is first opened, from a cache on disk while the installed fonts do not change.
         self.fonts_families = []
-        for i in sorted(font.families()):
-            if re.match(r"^@", i) == None:
-                self.fonts_families.append(i)
         self.selected_fonts_families = "Tahoma"
 
         self.text_sizes = [
@@ -237,6 +4013,12 @@ class PaintApp:
             fill=tk.BOTH,
         )
 
+        # Layers frame
+        self.layers_frame = ttk.LabelFrame(self.root, text="Layers", labelanchor="nw")
+        self.layers_frame.pack(
+            side=tk.LEFT, ipadx=4, ipady=4, padx=5, pady=5, fill=tk.BOTH
+        )
+
         ## TODO : customize the current colours, tools label
         # Show the current color and tool at the top right
         self.current_color_label = ttk.Label(
@@ -255,12 +4037,9 @@ class PaintApp:
         )
 
         # Undo button to delete last changes
-        self.undo_icon = tk.PhotoImage(
-            file="./assets/undo32_icon.png", height=32, width=32
-        )
         self.undo_btn = tk.Button(
             self.root,
-            image=self.undo_icon,
+            image=self.icons.get("undo32"),
             compound=tk.LEFT,
             text="",
             bg="#FAFAFD",
@@ -281,12 +4060,13 @@ class PaintApp:
 
         self.fonts_families_combobox = ttk.Combobox(
             self.text_frame,
-            values=self.fonts_families,
+            values=[self.selected_fonts_families],
             state="readonly",
             width=20,
             font=(self.selected_fonts_families, 8, ""),
+            postcommand=self.load_font_families,
         )
-        self.fonts_families_combobox.current(0)
+        self.fonts_families_combobox.set(self.selected_fonts_families)
         self.fonts_families_combobox.pack(
             side=tk.LEFT, padx=(2, 2), pady=(0, 0), ipadx=4, ipady=4
         )
@@ -313,12 +4093,9 @@ class PaintApp:
         )
 
         # Text button to draw the text from the Text Entry
-        self.text_icon = tk.PhotoImage(
-            file="./assets/text_icon.png", height=16, width=16
-        )
         self.text_button = ttk.Button(
             self.text_frame,
-            image=self.text_icon,
+            image=self.icons.get("text"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -335,12 +4112,9 @@ class PaintApp:
         )
 
         # Draw Rectangle tool
-        self.rectangle_icon = tk.PhotoImage(
-            file="./assets/rectangle_icon.png", height=16, width=16
-        )
         self.rectangle_button = ttk.Button(
             self.shapes_frame,
-            image=self.rectangle_icon,
+            image=self.icons.get("rectangle"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -358,12 +4132,9 @@ class PaintApp:
         )
 
         # Draw Filled Rectangle tool
-        self.f_rectangle_icon = tk.PhotoImage(
-            file="./assets/f_rectangle_icon.png", height=16, width=16
-        )
         self.f_rectangle_button = ttk.Button(
             self.shapes_frame,
-            image=self.f_rectangle_icon,
+            image=self.icons.get("f_rectangle"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -381,12 +4152,9 @@ class PaintApp:
         )
 
         # Draw Circle tool
-        self.circle_icon = tk.PhotoImage(
-            file="./assets/circle_icon.png", height=16, width=16
-        )
         self.circle_button = ttk.Button(
             self.shapes_frame,
-            image=self.circle_icon,
+            image=self.icons.get("circle"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -404,12 +4172,9 @@ class PaintApp:
         )
 
         # Draw Filled Circle tool
-        self.f_circle_icon = tk.PhotoImage(
-            file="./assets/f_circle_icon.png", height=16, width=16
-        )
         self.f_circle_button = ttk.Button(
             self.shapes_frame,
-            image=self.f_circle_icon,
+            image=self.icons.get("f_circle"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -427,12 +4192,9 @@ class PaintApp:
         )
 
         # Draw Line tool
-        self.line_icon = tk.PhotoImage(
-            file="./assets/line_icon.png", height=16, width=16
-        )
         self.line_button = ttk.Button(
             self.shapes_frame,
-            image=self.line_icon,
+            image=self.icons.get("line"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -450,10 +4212,9 @@ class PaintApp:
         self.rectangles = []
 
         # Pen tool
-        self.pen_icon = tk.PhotoImage(file="./assets/pen_icon.png", height=16, width=16)
         self.pen_button = ttk.Button(
             self.tool_frame,
-            image=self.pen_icon,
+            image=self.icons.get("pen"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -468,12 +4229,9 @@ class PaintApp:
             bd=0,
         )
         # Eraser tool
-        self.eraser_icon = tk.PhotoImage(
-            file="./assets/eraser_icon.png", height=16, width=16
-        )
         self.eraser_button = ttk.Button(
             self.tool_frame,
-            image=self.eraser_icon,
+            image=self.icons.get("eraser"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -487,13 +4245,51 @@ class PaintApp:
             fg="#1A1A1B",
             bd=0,
         )
-        # Clear tool
-        self.clear_icon = tk.PhotoImage(
-            file="./assets/clear_icon.png", height=16, width=16
+        # Bucket fill tool
+        self.bucket_button = ttk.Button(
+            self.tool_frame,
+            image=self.icons.get("bucket"),
+            compound=tk.LEFT,
+            text="",
+            width=2,
+            command=self.select_bucket_tool,
+        )  # Bucket
+        self.bucket_button.pack(side=tk.LEFT, padx=2, pady=0, ipadx=4, ipady=4)
+        ToolTip(
+            self.bucket_button,
+            msg="Bucket fill tool.",
+            bg="#FAFAFD",
+            fg="#1A1A1B",
+            bd=0,
+        )
+        self.fill_tolerance_combobox = ttk.Combobox(
+            self.tool_frame,
+            values=self.fill_tolerances,
+            state="readonly",
+            width=3,
+            font=("Fira Code", 10, "bold"),
+        )
+        self.fill_tolerance_combobox.current(
+            self.fill_tolerances.index(self.fill_tolerance)
+        )
+        self.fill_tolerance_combobox.pack(side=tk.LEFT, padx=2, pady=0)
+        self.fill_tolerance_combobox.bind(
+            "<<ComboboxSelected>>",
+            lambda event: self.select_fill_tolerance(
+                int(self.fill_tolerance_combobox.get())
+            ),
+        )
+        ToolTip(
+            self.fill_tolerance_combobox,
+            msg="Bucket fill tolerance: how different a colour may be and still be filled.",
+            bg="#FAFAFD",
+            fg="#1A1A1B",
+            bd=0,
         )
+        # Clear tool
         self.clear_button = ttk.Button(
             self.tool_frame,
-            image=self.clear_icon,
+            image=self.icons.get("clear"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -524,12 +4320,9 @@ class PaintApp:
 
         ##TODO : Add more colours
         # Select colours tool
-        self.black = tk.PhotoImage(
-            file="./assets/colors/black.png", height=16, width=16
-        )
         self.black_btn = tk.Button(
             self.colours_frame,
-            image=self.black,
+            image=self.icons.get("black"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -539,10 +4332,9 @@ class PaintApp:
         )
         self.black_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.red = tk.PhotoImage(file="./assets/colors/red.png", height=16, width=16)
         self.red_btn = tk.Button(
             self.colours_frame,
-            image=self.red,
+            image=self.icons.get("red"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -552,12 +4344,9 @@ class PaintApp:
         )
         self.red_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.green = tk.PhotoImage(
-            file="./assets/colors/green.png", height=16, width=16
-        )
         self.green_btn = tk.Button(
             self.colours_frame,
-            image=self.green,
+            image=self.icons.get("green"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -567,12 +4356,9 @@ class PaintApp:
         )
         self.green_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.yellow = tk.PhotoImage(
-            file="./assets/colors/yellow.png", height=16, width=16
-        )
         self.yellow_btn = tk.Button(
             self.colours_frame,
-            image=self.yellow,
+            image=self.icons.get("yellow"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -582,12 +4368,9 @@ class PaintApp:
         )
         self.yellow_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.indigo = tk.PhotoImage(
-            file="./assets/colors/indigo.png", height=16, width=16
-        )
         self.indigo_btn = tk.Button(
             self.colours_frame,
-            image=self.indigo,
+            image=self.icons.get("indigo"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -597,10 +4380,9 @@ class PaintApp:
         )
         self.indigo_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.gold = tk.PhotoImage(file="./assets/colors/gold.png", height=16, width=16)
         self.gold_btn = tk.Button(
             self.colours_frame,
-            image=self.gold,
+            image=self.icons.get("gold"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -610,10 +4392,9 @@ class PaintApp:
         )
         self.gold_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.lime = tk.PhotoImage(file="./assets/colors/lime.png", height=16, width=16)
         self.lime_btn = tk.Button(
             self.colours_frame,
-            image=self.lime,
+            image=self.icons.get("lime"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -623,10 +4404,9 @@ class PaintApp:
         )
         self.lime_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.pink = tk.PhotoImage(file="./assets/colors/pink.png", height=16, width=16)
         self.pink_btn = tk.Button(
             self.colours_frame,
-            image=self.pink,
+            image=self.icons.get("pink"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -636,12 +4416,9 @@ class PaintApp:
         )
         self.pink_btn.pack(side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0)
 
-        self.turquoise = tk.PhotoImage(
-            file="./assets/colors/turquoise.png", height=16, width=16
-        )
         self.turquoise_btn = tk.Button(
             self.colours_frame,
-            image=self.turquoise,
+            image=self.icons.get("turquoise"),
             compound=tk.LEFT,
             text="",
             width=20,
@@ -653,12 +4430,9 @@ class PaintApp:
             side=tk.LEFT, padx=(4, 4), pady=(0, 0), ipadx=0, ipady=0
         )
         # Select custom color tool
-        self.color_choser_icon = tk.PhotoImage(
-            file="./assets/color_choser_icon.png", height=16, width=16
-        )
         self.color_choser_button = ttk.Button(
             self.colours_frame,
-            image=self.color_choser_icon,
+            image=self.icons.get("color_choser"),
             compound=tk.LEFT,
             text="",
             width=2,
@@ -688,18 +4462,84 @@ class PaintApp:
             lambda event: self.select_pen_type(self.pen_type_combobox.get()),
         )
 
+        # Layers list, top layer first, and the layer buttons
+        self.layers_listbox = tk.Listbox(
+            self.layers_frame,
+            height=3,
+            width=16,
+            exportselection=False,
+            activestyle="none",
+            font=("Fira Code", 8, ""),
+        )
+        self.layers_listbox.pack(side=tk.LEFT, padx=(2, 2), pady=(0, 0), fill=tk.Y)
+        self.layers_listbox.bind("<<ListboxSelect>>", self.select_layer)
+        self.layer_buttons_frame = ttk.Frame(self.layers_frame)
+        self.layer_buttons_frame.pack(side=tk.LEFT, padx=(2, 2), pady=(0, 0))
+        for column, (text, command, tip) in enumerate(
+            [
+                ("+", self.add_layer, "Add a layer above the current one."),
+                ("-", self.delete_layer, "Delete the current layer."),
+                ("\u25b2", lambda: self.move_layer(1), "Move the layer up."),
+                ("\u25bc", lambda: self.move_layer(-1), "Move the layer down."),
+                ("\u25c9", self.toggle_layer, "Show or hide the layer."),
+            ]
+        ):
+            button = ttk.Button(
+                self.layer_buttons_frame, text=text, width=2, command=command
+            )
+            button.grid(row=0, column=column, padx=1, pady=1)
+            ToolTip(button, msg=tip, bg="#FAFAFD", fg="#1A1A1B", bd=0)
+        self.layer_opacity = tk.DoubleVar(value=100)
+        self.layer_opacity_scale = ttk.Scale(
+            self.layer_buttons_frame,
+            from_=0,
+            to=100,
+            orient=tk.HORIZONTAL,
+            variable=self.layer_opacity,
+            command=self.set_layer_opacity,
+        )
+        self.layer_opacity_scale.grid(
+            row=1, column=0, columnspan=5, sticky=tk.EW, padx=1, pady=1
+        )
+        ToolTip(
+            self.layer_opacity_scale,
+            msg="Layer opacity.",
+            bg="#FAFAFD",
+            fg="#1A1A1B",
+            bd=0,
+        )
+        self.refresh_layers()
+
     def setup_events(self):
         """Bind the nessesary events to the Canvas widget.\n
+        Bind <ButtonPress-1> to start a stroke. \n
         Bind <B1-Motion> to draw. \n
         Bind <ButtonRelease-1> to trigger the Button Release. \n
-        Bind CTRL+S , CTRL+Z to Save and Undo.\n
+        Bind CTRL+S , CTRL+O , CTRL+Z , CTRL+Y to Save, Open, Undo and Redo.\n
+        Bind F12 to show or hide the performance HUD.\n
+        Bind the mouse wheel and CTRL+plus , CTRL+minus , CTRL+0 to zoom, the middle or right button drag to pan.\n
         """
         self.root.bind("<Control-s>", self.save_as)  # Save file using CTRL+S
+        self.root.bind("<Control-o>", self.open_document)  # Open file using CTRL+O
         self.root.bind("<Control-z>", self.undo)  # UNDO using CTRL+Z
+        self.root.bind("<Control-y>", self.redo)  # REDO using CTRL+Y
         self.root.bind("<Control-n>", self.clear_canvas)  # UNDO using CTRL+Z
+        self.root.bind("<F12>", self.toggle_hud)  # Performance HUD using F12
+        self.root.bind("<Control-plus>", self.zoom_in)  # Zoom in using CTRL++
+        self.root.bind("<Control-equal>", self.zoom_in)
+        self.root.bind("<Control-minus>", self.zoom_out)  # Zoom out using CTRL+-
+        self.root.bind("<Control-0>", self.zoom_reset)  # Actual size using CTRL+0
 
+        self.canvas.bind("<ButtonPress-1>", self.start_draw)
         self.canvas.bind("<B1-Motion>", self.draw)
         self.canvas.bind("<ButtonRelease-1>", self.release)
+        self.canvas.bind("<MouseWheel>", self.zoom_wheel)  # Windows and macOS
+        self.canvas.bind("<Button-4>", self.zoom_wheel)  # X11 wheel up
+        self.canvas.bind("<Button-5>", self.zoom_wheel)  # X11 wheel down
+        for button in (2, 3):
+            self.canvas.bind(f"<ButtonPress-{button}>", self.start_pan)
+            self.canvas.bind(f"<B{button}-Motion>", self.pan)
+        self.canvas.bind("<Configure>", self.view.viewport_changed)
 
     def select_pen_tool(self):
         """Define pen tool function to change the selected pen."""
@@ -714,17 +4554,35 @@ class PaintApp:
         self.setup_events()
 
     def select_eraser_tool(self):
-        """Define eraser tool function to change the selected pen to eraser."""
+        """Define eraser tool function to change the selected pen to eraser.\n
+        The eraser removes the shapes and texts it touches and cuts the strokes, it draws nothing.
+        """
         self.selected_tool = "eraser"
-        self.selected_color = "#FFFFFF"
         self.current_color_label.configure(
-            background=self.selected_color,
+            background="#FFFFFF",
             text=self.selected_tool,
             foreground="#000000",
         )
         self.canvas.unbind("<ButtonPress-1>")
         self.setup_events()
 
+    def select_bucket_tool(self):
+        """Define bucket tool function to change the selected pen to the bucket fill.\n
+        A click fills the region of about the same colour around the clicked point with the selected colour.
+        """
+        self.selected_tool = "bucket"
+        self.current_color_label.configure(
+            background=self.selected_color,
+            text=self.selected_tool,
+            foreground="#FFFFFF",
+        )
+        self.canvas.unbind("<ButtonPress-1>")
+        self.setup_events()
+
+    def select_fill_tolerance(self, tolerance):
+        """Define fill tolerance function to change the tolerance of the bucket tool."""
+        self.fill_tolerance = tolerance
+
     def select_size(self, size):
         """Define select pen size function to change the size of the pen tool."""
         self.selected_size = size
@@ -733,6 +4591,12 @@ class PaintApp:
         """Define text size function to change the size of the text tool."""
         self.selected_text_size = size
 
+    def load_font_families(self):
+        """Fill the font families combobox the first time it is opened."""
+        if not self.fonts_families:
+            self.fonts_families = font_families(self.root)
+            self.fonts_families_combobox.configure(values=self.fonts_families)
+
     def select_font_family(self, font_name):
         """Define font family function to change the font of the text tool."""
         self.selected_fonts_families = font_name
@@ -747,93 +4611,202 @@ class PaintApp:
         """Define select pen type function to change the type of the pen tool."""
         self.selected_pen_type = pen_type
 
-    def draw(self, event):
-        """Define the Draw function that allow the user to draw on the Canvas widget, depending on the selected pen type."""
+    @timed
+    def start_draw(self, event):
+        """Start a new freehand stroke (or eraser drag) at the pressed point."""
+        if not self.document.layer.visible:
+            self.root.bell()  # Nothing is drawn on a hidden layer
+            return
         if self.selected_tool == "pen" or self.selected_tool == "eraser":
+            self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
+            self.stroke = None
+        if self.selected_tool == "eraser":
+            self.erase_along(self.prev_x, self.prev_y, self.prev_x, self.prev_y)
+        if self.selected_tool == "bucket":
+            self.fill_at(*self.view.to_document(event.x, event.y))
+
+    @timed
+    def draw(self, event):
+        """Define the Draw function that allow the user to draw on the Canvas widget, depending on the selected pen type.\n
+        The points are appended to one Stroke of the document, its canvas items are updated by the view.
+        """
+        x, y = self.view.to_document(event.x, event.y)
+        if self.selected_tool == "eraser":
             if self.prev_x is not None and self.prev_y is not None:
-                if self.selected_pen_type == "line":
-                    self.canvas.create_line(
-                        self.prev_x,
-                        self.prev_y,
-                        event.x,
-                        event.y,
-                        fill=self.selected_color,
-                        width=self.selected_size,
-                        smooth=True,
-                    )
-                elif self.selected_pen_type == "round":
-                    x1 = event.x - self.selected_size
-                    y1 = event.y - self.selected_size
-                    x2 = event.x + self.selected_size
-                    y2 = event.y + self.selected_size
-                    self.canvas.create_oval(
-                        x1,
-                        y1,
-                        x2,
-                        y2,
-                        fill=self.selected_color,
-                        outline=self.selected_color,
-                    )
-                elif self.selected_pen_type == "square":
-                    x1 = event.x - self.selected_size
-                    y1 = event.y - self.selected_size
-                    x2 = event.x + self.selected_size
-                    y2 = event.y + self.selected_size
-                    self.canvas.create_rectangle(
-                        x1,
-                        y1,
-                        x2,
-                        y2,
-                        fill=self.selected_color,
-                        outline=self.selected_color,
-                    )
-                elif self.selected_pen_type == "arrow":
-                    x1 = event.x - self.selected_size
-                    y1 = event.y - self.selected_size
-                    x2 = event.x + self.selected_size
-                    y2 = event.y + self.selected_size
-                    self.canvas.create_polygon(
-                        x1,
-                        y1,
-                        x1,
-                        y2,
-                        event.x,
-                        y2,
-                        fill=self.selected_color,
-                        outline=self.selected_color,
-                    )
-                elif self.selected_pen_type == "diamond":
-                    x1 = event.x - self.selected_size
-                    y1 = event.y
-                    x2 = event.x
-                    y2 = event.y - self.selected_size
-                    x3 = event.x + self.selected_size
-                    y3 = event.y
-                    x4 = event.x
-                    y4 = event.y + self.selected_size
-                    self.canvas.create_polygon(
-                        x1,
-                        y1,
-                        x2,
-                        y2,
-                        x3,
-                        y3,
-                        x4,
-                        y4,
-                        fill=self.selected_color,
-                        outline=self.selected_color,
+                self.erase_along(self.prev_x, self.prev_y, x, y)
+            self.prev_x = x
+            self.prev_y = y
+        elif self.selected_tool == "pen":
+            if self.prev_x is not None and self.prev_y is not None:
+                if self.stroke is None:
+                    self.stroke = self.document.add(
+                        Stroke(
+                            self.selected_color,
+                            self.selected_size,
+                            self.selected_pen_type,
+                            (self.prev_x, self.prev_y),
+                        )
                     )
-            self.prev_x = event.x
-            self.prev_y = event.y
+                self.document.extend(self.stroke, x, y)
+                self.view.extend(self.stroke)
+            self.prev_x = x
+            self.prev_y = y
 
+    def erase_along(self, x0, y0, x1, y1):
+        """Erase along the eraser path from (x0, y0) to (x1, y1).\n
+        Only the elements found by the spatial index around the path are tested.
+        """
+        radius = eraser_radius(self.selected_size)
+        for element, pieces in self.document.erase_along(x0, y0, x1, y1, radius):
+            for piece in pieces:
+                self.view.add(piece, above=element)
+                self.erase_pieces[piece.id] = piece
+            if self.erase_pieces.pop(element.id, None) is not None:
+                self.view.remove(element)  # A piece cut earlier in this same drag
+            else:
+                self.view.hide(element)
+                self.erased.append(element)
+
+    def fill_at(self, x, y):
+        """Fill the region around (x, y) with the selected colour, bounded by the strokes of every visible layer."""
+        fill = fill_for(
+            self.document,
+            x,
+            y,
+            self.selected_color,
+            self.fill_tolerance,
+            self.render_cache,
+        )
+        if fill is not None:
+            self.add_element(fill)
+
+    @timed
     def release(self, event):
-        """Define the release function that allow inialize the prev_x and prev_y coordinates to zeros."""
+        """Define the release function that finalize the current stroke and inialize the prev_x and prev_y coordinates."""
+        if self.stroke is not None:
+            if self.simplify_tolerance > 0 or self.fit_curves:
+                self.document.simplify(
+                    self.stroke, self.simplify_tolerance, self.fit_curves
+                )
+            self.view.finish(self.stroke)
+            self.record(Edit(added=[self.stroke]))
+        if self.erased or self.erase_pieces:
+            self.record(
+                Edit(added=self.erase_pieces.values(), removed=self.erased), b"X"
+            )
+            self.erased = []
+            self.erase_pieces = {}
+        self.stroke = None
         self.prev_x = None
         self.prev_y = None
 
+    def add_element(self, element):
+        """Add a finished element to the document, show it on the Canvas and record it for undo."""
+        if not self.document.layer.visible:
+            self.root.bell()  # Nothing is drawn on a hidden layer
+            return
+        self.document.add(element)
+        self.view.add(element)
+        self.record(Edit(added=[element]))
+
+    def record(self, edit, op=b"A"):
+        """Record a finished edit for undo and in the journal, then flatten the older elements if the Canvas
+        holds too many items.
+        """
+        self.history.push(edit)
+        self.journal.log(op, removed=edit.removed, added=edit.added)
+        self.render_cache.changed(added=edit.added, removed=edit.removed)
+        if self.view.needs_flattening():
+            keep = set()
+            for recent in list(self.history.undo_stack)[-FLATTEN_KEEP_STEPS:]:
+                keep.update(element.id for element in recent.added)
+            self.view.flatten(keep)
+
     def clear_canvas(self, event=False):
-        """Define the clear Canvas function that allow to delete all objects from Canvas."""
-        self.canvas.delete("all")
+        """Define the clear Canvas function that allow to delete all objects from Canvas.\n
+        The cleared elements are only hidden, so clearing can be undone.
+        """
+        removed = self.document.clear()
+        if removed:
+            self.view.hide_all(removed)
+            self.record(Edit(removed=removed), b"C")
+
+    def refresh_layers(self):
+        """Fill the Layers list from the document, top layer first, and select the current layer."""
+        layers = self.document.layers
+        self.layers_listbox.delete(0, tk.END)
+        for layer in reversed(layers):
+            label = layer.name if layer.visible else f"({layer.name})"
+            if layer.opacity < 1:
+                label += f" {round(layer.opacity * 100)}%"
+            self.layers_listbox.insert(tk.END, label)
+        index = len(layers) - 1 - self.document.positions[self.document.layer.id]
+        self.layers_listbox.selection_set(index)
+        self.layers_listbox.see(index)
+        self.layer_opacity.set(round(self.document.layer.opacity * 100))
+
+    def layers_changed(self):
+        """Show and journal a change of the layers of the document."""
+        self.view.layers_changed()
+        self.journal.log_layers(self.document)
+        self.refresh_layers()
+
+    def select_layer(self, event=False):
+        """Make the layer selected in the Layers list the one drawn on.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        selection = self.layers_listbox.curselection()
+        if not selection:
+            return
+        layers = self.document.layers
+        layer = layers[len(layers) - 1 - selection[0]]
+        if layer is not self.document.layer:
+            self.document.layer = layer
+            self.layers_changed()
+
+    def add_layer(self):
+        """Add an empty layer above the current one and draw on it."""
+        self.document.add_layer()
+        self.layers_changed()
+
+    def delete_layer(self):
+        """Delete the current layer with its elements, which can be undone. The last layer is never deleted."""
+        if len(self.document.layers) == 1:
+            return
+        layer = self.document.layer
+        edit = LayerEdit(
+            layer,
+            self.document.positions[layer.id],
+            self.document.layer_elements(layer),
+        )
+        edit.apply(self.document, self.view)
+        self.record(edit, b"C")
+        self.journal.log_layers(self.document)
+        self.refresh_layers()
+
+    def move_layer(self, offset):
+        """Move the current layer up (offset 1) or down (offset -1) the stack of layers."""
+        position = self.document.positions[self.document.layer.id] + offset
+        if 0 <= position < len(self.document.layers):
+            self.document.move_layer(self.document.layer, position)
+            self.layers_changed()
+
+    def toggle_layer(self):
+        """Show or hide the current layer. A hidden layer is not exported and cannot be drawn on."""
+        self.document.layer.visible = not self.document.layer.visible
+        self.layers_changed()
+
+    def set_layer_opacity(self, value):
+        """Set the opacity of the current layer from the opacity slider, in percent.\n
+        The layer being drawn on is shown opaque on the Canvas, its opacity applies once another layer is selected
+        and when the drawing is saved as an image.
+        """
+        opacity = round(float(value)) / 100
+        if opacity != self.document.layer.opacity:
+            self.document.layer.opacity = opacity
+            self.layers_changed()
 
     def draw_rectangle(self):
         """Define the rectangle function that allow to bind start and stop events to draw a rectangle."""
@@ -850,20 +4823,25 @@ class PaintApp:
     def start_draw_rectangle(self, event):
         """Define the draw rectangle function that allow inialize the prev_x and prev_y coordinates."""
         self.selected_tool = "rectangle"
-        self.prev_x, self.prev_y = event.x, event.y
+        self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
         self.current_color_label.configure(text=self.selected_tool)
 
+    @timed
     def stop_draw_rectangle(self, event):
         """Define the draw rectangle function that allow to draw a rectangle."""
+        x, y = self.view.to_document(event.x, event.y)
         if self.selected_tool == "rectangle":
             if self.prev_x is not None and self.prev_y is not None:
-                self.canvas.create_rectangle(
-                    self.prev_x,
-                    self.prev_y,
-                    event.x,
-                    event.y,
-                    outline=self.selected_color,
-                    width=self.selected_size,
+                self.add_element(
+                    shape_for(
+                        "rectangle",
+                        self.prev_x,
+                        self.prev_y,
+                        x,
+                        y,
+                        self.selected_color,
+                        self.selected_size,
+                    )
                 )
                 self.prev_x = None
                 self.prev_y = None
@@ -883,21 +4861,25 @@ class PaintApp:
     def start_draw_filled_rectangle(self, event):
         """Define the draw filled rectangle function that allow inialize the prev_x and prev_y coordinates."""
         self.selected_tool = "frectangle"
-        self.prev_x, self.prev_y = event.x, event.y
+        self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
         self.current_color_label.configure(text=self.selected_tool)
 
+    @timed
     def stop_draw_filled_rectangle(self, event):
         """Define the draw filled rectangle function that allow to draw a filled rectangle."""
+        x, y = self.view.to_document(event.x, event.y)
         if self.selected_tool == "frectangle":
             if self.prev_x is not None and self.prev_y is not None:
-                self.canvas.create_rectangle(
-                    self.prev_x,
-                    self.prev_y,
-                    event.x,
-                    event.y,
-                    outline=self.selected_color,
-                    fill=self.selected_color,
-                    width=self.selected_size,
+                self.add_element(
+                    shape_for(
+                        "frectangle",
+                        self.prev_x,
+                        self.prev_y,
+                        x,
+                        y,
+                        self.selected_color,
+                        self.selected_size,
+                    )
                 )
                 self.prev_x = None
                 self.prev_y = None
@@ -916,24 +4898,23 @@ class PaintApp:
     def start_draw_text(self, event):
         """Define the draw text function that allow inialize the prev_x and prev_y coordinates."""
         self.selected_tool = "text"
-        self.prev_x, self.prev_y = event.x, event.y
+        self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
         self.current_color_label.configure(text=self.selected_tool)
 
+    @timed
     def stop_draw_text(self, event):
         """Define the draw text function that allow to draw a text."""
+        x, y = self.view.to_document(event.x, event.y)
         if self.selected_tool == "text" and self.entry_text.get() != "":
             if self.prev_x is not None and self.prev_y is not None:
-                self.canvas.create_text(
-                    event.x,
-                    event.y,
-                    anchor="w",
-                    fill=self.selected_color,
-                    text=self.entry_text.get(),
-                    font=(
-                        self.selected_fonts_families,
-                        self.selected_text_size,
-                        "bold",
-                    ),
+                self.add_element(
+                    Text(
+                        x,
+                        y,
+                        self.entry_text.get(),
+                        self.selected_color,
+                        (self.selected_fonts_families, self.selected_text_size, "bold"),
+                    )
                 )
                 self.prev_x = None
                 self.prev_y = None
@@ -961,20 +4942,25 @@ class PaintApp:
     def start_draw_circle(self, event):
         """Define the draw circle function that allow inialize the prev_x and prev_y coordinates."""
         self.selected_tool = "circle"
-        self.prev_x, self.prev_y = event.x, event.y
+        self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
         self.current_color_label.configure(text=self.selected_tool)
 
+    @timed
     def stop_draw_circle(self, event):
         """Define the draw circle function that allow to draw a circle."""
+        x, y = self.view.to_document(event.x, event.y)
         if self.selected_tool == "circle":
             if self.prev_x is not None and self.prev_y is not None:
-                self.canvas.create_oval(
-                    event.x,
-                    event.y,
-                    self.prev_x,
-                    self.prev_y,
-                    outline=self.selected_color,
-                    width=self.selected_size,
+                self.add_element(
+                    shape_for(
+                        "circle",
+                        self.prev_x,
+                        self.prev_y,
+                        x,
+                        y,
+                        self.selected_color,
+                        self.selected_size,
+                    )
                 )
                 self.prev_x = None
                 self.prev_y = None
@@ -994,22 +4980,26 @@ class PaintApp:
     def start_draw_filled_circle(self, event):
         """Define the draw filled circle function that allow inialize the prev_x and prev_y coordinates."""
         self.selected_tool = "fcircle"
-        self.prev_x, self.prev_y = event.x, event.y
+        self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
         self.current_color_label.configure(text=self.selected_tool)
 
+    @timed
     def stop_draw_filled_circle(self, event):
         """Define the draw filled circle function that allow to draw a filled circle."""
+        x, y = self.view.to_document(event.x, event.y)
         r = 3
         if self.selected_tool == "fcircle":
             if self.prev_x is not None and self.prev_y is not None:
-                self.canvas.create_oval(
-                    event.x,
-                    event.y,
-                    self.prev_x,
-                    self.prev_y,
-                    outline=self.selected_color,
-                    fill=self.selected_color,
-                    width=self.selected_size,
+                self.add_element(
+                    shape_for(
+                        "fcircle",
+                        self.prev_x,
+                        self.prev_y,
+                        x,
+                        y,
+                        self.selected_color,
+                        self.selected_size,
+                    )
                 )
 
                 self.prev_x = None
@@ -1039,9 +5029,10 @@ class PaintApp:
             event (_type_): _description_
         """
         self.selected_tool = "line"
-        self.prev_x, self.prev_y = event.x, event.y
+        self.prev_x, self.prev_y = self.view.to_document(event.x, event.y)
         self.current_color_label.configure(text=self.selected_tool)
 
+    @timed
     def stop_draw_line(self, event):
         """Stop the drawing line.\n
         Create line on canvas by grabing the coordinates from previous prev_x and prev_y and the new coords event.x and event.y\n
@@ -1050,52 +5041,373 @@ class PaintApp:
         Args:
             event (_type_): _description_
         """
+        x, y = self.view.to_document(event.x, event.y)
         if self.selected_tool == "line":
             if self.prev_x is not None and self.prev_y is not None:
-                self.canvas.create_line(
-                    event.x,
-                    event.y,
-                    self.prev_x,
-                    self.prev_y,
-                    fill=self.selected_color,
-                    width=self.selected_size,
+                self.add_element(
+                    shape_for(
+                        "line",
+                        self.prev_x,
+                        self.prev_y,
+                        x,
+                        y,
+                        self.selected_color,
+                        self.selected_size,
+                    )
                 )
 
                 self.prev_x = None
                 self.prev_y = None
 
     def save_as(self, event=False):
-        """Open a dialog to save the drawing as .jpg or .png files.
+        """Open a dialog to save the drawing as .jpg, .png, .webp or scalable .svg files, or as an editable
+        .paint document.\n
+        Image exports first ask for their encoder settings. The drawing is rendered off-screen and encoded
+        by a worker thread, so drawing goes on meanwhile.
 
         Args:
             event (bool, optional): _description_. Defaults to False.
         """
+        if self.export_job is not None:
+            self.root.bell()  # One export at a time
+            return
         file_path = filedialog.asksaveasfilename(
             defaultextension=".jpg",
-            filetypes=[("JPG files", "*.jpg"), ("PNG files", "*.png")],
+            filetypes=[
+                ("JPG files", "*.jpg"),
+                ("PNG files", "*.png"),
+                ("WebP files", "*.webp"),
+                ("SVG files", "*.svg"),
+                ("Paint documents", "*.paint"),
+            ],
+        )
+        if not file_path:
+            return
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == ".paint":
+            self.document.materialize()  # Release the file it may be saved over
+            self.start_export(file_path)
+            return
+        image_format = EXPORT_FORMATS.get(
+            extension
+        ) or Image.registered_extensions().get(extension)
+        if image_format is None:
+            messagebox.showerror("Error", f"Unknown image file type {extension!r}")
+            return
+        settings = self.export_settings.get(image_format)
+        if settings is not None:
+            settings = ExportDialog(self.root, image_format, settings).result
+            if settings is None:
+                return
+            self.export_settings[image_format] = settings
+        self.start_export(file_path, image_format, settings)
+
+    def start_export(self, path, image_format=None, settings=None):
+        """Start exporting the drawing on a worker thread and show its progress at the bottom of the Canvas."""
+        self.close_export_status()
+        self.export_job = ExportJob(self.document, path, image_format, settings).start()
+        self.export_status = ttk.Frame(self.canvas, padding=4)
+        self.export_label = ttk.Label(
+            self.export_status, text=f"Saving {os.path.basename(path)}"
+        )
+        self.export_label.pack(side=tk.LEFT, padx=(0, 6))
+        self.export_progress = ttk.Progressbar(
+            self.export_status, length=160, maximum=1.0
+        )
+        self.export_progress.pack(side=tk.LEFT)
+        self.export_cancel_button = ttk.Button(
+            self.export_status, text="Cancel", command=self.cancel_export
+        )
+        self.export_cancel_button.pack(side=tk.LEFT, padx=(6, 0))
+        self.export_status.place(relx=0.0, rely=1.0, x=8, y=-8, anchor=tk.SW)
+        self.poll_export()
+
+    def poll_export(self):
+        """Show the progress of the running export, then its outcome once done."""
+        job = self.export_job
+        if not job.done:
+            if job.progress is None:  # Encoding
+                if str(self.export_progress.cget("mode")) != "indeterminate":
+                    self.export_progress.configure(mode="indeterminate")
+                    self.export_progress.start(EXPORT_POLL_MS)
+            else:
+                self.export_progress.configure(value=job.progress)
+            self.root.after(EXPORT_POLL_MS, self.poll_export)
+            return
+        self.export_job = None
+        name = os.path.basename(job.path)
+        if job.error is not None:
+            self.close_export_status()
+            messagebox.showerror("Error", f"Failed to save {name}: {job.error}")
+            return
+        self.export_progress.stop()
+        self.export_progress.pack_forget()
+        self.export_cancel_button.pack_forget()
+        self.export_label.configure(
+            text=f"Saved {name}" if job.saved else f"Saving {name} cancelled"
+        )
+        self.export_status_job = self.root.after(
+            EXPORT_STATUS_MS, self.close_export_status
+        )
+
+    def cancel_export(self):
+        """Cancel the running export."""
+        if self.export_job is not None:
+            self.export_job.cancel()
+            self.export_label.configure(text="Cancelling...")
+
+    def close_export_status(self):
+        """Remove the progress of the last export from the Canvas."""
+        if self.export_status_job is not None:
+            self.root.after_cancel(self.export_status_job)
+            self.export_status_job = None
+        if self.export_status is not None:
+            self.export_status.destroy()
+            self.export_status = None
+
+    def new_document(self, event=False):
+        """Open a dialog to start a new drawing of any size up to DOCUMENT_MAX_SIZE pixels a side.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        size = simpledialog.askstring(
+            "New drawing",
+            "Size in pixels (width x height):",
+            initialvalue=f"{self.document.width}x{self.document.height}",
+            parent=self.root,
+        )
+        if size is None:
+            return
+        try:
+            width, height = parse_size(size)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if len(self.document) and not messagebox.askyesno(
+            "New drawing", "Discard the current drawing?"
+        ):
+            return
+        self.set_document(Document(width, height, self.document.background))
+
+    def open_document(self, event=False):
+        """Open a dialog to load a .paint document, replacing the current drawing.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Paint documents", "*.paint")]
         )
         if file_path:
             try:
-                x = self.root.winfo_rootx() + self.canvas.winfo_x()
-                y = self.root.winfo_rooty() + self.canvas.winfo_y()
-                x1 = x + self.canvas.winfo_width()
-                y1 = y + self.canvas.winfo_height()
-                ImageGrab.grab().crop((x, y, x1, y1)).save(file_path)
-                messagebox.showinfo("Save Drawing", "Image file saved successfully!")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to save the image file: {e}")
+                document = load_document(file_path)
+            except (OSError, PaintFormatError) as e:
+                messagebox.showerror("Error", f"Failed to open the document: {e}")
+                return
+            self.set_document(document)
+
+    def import_picture(self, event=False):
+        """Open a dialog to import a JPG or PNG photo on a new bottom layer, to draw over it.\n
+        The page grows to hold the photo. Its mip levels are built on a background thread, the Canvas
+        showing each one as it comes.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        file_path = filedialog.askopenfilename(
+            filetypes=[
+                ("Pictures", "*.jpg *.jpeg *.png"),
+                ("JPG files", "*.jpg *.jpeg"),
+                ("PNG files", "*.png"),
+            ]
+        )
+        if not file_path:
+            return
+        try:
+            with open(file_path, "rb") as f:
+                picture = Picture(0, 0, f.read())
+        except (OSError, Image.DecompressionBombError) as e:
+            messagebox.showerror("Error", f"Failed to import the picture: {e}")
+            return
+        if max(picture.width, picture.height) > DOCUMENT_MAX_SIZE:
+            messagebox.showerror(
+                "Error", f"Pictures go up to {DOCUMENT_MAX_SIZE} pixels a side"
+            )
+            return
+        document = self.document
+        size = document.width, document.height
+        grown = max(size[0], picture.width), max(size[1], picture.height)
+        PictureEdit.resize(document, self.view, grown)
+        current = document.layer
+        layer = document.add_layer(os.path.splitext(os.path.basename(file_path))[0])
+        document.move_layer(layer, 0)
+        document.layer = current
+        picture.layer = layer.id
+        document.add(picture)
+        self.view.layers_changed()
+        self.view.add(picture)
+        if grown != size:
+            self.journal.log_page(document)
+        self.journal.log_layers(document)
+        self.record(PictureEdit(picture, layer, 0, size, grown))
+        self.refresh_layers()
+        self.watch_picture(picture)
+
+    def watch_picture(self, picture, shown=None):
+        """Start building the mip levels of a picture, then redraw it each time a finer level is built.
+
+        Args:
+            picture (Picture): the picture to watch.
+            shown (int, optional): finest level drawn so far, -1 for none. Defaults to None, to start.
+        """
+        if shown is None:
+            picture.start()
+            shown = -1
+        finest = min(picture.levels, default=-1)
+        if finest != shown and picture.id in self.document.elements:
+            self.view.invalidate(picture.bbox(), picture.layer)
+        if finest != 0:
+            self.root.after(PICTURE_POLL_MS, self.watch_picture, picture, finest)
+
+    def set_document(self, document):
+        """Replace the current drawing by another one, starting a fresh history and journal."""
+        self.history.clear()
+        self.document = document
+        self.view.reset(document)
+        self.history = History(document, self.view)
+        self.render_cache.clear()
+        self.journal.reset(document)
+        self.refresh_layers()
+        for element in document:
+            if isinstance(element, Picture):
+                self.watch_picture(element)
+
+    def start_journal(self):
+        """Offer to recover the drawing of a journal left by a crash, then start journaling.\n
+        This waits until the main window is shown, so the question is not hidden by the Splash Screen.
+        """
+        if not self.root.winfo_viewable():
+            self.root.after(100, self.start_journal)
+            return
+        document = None
+        if self.journal.pending() and messagebox.askyesno(
+            "Recover drawing",
+            "Paint was not closed properly. Do you want to recover the unsaved drawing?",
+        ):
+            try:
+                document = replay_journal(self.journal.path)
+            except (OSError, ValueError, IndexError, KeyError, zlib.error) as e:
+                messagebox.showerror("Error", f"Failed to recover the drawing: {e}")
+        if document is not None:
+            self.set_document(document)
+        else:
+            self.journal.reset(self.document)
+        self.journal.start()
+
+    def exit(self):
+        """Stop a running export, flush and delete the journal, then quit the application."""
+        if self.export_job is not None:
+            self.export_job.cancel()
+            self.export_job.thread.join()
+        self.journal.close()
+        self.root.quit()
+
+    def toggle_hud(self, event=False):
+        """Show or hide the performance HUD, also with F12.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        if self.hud is None:
+            self.hud = PerformanceHUD(self)
+        else:
+            self.hud.close()
+            self.hud = None
+        self.hud_shown.set(self.hud is not None)
+
+    def zoom_in(self, event=False):
+        """Zoom in one step around the centre of the Canvas, also with CTRL + plus.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        self.view.zoom_to(self.view.zoom * ZOOM_STEP)
+
+    def zoom_out(self, event=False):
+        """Zoom out one step around the centre of the Canvas, also with CTRL + minus.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        self.view.zoom_to(self.view.zoom / ZOOM_STEP)
+
+    def zoom_reset(self, event=False):
+        """Show the drawing at its actual size, also with CTRL + 0.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        self.view.zoom_to(1.0)
+
+    def zoom_wheel(self, event):
+        """Zoom one step in or out around the mouse pointer with the mouse wheel."""
+        if event.num == 4 or event.delta > 0:
+            self.view.zoom_to(self.view.zoom * ZOOM_STEP, event.x, event.y)
+        else:
+            self.view.zoom_to(self.view.zoom / ZOOM_STEP, event.x, event.y)
+
+    def start_pan(self, event):
+        """Start dragging the view with the middle or right mouse button."""
+        self.canvas.scan_mark(event.x, event.y)
+
+    def pan(self, event):
+        """Drag the view. The Canvas is only scrolled, until the viewport leaves the realized region."""
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.view.viewport_changed()
 
     def undo(self, event=False):
-        """Undo the last changes in the canvas. delete the last drawing object from Canvas.\n
+        """Undo the last changes in the canvas: a whole stroke, shape, text or clear.\n
         Also you can use the CTRL + Z to undo the last changes.
 
         Args:
             event (bool, optional): _description_. Defaults to False.
         """
-        items = self.canvas.find_all()
-        if items:
-            self.canvas.delete(items[-1])
-            # self.stack.append(items[-1])
+        edit = self.history.undo()
+        if edit is None:
+            return
+        if isinstance(
+            edit, LayerEdit
+        ):  # The layer is journaled back before its elements
+            self.journal.log_layers(self.document)
+            self.refresh_layers()
+        self.journal.log(b"U", removed=edit.added, restored=edit.removed)
+        self.render_cache.changed(added=edit.removed, removed=edit.added)
+        if isinstance(edit, PictureEdit):  # Its layer goes after its picture
+            self.journal.log_layers(self.document)
+            if edit.grown != edit.size:
+                self.journal.log_page(self.document)
+            self.refresh_layers()
+
+    def redo(self, event=False):
+        """Redo the last undone change, also with CTRL + Y.
+
+        Args:
+            event (bool, optional): _description_. Defaults to False.
+        """
+        edit = self.history.redo()
+        if edit is None:
+            return
+        if isinstance(edit, PictureEdit):
+            if edit.grown != edit.size:
+                self.journal.log_page(self.document)
+            self.journal.log_layers(self.document)
+            self.refresh_layers()
+        self.journal.log(b"R", removed=edit.removed, restored=edit.added)
+        self.render_cache.changed(added=edit.added, removed=edit.removed)
+        if isinstance(edit, LayerEdit):
+            self.journal.log_layers(self.document)
+            self.refresh_layers()
 
     def about(self):
         """Open the About Window, that contain the app name, logo and version."""
@@ -1121,7 +5433,7 @@ class PaintApp:
         about_window_frame.pack(side=tk.LEFT, fill=tk.BOTH)
 
         self.main_icon = tk.PhotoImage(
-            file="./assets/paint_64.png", height=64, width=64
+            file=os.path.join(ASSETS_DIR, "paint_64.png"), height=64, width=64
         )
 
         tk.Label(
@@ -1153,9 +5465,168 @@ class PaintApp:
         ).pack(side=tk.TOP, padx=2, pady=2, ipadx=5, ipady=5)
 
 
-if __name__ == "__main__":
-    # Inilialize the Splash Screen first.
-    splash_screen = tk.Tk()
+########### Headless rendering ###########
+# An operation script is a JSON file replaying what a user does in the Paint window:
+#   {"width": 900, "height": 600, "background": "#FFFFFF", "operations": [
+#       {"tool": "pen", "pen_type": "round", "color": "#FF0000", "size": 4, "points": [[x, y], ...]},
+#       {"tool": "eraser", "size": 10, "points": [[x, y], ...]},
+#       {"tool": "rectangle", "from": [x, y], "to": [x, y], "color": "#000000", "size": 2},
+#       {"tool": "text", "at": [x, y], "text": "Hello", "color": "#000000", "font": "Tahoma", "size": 12},
+#       {"tool": "bucket", "at": [x, y], "color": "#0000FF", "tolerance": 32},
+#       {"tool": "clear"}, {"tool": "undo"}, {"tool": "redo"}]}
+# The shape tools are "rectangle", "frectangle", "circle", "fcircle" and "line". A pen or eraser
+# drag is its pressed point followed by its motion points. Missing settings take the defaults of
+# the Paint window.
+RENDER_FORMATS = {"png": "PNG", "jpg": "JPEG", "svg": "SVG"}
+
+
+class NullView:
+    """Stands in for the CanvasView when a drawing is replayed without a display."""
+
+    def add(self, element, above=None):
+        pass
+
+    def hide(self, element):
+        pass
+
+    def show(self, element):
+        pass
+
+    def remove(self, element):
+        pass
+
+    def layers_changed(self):
+        pass
+
+
+def replay_script(script):
+    """Build the Document drawn by an operation script, with the semantics of the PaintApp handlers."""
+    document = Document(
+        script.get("width", 900),
+        script.get("height", 600),
+        script.get("background", "#FFFFFF"),
+    )
+    history = History(document, NullView())
+    for operation in script.get("operations", ()):
+        tool = operation["tool"]
+        color = operation.get("color", "#000000")
+        size = operation.get("size", 2)
+        if tool == "pen":
+            points = operation["points"]
+            if len(points) < 2:  # A click without motion draws nothing
+                continue
+            stroke = document.add(
+                Stroke(color, size, operation.get("pen_type", "line"), points[0])
+            )
+            for x, y in points[1:]:
+                document.extend(stroke, x, y)
+            if SIMPLIFY_TOLERANCE > 0 or CURVE_FITTING:
+                document.simplify(stroke, SIMPLIFY_TOLERANCE, CURVE_FITTING)
+            history.push(Edit(added=[stroke]))
+        elif tool == "eraser":
+            points = operation["points"]
+            erased = []
+            pieces = {}
+            radius = eraser_radius(size)
+            for (x0, y0), (x1, y1) in zip(points[:1] + points[:-1], points):
+                for element, cut in document.erase_along(x0, y0, x1, y1, radius):
+                    for piece in cut:
+                        pieces[piece.id] = piece
+                    if pieces.pop(element.id, None) is None:
+                        erased.append(element)
+            if erased or pieces:
+                history.push(Edit(added=pieces.values(), removed=erased))
+        elif tool in SHAPE_TOOLS:
+            shape = shape_for(tool, *operation["from"], *operation["to"], color, size)
+            history.push(Edit(added=[document.add(shape)]))
+        elif tool == "text":
+            family = operation.get("font", "Tahoma")
+            text = Text(
+                *operation["at"],
+                operation["text"],
+                color,
+                (family, operation.get("size", 12), "bold"),
+            )
+            history.push(Edit(added=[document.add(text)]))
+        elif tool == "bucket":
+            fill = fill_for(
+                document,
+                *operation["at"],
+                color,
+                operation.get("tolerance", FILL_TOLERANCE),
+            )
+            if fill is not None:
+                history.push(Edit(added=[document.add(fill)]))
+        elif tool == "clear":
+            removed = document.clear()
+            if removed:
+                history.push(Edit(removed=removed))
+        elif tool == "undo":
+            history.undo()
+        elif tool == "redo":
+            history.redo()
+        else:
+            raise ValueError(f"unknown tool {tool!r}")
+    return document
+
+
+def render_file(path, output_dir, image_format="png"):
+    """Rasterize a .paint document or a .json operation script to an image file, or write it as SVG.\n
+    Return (output path, element count), or raise on a file that cannot be read.
+    """
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as file:
+            document = replay_script(json.load(file))
+    else:
+        document = load_document(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    output = os.path.join(output_dir, f"{name}.{image_format}")
+    if image_format == "svg":
+        save_svg(document, output)
+    else:
+        render_document(document).save(output, RENDER_FORMATS[image_format])
+    return output, len(document)
+
+
+def render_command(args):
+    """Render every input file across a process pool and report the throughput."""
+    os.makedirs(args.output, exist_ok=True)
+    started = time.perf_counter()
+    rendered = failed = elements = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(render_file, path, args.output, args.format): path
+            for path in args.inputs
+        }
+        for future in as_completed(futures):
+            try:
+                output, count = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{futures[future]}: {e}", file=sys.stderr)
+                continue
+            rendered += 1
+            elements += count
+            if args.verbose:
+                print(output)
+    elapsed = time.perf_counter() - started
+    print(
+        f"{rendered} files rendered, {failed} failed, in {elapsed:.2f} s: "
+        f"{rendered / elapsed:.1f} files/s, {elements / elapsed:.0f} elements/s"
+    )
+    return 1 if failed else 0
+
+
+########### Startup ###########
+SPLASH_MIN_SECONDS = (
+    0.5  # The splash screen stays at least this long, even when the app is ready sooner
+)
+log = logging.getLogger("paint")
+
+
+def show_splash(root):
+    """Show the Splash Screen as a borderless window at the center of the screen and return it."""
+    splash_screen = tk.Toplevel(root)
     splash_screen_w = 512  # 300x200
     splash_screen_h = 341
     splash_screen.resizable(False, False)
@@ -1164,8 +5635,11 @@ if __name__ == "__main__":
     splash_screen.overrideredirect(True)
     splash_screen.lift()
     splash_screen.wm_attributes("-topmost", True)
-    splash_screen.wm_attributes("-disabled", True)
-    splash_screen.wm_attributes("-transparentcolor", "white")
+    try:  # Windows only attributes
+        splash_screen.wm_attributes("-disabled", True)
+        splash_screen.wm_attributes("-transparentcolor", "white")
+    except tk.TclError:
+        pass
 
     splash_screen.attributes("-alpha", 1)
     splash_screen.configure(bd=0, borderwidth=0, border=0)
@@ -1175,13 +5649,16 @@ if __name__ == "__main__":
     y = int((splash_screen.winfo_screenheight() / 2) - (splash_screen_h / 2))
     splash_screen.geometry(f"{splash_screen_w}x{splash_screen_h}+{x}+{y}")
 
-    bg_screen_img = tk.PhotoImage(
-        file="./assets/sc_512_341.png", width=splash_screen_w, height=splash_screen_h
+    splash_screen.image = tk.PhotoImage(
+        master=splash_screen,
+        file=os.path.join(ASSETS_DIR, "sc_512_341.png"),
+        width=splash_screen_w,
+        height=splash_screen_h,
     )
     label_bg = tk.Label(
         splash_screen,
         bg="#FFFFFF",
-        image=bg_screen_img,
+        image=splash_screen.image,
         justify=tk.CENTER,
         width=splash_screen_w,
         height=splash_screen_h,
@@ -1189,24 +5666,96 @@ if __name__ == "__main__":
         font=("Fira Code", 16, "bold"),
     )
     label_bg.place(x=0, y=0, relwidth=1, relheight=1)
+    splash_screen.update()
+    return splash_screen
 
-    def destroy_ss():
-        """Close the Splash Screen and open the main window of Paint App."""
-        splash_screen.destroy()
 
-    # Destroy the Splash Screen after 1S and show the main window.
-    splash_screen.after(1000, destroy_ss)
-    splash_screen.mainloop()
+def start_gui(document_size=None):
+    """Start Paint: the main window is built and the text tool font preloaded while the Splash Screen
+    shows, then the Splash Screen closes once the app is ready and SPLASH_MIN_SECONDS have passed.
+    The font families are listed once the first frame is shown, as the list may need a slow scan.
+
+    Args:
+        document_size (tuple, optional): (width, height) of the new drawing. Defaults to the Canvas size.
+    """
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    started = time.perf_counter()
 
+    def phase(name):
+        log.info("startup: %s at %.0f ms", name, (time.perf_counter() - started) * 1000)
+
+    # A single Tk root, hidden behind the Splash Screen until the app is ready.
     root = tk.Tk()
+    root.withdraw()
+    splash_screen = show_splash(root)
+    shown = time.perf_counter()
+    phase("splash screen shown")
+
     root.title("Paint Application")
     # getting screen width and height of display
     width = root.winfo_screenwidth()
     height = root.winfo_screenheight()
 
     root.geometry("%dx%d" % (width, height))  # setting tkinter window size
-    root.state("zoomed")  # make it full window zoomed
     root.configure(bg="#F9F9F9")
-    root.iconbitmap("paint.ico")  # Add an icon to the main app
-    app = PaintApp(root)  # Creating an object of the PaintApp class.
+    try:
+        root.iconbitmap(
+            os.path.join(os.path.dirname(ASSETS_DIR), "paint.ico")
+        )  # Add an icon to the main app
+    except tk.TclError:  # .ico files are only supported on Windows
+        pass
+    app = PaintApp(root, document_size)  # Creating an object of the PaintApp class.
+    phase("main window built")
+
+    # Preload what the first interactions need: the font of the text tool.
+    load_font(app.selected_fonts_families, app.selected_text_size, "bold")
+    phase("text font preloaded")
+
+    def preload_font_families():
+        """Fill the font families list, from the disk cache or by asking Tk on a cold cache."""
+        app.load_font_families()
+        phase("font families loaded")
+
+    def show_main_window():
+        """Close the Splash Screen and open the main window of Paint App."""
+        splash_screen.destroy()
+        root.deiconify()
+        try:
+            root.state("zoomed")  # make it full window zoomed
+        except tk.TclError:  # "zoomed" is not a window state on X11
+            root.attributes("-zoomed", True)
+        root.update_idletasks()
+        phase("first frame")
+        root.after_idle(preload_font_families)
+
+    remaining = SPLASH_MIN_SECONDS - (time.perf_counter() - shown)
+    root.after(max(0, round(remaining * 1000)), show_main_window)
     root.mainloop()
+
+
+def main(argv=None):
+    """Start the Paint window, or run the "render" command to rasterize drawings without a display."""
+    parser = argparse.ArgumentParser(prog="paint", description=PAINTVERSION)
+    commands = parser.add_subparsers(dest="command")
+    render = commands.add_parser(
+        "render", help="Render .paint documents or .json operation scripts to images."
+    )
+    render.add_argument("inputs", nargs="+", help=".paint or .json files")
+    render.add_argument("-o", "--output", default=".", help="output folder")
+    render.add_argument("-f", "--format", choices=RENDER_FORMATS, default="png")
+    render.add_argument(
+        "-j", "--workers", type=int, default=None, help="processes (default: CPUs)"
+    )
+    render.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument(
+        "--size", type=parse_size, help="size of the new drawing, e.g. 20000x20000"
+    )
+    args = parser.parse_args(argv)
+    if args.command == "render":
+        return render_command(args)
+    start_gui(args.size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""The display-free drawing model: elements in a Document, hit-testing through its GridIndex and History."""
+
+from array import array
+
+import paint
+
+
+class View:
+    """Stands in for the CanvasView, recording which elements are shown."""
+
+    def __init__(self):
+        self.shown = set()
+
+    def hide(self, element):
+        self.shown.discard(element.id)
+
+    def show(self, element):
+        self.shown.add(element.id)
+
+    def remove(self, element):
+        self.shown.discard(element.id)
+
+    def layers_changed(self):
+        pass
+
+
+def drawing():
+    """Return a document holding an L shaped stroke, a rectangle over it and a stroke far away."""
+    document = paint.Document(2000, 2000)
+    corner = document.add(
+        paint.Stroke("#000000", 4, "line", [0, 0, 1000, 0, 1000, 1000])
+    )
+    box = document.add(paint.Shape("rectangle", (900, 900, 1100, 1100), "#FF0000"))
+    far = document.add(paint.Stroke("#0000FF", 2, "line", [1800, 1800, 1900, 1900]))
+    return document, corner, box, far
+
+
+def test_stroke_points_are_packed_int16():
+    stroke = paint.Stroke("#000000", 2, "line", [1, 2, 3, 4])
+    stroke.append(-32768, 32767)
+    assert isinstance(stroke.points, array) and stroke.points.typecode == "h"
+    assert list(stroke.points) == [1, 2, 3, 4, -32768, 32767]
+
+
+def test_add_numbers_and_stacks_elements():
+    document, corner, box, far = drawing()
+    assert len(document) == 3
+    assert len({corner.id, box.id, far.id}) == 3
+    assert list(document) == [corner, box, far]
+    assert {element.layer for element in document} == {document.layer.id}
+
+
+def test_hit_test_follows_the_segments():
+    document, corner, box, far = drawing()
+    assert document.find_at(500, 2, 3) == [corner]
+    assert document.find_at(1000, 1000, 3) == [corner, box]  # Bottom to top
+    # Inside the box of the L shaped stroke, but far from both of its segments
+    assert document.find_at(100, 800, 5) == []
+    assert document.find_in(1700, 1700, 2000, 2000) == [far]
+
+
+def test_hit_test_after_remove_and_restore():
+    document, corner, box, far = drawing()
+    document.remove(box)
+    assert document.find_at(1050, 1050, 3) == []
+    document.restore(box)
+    assert document.find_at(1050, 1050, 3) == [box]
+    assert list(document) == [corner, box, far]
+
+
+def test_erase_undo_redo_round_trip():
+    document, corner, box, far = drawing()
+    view = View()
+    view.shown = {element.id for element in document}
+    history = paint.History(document, view)
+    changes = document.erase(500, 0, 10)
+    assert [element for element, pieces in changes] == [corner]
+    pieces = changes[0][1]
+    assert len(pieces) == 2
+    history.push(paint.Edit(added=pieces, removed=[corner]))
+    assert corner.id not in document.elements
+    assert document.find_at(500, 0, 3) == []
+    assert document.find_at(100, 0, 3) == [pieces[0]]
+
+    assert history.undo() is not None
+    assert list(document) == [corner, box, far]
+    assert document.find_at(500, 0, 3) == [corner]
+    assert view.shown == {corner.id, box.id, far.id}
+
+    assert history.redo() is not None
+    assert corner.id not in document.elements
+    assert set(document.elements) == {box.id, far.id, *(piece.id for piece in pieces)}
+    assert history.redo() is None
+
+
+def test_clear_is_undone_whole():
+    document, corner, box, far = drawing()
+    history = paint.History(document, View())
+    removed = document.clear()
+    history.push(paint.Edit(removed=removed))
+    assert len(document) == 0 and document.find_in(0, 0, 2000, 2000) == []
+    history.undo()
+    assert list(document) == [corner, box, far]
+    assert document.find_in(0, 0, 2000, 2000) == [corner, box, far]
+
+
+def test_history_drops_the_oldest_steps():
+    document = paint.Document(100, 100)
+    history = paint.History(document, View(), max_entries=3)
+    strokes = []
+    for x in range(5):
+        strokes.append(document.add(paint.Stroke("#000000", 2, "line", [x, 0, x, 50])))
+        history.push(paint.Edit(added=[strokes[-1]]))
+    while history.undo() is not None:
+        pass
+    assert list(document) == strokes[:2]
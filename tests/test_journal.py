@@ -0,0 +1,84 @@
+"""Torn-write recovery of the operation journal: a damaged tail is dropped, the intact prefix replays."""
+
+import struct
+import zlib
+
+import pytest
+
+import paint
+
+STROKES = [
+    [10, 10, 50, 60, 90, 20],
+    [100, 100, 120, 140],
+    [5, 300, 200, 310, 400, 290, 600, 305],
+]
+
+
+def summary(document):
+    """Return what a replayed drawing holds: its size and the layer and points of each stroke."""
+    return (
+        document.width,
+        document.height,
+        [(element.layer, list(element.points)) for element in document],
+    )
+
+
+def expected(count):
+    """Return the summary of the drawing once the first count strokes were journaled."""
+    return 900, 600, [(1, points) for points in STROKES[:count]]
+
+
+def records(data):
+    """Return the (start, payload start, end) offsets of the records of a journal file."""
+    spans = []
+    offset = len(paint.JOURNAL_MAGIC)
+    while offset < len(data):
+        length, _ = paint.RECORD_HEADER.unpack_from(data, offset)
+        start = offset + paint.RECORD_HEADER.size
+        spans.append((offset, start, start + length))
+        offset = start + length
+    return spans
+
+
+@pytest.fixture
+def journal(tmp_path):
+    """Write a journal of a snapshot followed by one record per stroke, return its path and bytes."""
+    path = tmp_path / "journal.wal"
+    journal = paint.Journal(str(path), sync_interval=0)
+    journal.start()
+    document = paint.Document(900, 600)
+    journal.reset(document)
+    for points in STROKES:
+        stroke = document.add(paint.Stroke("#000000", 2, "line", points))
+        journal.log(b"A", added=[stroke])
+    journal.close(remove=False)
+    data = path.read_bytes()
+    assert summary(paint.replay_journal(str(path))) == expected(len(STROKES))
+    return path, data
+
+
+def test_truncated_inside_last_record(journal):
+    path, data = journal
+    start, payload, end = records(data)[-1]
+    for cut in (start + 1, payload, payload + 3, end - 1):
+        path.write_bytes(data[:cut])
+        assert summary(paint.replay_journal(str(path))) == expected(len(STROKES) - 1)
+
+
+def test_garbage_appended(journal):
+    path, data = journal
+    for garbage in (b"\x00", b"\xff" * 5, struct.pack("<II", 3, 0) + b"abc"):
+        path.write_bytes(data + garbage)
+        assert summary(paint.replay_journal(str(path))) == expected(len(STROKES))
+
+
+@pytest.mark.parametrize("stroke", range(len(STROKES)))
+def test_flipped_byte_in_payload(journal, stroke):
+    path, data = journal
+    # The snapshot takes the D, L and S records, then comes one record per stroke.
+    _, payload, end = records(data)[3 + stroke]
+    damaged = bytearray(data)
+    damaged[(payload + end) // 2] ^= 0x40
+    assert zlib.crc32(damaged[payload:end]) != zlib.crc32(data[payload:end])
+    path.write_bytes(bytes(damaged))
+    assert summary(paint.replay_journal(str(path))) == expected(stroke)
@@ -0,0 +1,70 @@
+# Pack the toolbar and menu icons of ./assets into one atlas image, assets/icons.png, with the
+# position of every icon in assets/icons.json. Run it again after changing an icon:
+#     python tools/build_atlas.py
+import json
+import os
+
+from PIL import Image
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets")
+ATLAS_WIDTH = 128
+
+# Icon name -> (file in ./assets, size shown). The colour swatches are 32x32 files of which the
+# toolbar only ever showed the top left 16x16 corner.
+ICONS = {
+    "save": ("save_icon.png", 16),
+    "exit": ("exit_icon.png", 16),
+    "undo": ("undo_icon.png", 16),
+    "about": ("about_icon.png", 16),
+    "undo32": ("undo32_icon.png", 32),
+    "text": ("text_icon.png", 16),
+    "rectangle": ("rectangle_icon.png", 16),
+    "f_rectangle": ("f_rectangle_icon.png", 16),
+    "circle": ("circle_icon.png", 16),
+    "f_circle": ("f_circle_icon.png", 16),
+    "line": ("line_icon.png", 16),
+    "pen": ("pen_icon.png", 16),
+    "eraser": ("eraser_icon.png", 16),
+    "bucket": ("bucket_icon.png", 16),
+    "clear": ("clear_icon.png", 16),
+    "color_choser": ("color_choser_icon.png", 16),
+    "black": ("colors/black.png", 16),
+    "red": ("colors/red.png", 16),
+    "green": ("colors/green.png", 16),
+    "yellow": ("colors/yellow.png", 16),
+    "indigo": ("colors/indigo.png", 16),
+    "gold": ("colors/gold.png", 16),
+    "lime": ("colors/lime.png", 16),
+    "pink": ("colors/pink.png", 16),
+    "turquoise": ("colors/turquoise.png", 16),
+}
+
+
+def main():
+    """Place the icons on shelves, tallest first, and write the atlas and its index."""
+    icons = {}
+    for name, (file, size) in ICONS.items():
+        with Image.open(os.path.join(ASSETS_DIR, file)) as image:
+            icons[name] = image.convert("RGBA").crop((0, 0, size, size))
+    index = {}
+    x = y = shelf = 0
+    for name in sorted(icons, key=lambda name: -icons[name].height):
+        width, height = icons[name].size
+        if x + width > ATLAS_WIDTH:
+            x, y, shelf = 0, y + shelf, 0
+        index[name] = [x, y, width, height]
+        x += width
+        shelf = max(shelf, height)
+    atlas = Image.new("RGBA", (ATLAS_WIDTH, y + shelf), (0, 0, 0, 0))
+    for name, (x, y, width, height) in index.items():
+        atlas.paste(icons[name], (x, y))
+    atlas.save(os.path.join(ASSETS_DIR, "icons.png"), optimize=True)
+    with open(os.path.join(ASSETS_DIR, "icons.json"), "w", encoding="utf-8") as file:
+        entries = (
+            f"  {json.dumps(name)}: {box}" for name, box in sorted(index.items())
+        )
+        file.write("{\n" + ",\n".join(entries) + "\n}\n")
+
+
+if __name__ == "__main__":
+    main()